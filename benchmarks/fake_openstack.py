@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+    In-process stand-ins for the cinder and nova clients used by
+    migration_planner.py. Managers list generated resources with
+    marker/limit pagination and count the API calls made in a Counter
+    shared by all the managers of a cloud.
+"""
+
+import random
+from collections import Counter
+
+VOLUME_TYPES = ('hos-legacy', 'ses-rbd', 'ses-ssd')
+
+class NotFound(Exception):
+    """Mirrors the 404 errors of cinderclient and novaclient"""
+    code = http_status = 404
+
+class Resource(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+class VolumeType(Resource):
+
+    def get_keys(self):
+        return dict(volume_backend_name=self.name)
+
+class FakeManager(object):
+    """Cinder or nova manager listing resources with marker/limit pagination"""
+
+    def __init__(self, name, resources, calls=None):
+        self.name = name
+        self.resources = resources
+        self.index = {x.id: i for i, x in enumerate(resources)}
+        self.calls = Counter() if calls is None else calls
+
+    def count(self, op):
+        self.calls['%s.%s' % (self.name, op)] += 1
+
+    def list(self, search_opts=None, marker=None, limit=None, detailed=True):
+        self.count('list')
+        search_opts = search_opts or {}
+        # Generated resources never change: nothing was updated since a given time
+        if 'changes-since' in search_opts or 'updated_at' in search_opts:
+            return []
+        start = self.index[marker] + 1 if marker is not None else 0
+        end = start + limit if limit else len(self.resources)
+        return self.resources[start:end]
+
+    def get(self, resid):
+        self.count('get')
+        if resid not in self.index:
+            raise NotFound(resid)
+        return self.resources[self.index[resid]]
+
+class FakeVolumeTypes(object):
+
+    def __init__(self, names, calls):
+        self.types = [VolumeType(id='type-%d' % i, name=x) for i, x in enumerate(names)]
+        self.calls = calls
+
+    def list(self):
+        self.calls['volume_types.list'] += 1
+        return list(self.types)
+
+class FakeCinder(object):
+
+    def __init__(self, volumes, snapshots, volume_types=VOLUME_TYPES, calls=None):
+        self.calls = Counter() if calls is None else calls
+        self.volumes = FakeManager('volumes', volumes, self.calls)
+        self.volume_snapshots = FakeManager('volume_snapshots', snapshots, self.calls)
+        self.volume_types = FakeVolumeTypes(volume_types, self.calls)
+
+class FakeNova(object):
+
+    def __init__(self, servers, calls=None):
+        self.calls = Counter() if calls is None else calls
+        self.servers = FakeManager('servers', servers, self.calls)
+
+def make_cloud(volumes, snapshots_per_volume, servers, attached=0.5, seed=0):
+    """
+        Generate a cloud of volumes of random types, a share of them attached
+        to one of the servers, each with up to snapshots_per_volume snapshots.
+        Return (cinder, nova) clients sharing a single API call Counter.
+    """
+    rnd = random.Random(seed)
+    calls = Counter()
+    vols = []
+    srv_volumes = {}
+    for i in range(volumes):
+        volid = 'vol-%d' % i
+        attachments = []
+        if servers and rnd.random() < attached:
+            srvid = 'srv-%d' % rnd.randrange(servers)
+            attachments.append(dict(server_id=srvid))
+            srv_volumes.setdefault(srvid, []).append(dict(id=volid))
+        vols.append(Resource(id=volid, size=rnd.randint(1, 500), volume_type=rnd.choice(VOLUME_TYPES),
+                             attachments=attachments, **{'os-vol-host-attr:host': 'controller@%s#%s' % (
+                                 'legacy' if i % 2 else 'ses', 'pool')}))
+    snaps = [Resource(id='snap-%d-%d' % (i, j), volume_id=v.id)
+             for i, v in enumerate(vols) for j in range(rnd.randint(0, snapshots_per_volume))]
+    srvs = []
+    for i in range(servers):
+        srvid = 'srv-%d' % i
+        vols_attached = srv_volumes.get(srvid, [])
+        # One server in four boots from its first volume
+        image = dict(id='image-%d' % (i % 10)) if i % 4 or not vols_attached else ''
+        srvs.append(Resource(id=srvid, name='instance-%d' % i, image=image,
+                             status=rnd.choice(('ACTIVE', 'ACTIVE', 'ACTIVE', 'SHUTOFF')),
+                             **{'os-extended-volumes:volumes_attached': vols_attached,
+                                'OS-EXT-SRV-ATTR:host': 'compute-%d' % (i % 50)}))
+    return FakeCinder(vols, snaps, calls=calls), FakeNova(srvs, calls=calls)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""
+    Stand-in for the rbd command line, storing the images of each cluster
+    and pool as sparse files under $FAKE_RBD_ROOT (default /tmp/fake-rbd).
+
+    Implements the subset of rbd used by rbd-migrate.py. Diffs use their
+    own format: a JSON header line followed by the data of each extent.
+"""
+
+import json, os, shutil, sys
+
+BLOCK = 65536
+ZERO = b'\0' * BLOCK
+
+def fail(msg):
+    sys.stderr.write('rbd: %s\n' % msg)
+    sys.exit(2)
+
+class Image(object):
+
+    def __init__(self, pool_dir, name):
+        self.dir = os.path.join(pool_dir, name)
+        self.name = name
+
+    @property
+    def exists(self):
+        return os.path.isdir(self.dir)
+
+    def data(self, snap=None):
+        return os.path.join(self.dir, 'snap.' + snap if snap else 'head')
+
+    def load(self):
+        if not self.exists:
+            fail('error opening image %s: (2) No such file or directory' % self.name)
+        with open(os.path.join(self.dir, 'meta.json')) as f:
+            return json.load(f)
+
+    def save(self, meta):
+        with open(os.path.join(self.dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    def create(self, size):
+        if self.exists:
+            fail('image already exists')
+        os.makedirs(self.dir)
+        with open(self.data(), 'wb') as f:
+            f.truncate(size)
+        self.save(dict(size=size, snaps=[], meta={}))
+
+    def resize(self, size):
+        meta = self.load()
+        with open(self.data(), 'r+b') as f:
+            f.truncate(size)
+        meta['size'] = size
+        self.save(meta)
+
+    def extents(self, snap=None, from_snap=None):
+        """Allocated (offset, length) extents, or the ones differing from from_snap"""
+        with open(self.data(snap), 'rb') as f:
+            base = open(self.data(from_snap), 'rb') if from_snap else None
+            offset = 0
+            try:
+                while True:
+                    block = f.read(BLOCK)
+                    if not block:
+                        return
+                    if base is not None:
+                        if block != base.read(BLOCK).ljust(len(block), b'\0'):
+                            yield offset, len(block)
+                    elif block != ZERO[:len(block)]:
+                        yield offset, len(block)
+                    offset += len(block)
+            finally:
+                if base is not None:
+                    base.close()
+
+def split_spec(spec):
+    return spec.split('@', 1) if '@' in spec else (spec, None)
+
+def main(argv):
+    root = os.environ.get('FAKE_RBD_ROOT', '/tmp/fake-rbd')
+    opts = {}
+    args = []
+    i = 0
+    while i < len(argv):
+        if argv[i] in ('-c', '--id', '-p', '--pool', '--format', '--size', '--from-snap', '--snap',
+                       '--image-format', '--stripe-unit', '--stripe-count', '--order', '--image-features'):
+            opts[argv[i]] = argv[i + 1]
+            i += 2
+        else:
+            args.append(argv[i])
+            i += 1
+    cluster = os.path.basename(opts.get('-c', 'ceph.conf')).rsplit('.', 1)[0]
+    pool_dir = os.path.join(root, cluster, opts.get('-p', opts.get('--pool', 'rbd')))
+    if not os.path.isdir(pool_dir):
+        os.makedirs(pool_dir)
+    out = sys.stdout.write
+    cmd, args = args[0], args[1:]
+    if cmd == 'ls':
+        out(json.dumps(sorted(os.listdir(pool_dir))) if '--format' in opts else
+            ''.join(x + '\n' for x in sorted(os.listdir(pool_dir))))
+    elif cmd == 'info':
+        name, snap = split_spec(args[0])
+        meta = Image(pool_dir, name).load()
+        out(json.dumps(dict(name=name, size=meta['size'])))
+    elif cmd == 'create':
+        Image(pool_dir, args[0]).create(int(opts['--size']) * 1024 * 1024)
+    elif cmd == 'rm':
+        image = Image(pool_dir, args[0])
+        if image.load()['snaps']:
+            fail('image has snapshots - not removing')
+        shutil.rmtree(image.dir)
+    elif cmd == 'diff':
+        name, snap = split_spec(args[0])
+        image = Image(pool_dir, name)
+        image.load()
+        out(json.dumps([dict(offset=o, length=l, exists='true')
+                        for o, l in image.extents(snap, opts.get('--from-snap'))]))
+    elif cmd == 'snap':
+        sub, spec = args[0], args[1]
+        name, snap = split_spec(spec)
+        image = Image(pool_dir, name)
+        meta = image.load()
+        if sub == 'create':
+            shutil.copyfile(image.data(), image.data(snap))
+            meta['snaps'].append(snap)
+        elif sub == 'rm':
+            os.remove(image.data(snap))
+            meta['snaps'].remove(snap)
+        elif sub == 'purge':
+            for s in meta['snaps']:
+                os.remove(image.data(s))
+            meta['snaps'] = []
+        elif sub == 'ls':
+            out(json.dumps([dict(id=i, name=s) for i, s in enumerate(meta['snaps'])]))
+            return
+        image.save(meta)
+    elif cmd == 'image-meta':
+        sub, name = args[0], args[1]
+        image = Image(pool_dir, name)
+        meta = image.load()
+        if sub == 'get':
+            if args[2] not in meta['meta']:
+                fail('failed to get metadata %s of image : (2) No such file or directory' % args[2])
+            out(meta['meta'][args[2]] + '\n')
+        elif sub == 'set':
+            meta['meta'][args[2]] = args[3]
+            image.save(meta)
+        elif sub == 'remove':
+            meta['meta'].pop(args[2], None)
+            image.save(meta)
+    elif cmd == 'export-diff':
+        name, snap = split_spec(args[0])
+        image = Image(pool_dir, name)
+        meta = image.load()
+        from_snap = opts.get('--from-snap')
+        extents = list(image.extents(snap, from_snap))
+        stream = getattr(sys.stdout, 'buffer', sys.stdout)
+        stream.write((json.dumps(dict(size=os.path.getsize(image.data(snap)), from_snap=from_snap, to_snap=snap,
+                                      extents=extents)) + '\n').encode('utf-8'))
+        with open(image.data(snap), 'rb') as f:
+            for offset, length in extents:
+                f.seek(offset)
+                stream.write(f.read(length))
+    elif cmd == 'import-diff':
+        image = Image(pool_dir, args[1])
+        meta = image.load()
+        stream = getattr(sys.stdin, 'buffer', sys.stdin)
+        header = json.loads(stream.readline().decode('utf-8'))
+        if header['from_snap'] and header['from_snap'] not in meta['snaps']:
+            fail('start snapshot %s does not exist in the image' % header['from_snap'])
+        image.resize(header['size'])
+        with open(image.data(), 'r+b') as f:
+            for offset, length in header['extents']:
+                f.seek(offset)
+                f.write(stream.read(length))
+        if header['to_snap']:
+            meta = image.load()
+            shutil.copyfile(image.data(), image.data(header['to_snap']))
+            meta['snaps'].append(header['to_snap'])
+            image.save(meta)
+    else:
+        fail('unknown command %s' % cmd)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,553 @@
+#!/usr/bin/env python
+"""
+    In-process stand-in for a radosgw cluster, serving over HTTP the Swift
+    API and the parts of the admin API used by rgw-migrate.py.
+
+    Objects loaded by the benchmarks are generated from their size and a
+    seed rather than stored. Uploaded objects are kept in memory up to
+    KEEP_LIMIT bytes: beyond, only their size and etag are, and reading them
+    back fails. Server side copies with X-Copy-From are supported, DLO
+    manifests being copied as the concatenation of their segments. Requests
+    are counted by operation in FakeRadosGW.calls.
+"""
+
+import bisect, hashlib, json, socket, threading, time, uuid
+from collections import Counter
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SocketServer import ThreadingMixIn
+try:
+    from urllib.parse import parse_qsl, unquote, urlparse
+except ImportError:
+    from urllib import unquote
+    from urlparse import parse_qsl, urlparse
+
+BLOCK = 65536
+KEEP_LIMIT = 8 * 1024 * 1024
+# Largest object created by a server side copy (rgw_max_put_size)
+MAX_COPY_SIZE = 5 * 1024 * 1024 * 1024
+LISTING_LIMIT = 10000
+STORAGE_PATH = '/swift/v1'
+# Request headers stored with containers and objects
+CONTAINER_HEADERS = ('x-storage-policy', 'x-container-read', 'x-container-write')
+OBJECT_HEADERS = ('content-type', 'content-encoding', 'content-disposition', 'x-object-manifest')
+EMPTY_ETAG = hashlib.md5(b'').hexdigest()
+
+_patterns = {}
+_etags = {}
+
+def pattern(seed):
+    """Block of pseudo-random bytes repeated in generated objects"""
+    p = _patterns.get(seed)
+    if p is None:
+        digest = hashlib.sha512(str(seed).encode('utf-8')).digest()
+        p = _patterns[seed] = digest * (BLOCK // len(digest))
+    return p
+
+def iter_generated(seed, start, end):
+    p = pattern(seed)
+    while start < end:
+        offset = start % BLOCK
+        chunk = p[offset:offset + min(BLOCK - offset, end - start)]
+        start += len(chunk)
+        yield chunk
+
+def generated_etag(seed, size):
+    key = (seed, size)
+    if key not in _etags:
+        md5 = hashlib.md5()
+        for chunk in iter_generated(seed, 0, size):
+            md5.update(chunk)
+        _etags[key] = md5.hexdigest()
+    return _etags[key]
+
+def timestamp():
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000000', time.gmtime())
+
+class ContentNotRetained(Exception):
+    pass
+
+class Object(object):
+
+    def __init__(self, size, etag, headers, data=None, seed=None):
+        self.size = size
+        self.etag = etag
+        self.headers = headers
+        self.data = data
+        self.seed = seed
+        self.last_modified = timestamp()
+
+    def chunks(self, start, end):
+        if self.data is not None:
+            for offset in range(start, end, BLOCK):
+                yield self.data[offset:min(offset + BLOCK, end)]
+        elif self.seed is not None:
+            for chunk in iter_generated(self.seed, start, end):
+                yield chunk
+        elif end > start:
+            raise ContentNotRetained()
+
+class Container(object):
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.objects = {}
+        self.names = None
+
+    def put(self, name, obj):
+        if name not in self.objects:
+            self.names = None
+        self.objects[name] = obj
+
+    def delete(self, name):
+        del self.objects[name]
+        self.names = None
+
+    def listing(self, marker='', prefix='', limit=LISTING_LIMIT):
+        if self.names is None:
+            self.names = sorted(self.objects)
+        names = []
+        for name in self.names[bisect.bisect_right(self.names, max(marker, prefix)):]:
+            if len(names) >= limit or not name.startswith(prefix):
+                break
+            names.append(name)
+        return names
+
+    @property
+    def bytes(self):
+        return sum(x.size for x in self.objects.values())
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # Clients closing their connections are part of the game
+        pass
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    gateway = None
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # Headers and bodies are written separately: do not wait for delayed ACKs
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def header(self, name, default=None):
+        value = self.headers.get(name)
+        return default if value is None else value
+
+    def iter_body(self):
+        if self.header('content-length') is not None:
+            remaining = int(self.header('content-length'))
+            while remaining > 0:
+                chunk = self.rfile.read(min(BLOCK, remaining))
+                if not chunk:
+                    raise IOError('connection closed by client')
+                remaining -= len(chunk)
+                yield chunk
+        elif self.header('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                yield self.rfile.read(size)
+                self.rfile.readline()
+
+    def respond(self, status, headers=None, body=b'', content_length=None):
+        self.send_response(status)
+        self.send_header('X-Trans-Id', uuid.uuid4().hex)
+        for k, v in (headers or {}).items():
+            self.send_header(k, str(v))
+        self.send_header('Content-Length', str(len(body) if content_length is None else content_length))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def respond_json(self, status, data, headers=None):
+        headers = dict(headers or {}, **{'Content-Type': 'application/json; charset=utf-8'})
+        self.respond(status, headers, json.dumps(data).encode('utf-8'))
+
+    def dispatch(self):
+        url = urlparse(self.path)
+        path = unquote(url.path)
+        query = dict(parse_qsl(url.query, keep_blank_values=True))
+        gateway = self.gateway
+        if gateway.latency:
+            time.sleep(gateway.latency)
+        if path == '/auth':
+            gateway.count(self.command, 'auth')
+            self.drain()
+            return gateway.auth(self)
+        if path.startswith('/admin/'):
+            resource = path[len('/admin/'):]
+            gateway.count(self.command, 'admin/' + resource)
+            self.drain()
+            return gateway.admin(self, resource, query)
+        if path == STORAGE_PATH or path.startswith(STORAGE_PATH + '/'):
+            parts = path[len(STORAGE_PATH) + 1:].split('/', 1)
+            container = parts[0] or None
+            obj = parts[1] if len(parts) > 1 and parts[1] else None
+            gateway.count(self.command, 'object' if obj else 'container' if container else 'account')
+            if self.command != 'PUT' or obj is None:
+                self.drain()
+            return gateway.swift(self, container, obj, query)
+        gateway.count(self.command, 'other')
+        self.drain()
+        self.respond(404)
+
+    def drain(self):
+        for _ in self.iter_body():
+            pass
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = dispatch
+
+class FakeRadosGW(object):
+    """radosgw cluster served on host:port by a pool of threads"""
+
+    ADMIN_KEY = ('admin', 'secret')
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.users = {}
+        self.containers = {}
+        self.swift_keys = {}
+        self.tokens = {}
+        handler = type('Handler', (RequestHandler,), dict(gateway=self))
+        self.server = ThreadingServer((host, port), handler)
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        return self.server.server_address[:2]
+
+    @property
+    def credentials(self):
+        """Admin credentials in the host:port:access_key:secret_key format of rgw-migrate.py"""
+        return '%s:%d:%s:%s' % (self.endpoint + self.ADMIN_KEY)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-rgw-%d' % self.endpoint[1])
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, method, kind):
+        with self.lock:
+            self.calls['%s %s' % (method, kind)] += 1
+
+    ### Data sets
+
+    def add_user(self, uid, display_name=None):
+        self.users[uid] = dict(user_id=uid, display_name=display_name or uid, email='', suspended=0,
+                               max_buckets=1000, subusers=[], keys=[], swift_keys=[], caps=[],
+                               quota=dict(user=self.default_quota(), bucket=self.default_quota()))
+        self.containers[uid] = {}
+
+    def add_container(self, uid, name, headers=None):
+        self.containers[uid][name] = Container(dict(headers or {}))
+
+    def add_object(self, uid, container, name, size, seed, headers=None):
+        headers = dict(headers or {})
+        headers.setdefault('content-type', 'application/octet-stream')
+        self.containers[uid][container].put(name, Object(size, generated_etag(seed, size), headers, seed=seed))
+
+    def add_dlo(self, uid, container, name, segment_container, segment_sizes, seed):
+        for i, size in enumerate(segment_sizes):
+            self.add_object(uid, segment_container, '%s/%08d' % (name, i), size, seed + i)
+        headers = {'content-type': 'application/octet-stream',
+                   'x-object-manifest': '%s/%s/' % (segment_container, name)}
+        self.containers[uid][container].put(name, Object(0, EMPTY_ETAG, headers, data=b''))
+
+    def totals(self, uid=None):
+        """Number of objects and bytes stored, for all the users or one of them"""
+        objects = size = 0
+        for u in ([uid] if uid else self.containers):
+            for c in self.containers[u].values():
+                objects += len(c.objects)
+                size += c.bytes
+        return objects, size
+
+    ### Swift authentication
+
+    def auth(self, request):
+        user = request.header('x-auth-user')
+        key = request.header('x-auth-key')
+        uid = self.swift_keys.get(user, (None, None))
+        if user is None or uid[1] != key:
+            return request.respond(401)
+        token = 'AUTH_tk' + uuid.uuid4().hex
+        with self.lock:
+            self.tokens[token] = uid[0]
+        host, port = self.endpoint
+        request.respond(204, {'X-Storage-Url': 'http://%s:%d%s' % (host, port, STORAGE_PATH),
+                              'X-Auth-Token': token, 'X-Storage-Token': token})
+
+    ### Admin API, signatures are not checked
+
+    @staticmethod
+    def default_quota():
+        return dict(enabled=False, max_size_kb=-1, max_objects=-1)
+
+    def admin(self, request, resource, query):
+        method = request.command
+        if resource == 'metadata/user' and method == 'GET':
+            return request.respond_json(200, sorted(self.users))
+        if resource != 'user':
+            return request.respond_json(400, dict(Code='InvalidArgument'))
+        uid = query.get('uid')
+        user = self.users.get(uid)
+        if method == 'PUT' and 'quota' not in query and 'subuser' not in query and 'key' not in query:
+            if user is not None:
+                return request.respond_json(409, dict(Code='UserAlreadyExists'))
+            with self.lock:
+                self.add_user(uid, query.get('display-name'))
+            return request.respond_json(200, self.user_info(uid))
+        if user is None:
+            return request.respond_json(404, dict(Code='NoSuchUser'))
+        if 'quota' in query:
+            qtype = query.get('quota-type', 'user')
+            if method == 'GET':
+                return request.respond_json(200, user['quota'][qtype])
+            user['quota'][qtype] = dict((k.replace('-', '_'), v) for k, v in query.items()
+                                        if k in ('enabled', 'max-size-kb', 'max-objects'))
+            return request.respond(200)
+        if 'key' in query:
+            with self.lock:
+                subuser = query.get('subuser')
+                user['swift_keys'] = [x for x in user['swift_keys'] if x['user'] != subuser]
+                self.swift_keys.pop(subuser, None)
+            return request.respond(200)
+        if 'subuser' in query:
+            subuser = query['subuser']
+            with self.lock:
+                if method == 'PUT' and any(x['id'] == subuser for x in user['subusers']):
+                    return request.respond_json(409, dict(Code='SubuserExists'))
+                self.remove_subuser(user, subuser)
+                if method == 'PUT':
+                    secret = query.get('secret') or uuid.uuid4().hex
+                    user['subusers'].append(dict(id=subuser, permissions='full-control'))
+                    user['swift_keys'].append(dict(user=subuser, secret_key=secret))
+                    self.swift_keys[subuser] = (uid, secret)
+            return request.respond_json(200, user['subusers'])
+        if method == 'GET':
+            return request.respond_json(200, self.user_info(uid))
+        if method == 'DELETE':
+            with self.lock:
+                del self.users[uid]
+                del self.containers[uid]
+            return request.respond(200)
+        request.respond_json(400, dict(Code='InvalidArgument'))
+
+    def user_info(self, uid):
+        return dict((k, v) for k, v in self.users[uid].items() if k != 'quota')
+
+    def remove_subuser(self, user, subuser):
+        user['subusers'] = [x for x in user['subusers'] if x['id'] != subuser]
+        user['swift_keys'] = [x for x in user['swift_keys'] if x['user'] != subuser]
+        self.swift_keys.pop(subuser, None)
+
+    ### Swift API
+
+    def swift(self, request, container, obj, query):
+        uid = self.tokens.get(request.header('x-auth-token'))
+        c = self.containers.get(uid, {}).get(container)
+        if obj is not None and request.command == 'PUT':
+            if c is None:
+                request.drain()
+                return request.respond(404 if uid in self.containers else 401)
+            return self.put_object(request, self.containers[uid], c, obj)
+        if uid is None or uid not in self.containers:
+            return request.respond(401)
+        containers = self.containers[uid]
+        if container is None:
+            return self.account(request, containers, query)
+        if obj is None:
+            return self.container(request, containers, container, query)
+        if c is None:
+            return request.respond(404)
+        o = c.objects.get(obj)
+        if o is None:
+            return request.respond(404)
+        if request.command == 'DELETE':
+            with self.lock:
+                c.delete(obj)
+            return request.respond(204)
+        if request.command in ('GET', 'HEAD'):
+            return self.get_object(request, containers, o)
+        request.respond(405)
+
+    def account(self, request, containers, query):
+        if request.command not in ('GET', 'HEAD'):
+            return request.respond(405)
+        with self.lock:
+            names = sorted(x for x in containers if x > query.get('marker', '') and
+                           x.startswith(query.get('prefix', '')))[:int(query.get('limit', LISTING_LIMIT))]
+            listing = [dict(name=x, count=len(containers[x].objects), bytes=containers[x].bytes) for x in names]
+            objects = sum(len(x.objects) for x in containers.values())
+            size = sum(x.bytes for x in containers.values())
+        headers = {'X-Account-Container-Count': len(containers), 'X-Account-Object-Count': objects,
+                   'X-Account-Bytes-Used': size}
+        self.listing(request, headers, listing, query)
+
+    def container(self, request, containers, name, query):
+        method = request.command
+        if method == 'PUT':
+            headers = dict((k.lower(), v) for k, v in request.headers.items()
+                           if k.lower() in CONTAINER_HEADERS or k.lower().startswith('x-container-meta-'))
+            with self.lock:
+                if name in containers:
+                    containers[name].headers.update(headers)
+                    return request.respond(202)
+                containers[name] = Container(headers)
+            return request.respond(201)
+        c = containers.get(name)
+        if c is None:
+            return request.respond(404)
+        if method == 'DELETE':
+            if c.objects:
+                return request.respond(409)
+            with self.lock:
+                del containers[name]
+            return request.respond(204)
+        if method not in ('GET', 'HEAD'):
+            return request.respond(405)
+        with self.lock:
+            names = c.listing(query.get('marker', ''), query.get('prefix', ''),
+                              int(query.get('limit', LISTING_LIMIT)))
+            listing = [dict(name=x, hash=c.objects[x].etag, bytes=c.objects[x].size,
+                            content_type=c.objects[x].headers.get('content-type', ''),
+                            last_modified=c.objects[x].last_modified) for x in names]
+            headers = dict(c.headers, **{'X-Container-Object-Count': len(c.objects),
+                                         'X-Container-Bytes-Used': c.bytes})
+        self.listing(request, headers, listing, query)
+
+    def listing(self, request, headers, listing, query):
+        if query.get('format') == 'json':
+            return request.respond_json(200, listing, headers)
+        body = ''.join(x['name'] + '\n' for x in listing).encode('utf-8')
+        request.respond(200 if body else 204, dict(headers, **{'Content-Type': 'text/plain; charset=utf-8'}), body)
+
+    def put_object(self, request, containers, container, name):
+        copy_from = request.header('x-copy-from')
+        if copy_from is not None:
+            request.drain()
+            return self.copy_object(request, containers, container, name, copy_from)
+        md5 = hashlib.md5()
+        kept = []
+        size = 0
+        for chunk in request.iter_body():
+            md5.update(chunk)
+            size += len(chunk)
+            if size <= KEEP_LIMIT:
+                kept.append(chunk)
+        etag = md5.hexdigest()
+        expected = request.header('etag')
+        if expected is not None and expected.strip('"') != etag:
+            return request.respond(422)
+        headers = self.object_headers(request)
+        headers.setdefault('content-type', 'application/octet-stream')
+        with self.lock:
+            container.put(name, Object(size, etag, headers, data=b''.join(kept) if size <= KEEP_LIMIT else None))
+        request.respond(201, {'Etag': etag})
+
+    def copy_object(self, request, containers, container, name, copy_from):
+        src_container, _, src_name = unquote(copy_from).lstrip('/').partition('/')
+        with self.lock:
+            c = containers.get(src_container)
+            src = c.objects.get(src_name) if c else None
+        if src is None:
+            return request.respond(404)
+        parts = self.object_parts(containers, src)
+        size = sum(x.size for x in parts)
+        if size > MAX_COPY_SIZE:
+            return request.respond(413)
+        md5 = hashlib.md5()
+        kept = []
+        try:
+            for chunk in self.iter_parts(parts, 0, size):
+                md5.update(chunk)
+                if size <= KEEP_LIMIT:
+                    kept.append(chunk)
+        except ContentNotRetained:
+            return request.respond(503)
+        etag = md5.hexdigest()
+        headers = dict((k, v) for k, v in src.headers.items() if k != 'x-object-manifest')
+        headers.update(self.object_headers(request))
+        with self.lock:
+            container.put(name, Object(size, etag, headers, data=b''.join(kept) if size <= KEEP_LIMIT else None))
+        request.respond(201, {'Etag': etag})
+
+    @staticmethod
+    def object_headers(request):
+        return dict((k.lower(), v) for k, v in request.headers.items()
+                    if k.lower() in OBJECT_HEADERS or k.lower().startswith('x-object-meta-'))
+
+    def object_parts(self, containers, obj):
+        manifest = obj.headers.get('x-object-manifest')
+        if manifest is None:
+            return [obj]
+        # Dynamic large object: concatenation of the segments listed with the prefix
+        seg_container, prefix = manifest.split('/', 1)
+        c = containers.get(seg_container)
+        with self.lock:
+            return [c.objects[x] for x in c.listing(prefix=prefix, limit=len(c.objects))] if c else []
+
+    def get_object(self, request, containers, obj):
+        parts = self.object_parts(containers, obj)
+        etag = obj.etag
+        size = obj.size
+        if obj.headers.get('x-object-manifest') is not None:
+            size = sum(x.size for x in parts)
+            etag = '"%s"' % hashlib.md5(''.join(x.etag for x in parts).encode('utf-8')).hexdigest()
+        headers = dict(obj.headers, **{'Etag': etag, 'Accept-Ranges': 'bytes',
+                                       'Last-Modified': time.strftime('%a, %d %b %Y %H:%M:%S GMT'),
+                                       'X-Timestamp': '%.5f' % time.time()})
+        start, end, status = 0, size, 200
+        byte_range = request.header('range')
+        if byte_range and byte_range.startswith('bytes=') and size:
+            first, last = byte_range[len('bytes='):].split('-', 1)
+            start = int(first) if first else max(size - int(last), 0)
+            end = min(int(last) + 1, size) if first and last else size
+            if start >= end:
+                return request.respond(416, {'Content-Range': 'bytes */%d' % size})
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, size)
+            status = 206
+        if request.command == 'HEAD':
+            return request.respond(status, headers, content_length=end - start)
+        chunks = self.iter_parts(parts, start, end)
+        try:
+            first = next(chunks, b'')
+        except ContentNotRetained:
+            return request.respond(503)
+        request.respond(status, headers, content_length=end - start)
+        request.wfile.write(first)
+        for chunk in chunks:
+            request.wfile.write(chunk)
+
+    @staticmethod
+    def iter_parts(parts, start, end):
+        offset = 0
+        for part in parts:
+            if offset + part.size > start and offset < end:
+                for chunk in part.chunks(max(start - offset, 0), min(end - offset, part.size)):
+                    yield chunk
+            offset += part.size
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+    Inventory loading benchmark for migration_planner.py
+
+    Loads synthetic inventories, half volumes and half snapshots, from fake
+    cinder managers and compares load_inventory() with the former
+    snapshots-by-volume comprehension, which rescanned all the snapshots for
+    each volume owning some. The load time per object should stay flat as
+    the inventory grows.
+"""
+
+import gc, os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import migration_planner
+from fake_openstack import VOLUME_TYPES, FakeCinder, Resource
+
+SIZES = (12500, 25000, 50000, 100000)
+# The former indexing is quadratic: only time it on small inventories
+LEGACY_MAX_SNAPSHOTS = 10000
+SERVERS = 2000
+
+def make_inventory(count, seed=0):
+    rnd = random.Random(seed)
+    volumes = []
+    for i in range(count // 2):
+        attachments = [dict(server_id='srv-%d' % rnd.randrange(SERVERS))] if rnd.random() < 0.5 else []
+        volumes.append(Resource(id='vol-%d' % i, size=rnd.randint(1, 500),
+                                volume_type=rnd.choice(VOLUME_TYPES), attachments=attachments))
+    snapshots = [Resource(id='snap-%d' % i, volume_id='vol-%d' % rnd.randrange(len(volumes)))
+                 for i in range(count - len(volumes))]
+    return FakeCinder(volumes, snapshots)
+
+def legacy_index(cinder):
+    snapshots = {x.id: x.volume_id
+        for x in cinder.volume_snapshots.list(search_opts=dict(all_tenants=1))}
+    return {
+        x: set([k for k, v in snapshots.items() if v == x])
+            for x in snapshots.values()
+    }
+
+def timed(func, *args):
+    gc.collect()
+    t = time.time()
+    result = func(*args)
+    return result, time.time() - t
+
+def main():
+    print("%10s %12s %14s %10s %12s" % ('objects', 'load (s)', 'us/object', 'API calls', 'legacy (s)'))
+    for count in SIZES:
+        cinder = make_inventory(count)
+        inventory, elapsed = timed(migration_planner.load_inventory, cinder)
+        calls = sum(cinder.calls.values())
+        assert len(inventory.volumes) == len(cinder.volumes.resources)
+        if len(cinder.volume_snapshots.resources) <= LEGACY_MAX_SNAPSHOTS:
+            legacy, legacy_elapsed = timed(legacy_index, cinder)
+            assert legacy == inventory.snapshots_by_volume
+            legacy_elapsed = '%.2f' % legacy_elapsed
+        else:
+            legacy_elapsed = 'skipped'
+        print("%10d %12.2f %14.2f %10d %12s" % (count, elapsed, elapsed * 1e6 / count, calls, legacy_elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,552 @@
+#!/usr/bin/env python
+"""
+    Benchmark suite for rgw-migrate.py, rbd-migrate.py and migration_planner.py
+
+    rgw-migrate.py migrates generated data sets between two in-process fake
+    radosgw clusters, once per engine and mode, then runs a second time with
+    everything up to date. rbd-migrate.py copies generated images between
+    two fake rbd clusters, directly or with a pre-sync followed by changes
+    and a cutover, and the content of both clusters is compared.
+    migration_planner.py plans the migration of generated clouds through
+    fake cinder and nova clients.
+
+    Each result is appended to a JSON lines history and compared with the
+    previous result of the same benchmark on the same host: metrics worse by
+    more than the tolerance are reported as regressions.
+"""
+
+import argparse, hashlib, json, os, platform, random, resource, shutil, signal, subprocess, sys, tempfile, threading, time
+from collections import OrderedDict
+from multiprocessing import Pool
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+import migration_planner
+import fake_openstack, fake_rgw
+
+MB = 1024 * 1024
+# Distinct contents of the generated objects
+PATTERNS = 64
+
+# Data sets: the fields listed in 'scaled' are multiplied by --scale
+RGW_DATASETS = OrderedDict([
+    ('tiny-objects', dict(users=4, containers=4, objects=2500, sizes=(1, 4096), scaled=('objects',),
+                          modes=('pool', 'async', 'pool-head', 'pool-hup'))),
+    ('large-objects', dict(users=1, containers=1, objects=4, sizes=(256 * MB, 256 * MB), scaled=('objects',),
+                           modes=('pool', 'async', 'pool-segments'))),
+    # Segments up to fake_rgw.KEEP_LIMIT are retained, so that they can be concatenated
+    ('medium-objects', dict(users=1, containers=2, objects=16, sizes=(12 * MB, 32 * MB), scaled=('objects',),
+                            modes=('pool', 'pool-concat'))),
+    ('dlo', dict(users=1, containers=2, dlos=16, segments=8, segment_size=8 * MB, scaled=('dlos',),
+                 modes=('pool', 'async'))),
+    ('many-users', dict(users=500, containers=1, objects=10, sizes=(1024, 64 * 1024), scaled=('users',),
+                        modes=('pool', 'async'))),
+])
+RGW_MODES = OrderedDict([
+    ('pool', ['--engine', 'pool']),
+    ('async', ['--engine', 'async']),
+    ('pool-head', ['--engine', 'pool', '--diff', 'head']),
+    ('pool-segments', ['--engine', 'pool', '--segment-threshold', '64M', '--segment-size', '32M']),
+    ('pool-concat', ['--engine', 'pool', '--segment-threshold', '8M', '--segment-size', '4M',
+                     '--segment-mode', 'concat']),
+    # SIGHUP is sent to the whole process group while the objects are migrated
+    ('pool-hup', ['--engine', 'pool', '--throttle-file', 'throttle.json']),
+])
+# Seconds between the SIGHUP sent in the pool-hup mode
+HUP_INTERVAL = 0.2
+# Seconds without progress after which rgw-migrate.py is deemed hung by the SIGHUP
+HUP_STALL_TIMEOUT = 60
+# Images are written with extents of generated data: chains also get snapshots, written in between
+RBD_DATASETS = OrderedDict([
+    ('sparse-images', dict(pool='images', images=16, size=256 * MB, extents=32, extent_size=MB, snapshots=0,
+                           scaled=('images',), modes=('full', 'presync'))),
+    ('backup-chains', dict(pool='backups', images=8, size=64 * MB, extents=8, extent_size=MB, snapshots=4,
+                           scaled=('images',), modes=('full', 'presync'))),
+])
+RBD_MODES = ('full', 'presync')
+PLANNER_DATASETS = OrderedDict([
+    ('many-snapshots', dict(volumes=20000, snapshots_per_volume=10, servers=5000, scaled=('volumes', 'servers'),
+                            modes=('plan', 'offline', 'refresh'))),
+    ('large-cloud', dict(volumes=100000, snapshots_per_volume=1, servers=25000, scaled=('volumes', 'servers'),
+                         modes=('plan', 'offline', 'refresh'))),
+])
+PLANNER_MODES = ('plan', 'offline', 'refresh')
+PLANNER_MAPPINGS = ['hos-legacy=ses-rbd']
+# Metrics compared between runs, and whether higher values are better
+METRICS = OrderedDict([
+    ('objects_per_second', True),
+    ('bytes_per_second', True),
+    ('rerun_elapsed', False),
+    ('planning_time', False),
+    ('peak_rss', False),
+    ('peak_worker_rss', False),
+    ('api_calls', False),
+    ('rerun_api_calls', False),
+])
+
+def human_size(size):
+    prefixes = ' KMGTPEZY'
+    if size < 1024.0:
+        return str(size)
+    for p in prefixes:
+        if size > 1024.0:
+            size /= 1024.0
+        else:
+            return '%.1f%s' % (size, p)
+
+def scaled(spec, scale):
+    return dict(spec, **{k: max(1, int(round(spec[k] * scale))) for k in spec['scaled']})
+
+class RssSampler(threading.Thread):
+    """Peak resident set size of a process and of each of its descendants, read from /proc"""
+
+    def __init__(self, pid, interval=0.2):
+        threading.Thread.__init__(self, name='rss-sampler')
+        self.daemon = True
+        self.pid = pid
+        self.interval = interval
+        self.peaks = {}
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
+    def sample(self):
+        parents = {}
+        for name in os.listdir('/proc'):
+            if not name.isdigit():
+                continue
+            try:
+                with open('/proc/%s/stat' % name) as f:
+                    parents[int(name)] = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (IOError, OSError, IndexError, ValueError):
+                pass
+        tree = set([self.pid])
+        for pid in sorted(parents):
+            # Parents are not always listed before their children
+            ancestors = []
+            p = pid
+            while p in parents and p not in tree and p not in ancestors:
+                ancestors.append(p)
+                p = parents[p]
+            if p in tree:
+                tree.update(ancestors)
+        for pid in tree:
+            try:
+                with open('/proc/%d/status' % pid) as f:
+                    for line in f:
+                        if line.startswith('VmHWM:'):
+                            self.peaks[pid] = max(self.peaks.get(pid, 0), int(line.split()[1]) * 1024)
+            except (IOError, OSError):
+                pass
+
+    def result(self):
+        workers = [v for k, v in self.peaks.items() if k != self.pid]
+        main = self.peaks.get(self.pid)
+        return dict(peak_rss=main, peak_worker_rss=max(workers) if workers else main, workers=len(workers))
+
+def populate(gateway, spec, seed=0):
+    """Load a data set in a fake radosgw cluster"""
+    rnd = random.Random(seed)
+    for u in range(spec['users']):
+        uid = hashlib.md5(('user-%d' % u).encode('utf-8')).hexdigest()
+        gateway.add_user(uid, 'user-%d' % u)
+        for c in range(spec['containers']):
+            name = 'container-%d' % c
+            gateway.add_container(uid, name, {'x-container-meta-benchmark': 'true'})
+            for o in range(spec.get('objects', 0)):
+                gateway.add_object(uid, name, 'object-%06d' % o, rnd.randint(*spec['sizes']), rnd.randrange(PATTERNS))
+            if spec.get('dlos'):
+                gateway.add_container(uid, name + '_segments')
+                for o in range(spec['dlos']):
+                    gateway.add_dlo(uid, name, 'dlo-%04d' % o, name + '_segments',
+                                    [spec['segment_size']] * spec['segments'], rnd.randrange(PATTERNS))
+
+def git_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                           stderr=devnull).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def send_hup(proc, log_file, metrics_file):
+    """
+        Send SIGHUP to the process group of rgw-migrate.py until it exits,
+        once its handler is installed, i.e. once the throttle file is loaded.
+        The whole group is killed if the totals of its metrics file do not
+        change for HUP_STALL_TIMEOUT seconds.
+    """
+    with open(log_file) as log:
+        while proc.poll() is None and not any('Throttles:' in line for line in log):
+            time.sleep(HUP_INTERVAL)
+    totals, progress = None, time.time()
+    while proc.poll() is None:
+        try:
+            with open(metrics_file) as f:
+                current = json.load(f)['totals']
+        except (IOError, OSError, ValueError):
+            current = None
+        if current != totals:
+            totals, progress = current, time.time()
+        elif time.time() - progress > HUP_STALL_TIMEOUT:
+            sys.stderr.write("rgw-migrate.py hung after SIGHUP: killed\n")
+            os.killpg(proc.pid, signal.SIGKILL)
+            break
+        try:
+            os.killpg(proc.pid, signal.SIGHUP)
+        except OSError:
+            break
+        time.sleep(HUP_INTERVAL)
+
+def run_rgw_migrate(src, dst, mode, options, workdir, run):
+    """Run rgw-migrate.py once, return its metrics, peak RSS and the API calls it made"""
+    metrics_file = os.path.join(workdir, 'metrics-%s.json' % run)
+    log_file = os.path.join(workdir, 'rgw-migrate-%s.log' % run)
+    cmd = [sys.executable, os.path.join(REPO_DIR, 'rgw-migrate.py')] + RGW_MODES[mode] + [
+        '--jobs', str(options.jobs), '--concurrency', str(options.concurrency),
+        '--metrics-file', metrics_file, '--dead-letter', os.path.join(workdir, 'failed-%s.jsonl' % run),
+        src.credentials, dst.credentials]
+    src.calls.clear()
+    dst.calls.clear()
+    hup = mode == 'pool-hup'
+    if hup:
+        with open(os.path.join(workdir, 'throttle.json'), 'w') as f:
+            json.dump({}, f)
+    t = time.time()
+    with open(log_file, 'w') as log:
+        proc = subprocess.Popen(cmd, cwd=workdir, stdout=log, stderr=subprocess.STDOUT,
+                                preexec_fn=os.setsid if hup else None)
+        sampler = RssSampler(proc.pid)
+        sampler.start()
+        if hup:
+            send_hup(proc, log_file, metrics_file)
+        proc.wait()
+        sampler.stop()
+    elapsed = time.time() - t
+    try:
+        with open(metrics_file) as f:
+            snap = json.load(f)
+    except (IOError, OSError, ValueError):
+        snap = None
+    if proc.returncode or snap is None:
+        with open(log_file) as f:
+            sys.stderr.write(''.join(f.readlines()[-20:]))
+    return dict(sampler.result(), returncode=proc.returncode, elapsed=elapsed, snapshot=snap,
+                calls=dict(src=dict(src.calls), dst=dict(dst.calls)),
+                api_calls=sum(src.calls.values()) + sum(dst.calls.values()))
+
+def bench_rgw(dataset, spec, mode, options):
+    src = fake_rgw.FakeRadosGW(latency=options.latency / 1000.0).start()
+    dst = fake_rgw.FakeRadosGW(latency=options.latency / 1000.0).start()
+    workdir = tempfile.mkdtemp(prefix='rgw-bench-')
+    try:
+        populate(src, spec)
+        objects, size = src.totals()
+        first = run_rgw_migrate(src, dst, mode, options, workdir, 'first')
+        rerun = run_rgw_migrate(src, dst, mode, options, workdir, 'rerun')
+    finally:
+        src.stop()
+        dst.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    totals = first['snapshot']['totals'] if first['snapshot'] else dict(migrated=0, failed=objects)
+    ok = first['returncode'] == 0 and rerun['returncode'] == 0 and totals['failed'] == 0 and \
+        totals['migrated'] == objects
+    elapsed = first['elapsed']
+    transferred = first['snapshot']['transferred_bytes'] if first['snapshot'] else 0
+    return ok, dict(objects=objects, bytes=size, migrated=totals['migrated'], failed=totals['failed'],
+                    elapsed=elapsed, objects_per_second=totals['migrated'] / elapsed,
+                    bytes_per_second=transferred / elapsed, peak_rss=first['peak_rss'],
+                    peak_worker_rss=first['peak_worker_rss'], workers=first['workers'],
+                    api_calls=first['api_calls'], api_calls_by_operation=first['calls'],
+                    rerun_elapsed=rerun['elapsed'], rerun_api_calls=rerun['api_calls'])
+
+class FakeRbd(object):
+    """Pool of the fake rbd clusters stored under root"""
+
+    def __init__(self, root, pool):
+        self.root = root
+        self.pool = pool
+        self.cmd = [sys.executable, os.path.join(BENCH_DIR, 'fake_rbd.py')]
+
+    def run(self, cluster, *args):
+        env = dict(os.environ, FAKE_RBD_ROOT=self.root)
+        return subprocess.check_output(self.cmd + ['-c', '/etc/ceph/%s.conf' % cluster, '-p', self.pool] +
+                                       list(args), env=env).decode('utf-8')
+
+    def path(self, cluster, image, name='head'):
+        return os.path.join(self.root, cluster, self.pool, image, name)
+
+    def images(self, cluster):
+        return json.loads(self.run(cluster, 'ls', '--format', 'json'))
+
+    def snaps(self, cluster, image):
+        return [x['name'] for x in json.loads(self.run(cluster, 'snap', 'ls', image, '--format', 'json'))]
+
+    def write(self, cluster, image, rnd, spec):
+        """Write extents of generated data at random offsets, return the number of bytes written"""
+        written = 0
+        with open(self.path(cluster, image), 'r+b') as f:
+            for _ in range(spec['extents']):
+                offset = rnd.randrange(0, spec['size'], fake_rgw.BLOCK)
+                length = min(spec['extent_size'], spec['size'] - offset)
+                f.seek(offset)
+                f.write(b''.join(fake_rgw.iter_generated(rnd.randrange(PATTERNS), 0, length)))
+                written += length
+        return written
+
+    def create(self, cluster, image, rnd, spec, prefix='backup'):
+        self.run(cluster, 'create', '--size', str(spec['size'] // MB), image)
+        for i in range(spec['snapshots']):
+            self.write(cluster, image, rnd, spec)
+            self.run(cluster, 'snap', 'create', '%s@%s.%d' % (image, prefix, i))
+        self.write(cluster, image, rnd, spec)
+
+    def digest(self, cluster, image, name='head'):
+        md5 = hashlib.md5()
+        with open(self.path(cluster, image, name), 'rb') as f:
+            for block in iter(lambda: f.read(MB), b''):
+                md5.update(block)
+        return md5.hexdigest()
+
+    def compare(self, src, dst):
+        """Return the differences between the images of both clusters"""
+        problems = []
+        dst_images = self.images(dst)
+        for image in self.images(src):
+            if image not in dst_images:
+                problems.append('%s: missing' % image)
+                continue
+            snaps = self.snaps(src, image)
+            if snaps != self.snaps(dst, image):
+                problems.append('%s: snapshots %s, %s' % (image, snaps, self.snaps(dst, image)))
+            for name in ['head'] + ['snap.' + x for x in snaps if x in self.snaps(dst, image)]:
+                if self.digest(src, image, name) != self.digest(dst, image, name):
+                    problems.append('%s: %s differs' % (image, name))
+        return problems
+
+def run_rbd_migrate(rbd, options, workdir, run, presync=False):
+    """Run rbd-migrate.py once, return its exit status, elapsed time and peak RSS"""
+    cmd = [sys.executable, os.path.join(REPO_DIR, 'rbd-migrate.py'), '--rbd-cmd', ' '.join(rbd.cmd),
+           '--jobs', str(options.jobs)] + (['--presync'] if presync else []) + [rbd.pool, 'ceph', 'ses']
+    log_file = os.path.join(workdir, 'rbd-migrate-%s.log' % run)
+    t = time.time()
+    with open(log_file, 'w') as log:
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=dict(os.environ, FAKE_RBD_ROOT=rbd.root))
+        sampler = RssSampler(proc.pid)
+        sampler.start()
+        proc.wait()
+        sampler.stop()
+    elapsed = time.time() - t
+    if proc.returncode:
+        with open(log_file) as f:
+            sys.stderr.write(''.join(f.readlines()[-20:]))
+    return dict(sampler.result(), returncode=proc.returncode, elapsed=elapsed)
+
+def bench_rbd(dataset, spec, mode, options):
+    """
+        Copy the images of a data set, then either run the migration again
+        with everything up to date or, in presync mode, pre-sync the images,
+        change them, recreate one of them and run the cutover
+    """
+    rnd = random.Random(0)
+    workdir = tempfile.mkdtemp(prefix='rbd-bench-')
+    rbd = FakeRbd(os.path.join(workdir, 'clusters'), spec['pool'])
+    try:
+        images = ['image-%04d' % i for i in range(spec['images'])]
+        for image in images:
+            rbd.create('ceph', image, rnd, spec)
+        allocated = sum(os.stat(rbd.path('ceph', x)).st_blocks * 512 for x in images)
+        first = run_rbd_migrate(rbd, options, workdir, 'first', presync=mode == 'presync')
+        changed = 0
+        if mode == 'presync':
+            for image in images:
+                if spec['snapshots']:
+                    rbd.run('ceph', 'snap', 'create', '%s@backup.%d' % (image, spec['snapshots']))
+                changed += rbd.write('ceph', image, rnd, spec)
+            # Deleted and created again under the same name since the pre-sync
+            rbd.run('ceph', 'snap', 'purge', images[0])
+            rbd.run('ceph', 'rm', images[0])
+            rbd.create('ceph', images[0], rnd, spec, prefix='recreated')
+        rerun = run_rbd_migrate(rbd, options, workdir, 'rerun')
+        problems = rbd.compare('ceph', 'ses')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    for problem in problems:
+        sys.stderr.write('%s %s: %s\n' % (dataset, mode, problem))
+    ok = first['returncode'] == 0 and rerun['returncode'] == 0 and not problems
+    elapsed = first['elapsed']
+    return ok, dict(images=len(images), bytes=allocated, changed_bytes=changed, elapsed=elapsed,
+                    bytes_per_second=allocated / elapsed, rerun_elapsed=rerun['elapsed'],
+                    peak_rss=max(first['peak_rss'] or 0, rerun['peak_rss'] or 0), mismatches=len(problems))
+
+def run_planner(args):
+    sys.argv = ['migration_planner.py'] + args
+    try:
+        migration_planner.main()
+    except SystemExit as e:
+        if e.code:
+            raise RuntimeError('migration_planner.py exited with status %s' % e.code)
+
+def planner_job(args):
+    """Plan a migration in a fresh worker process, so that its peak RSS is its own"""
+    spec, mode = args
+    cinder, nova = fake_openstack.make_cloud(spec['volumes'], spec['snapshots_per_volume'], spec['servers'])
+    migration_planner.make_clients = lambda: (cinder, nova)
+    workdir = tempfile.mkdtemp(prefix='planner-bench-')
+    path = os.path.join(workdir, 'inventory.json.gz')
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        if mode != 'plan':
+            run_planner(['--save-inventory=' + path] + PLANNER_MAPPINGS)
+            cinder.calls.clear()
+        args = dict(plan=[], offline=['--load-inventory=' + path],
+                    refresh=['--load-inventory=' + path, '--refresh'])[mode]
+        t = time.time()
+        run_planner(args + PLANNER_MAPPINGS)
+        elapsed = time.time() - t
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        shutil.rmtree(workdir, ignore_errors=True)
+    return dict(volumes=len(cinder.volumes.resources), snapshots=len(cinder.volume_snapshots.resources),
+                servers=len(nova.servers.resources), planning_time=elapsed,
+                peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                api_calls=sum(cinder.calls.values()), api_calls_by_operation=dict(cinder.calls))
+
+def bench_planner(dataset, spec, mode, options):
+    pool = Pool(1)
+    try:
+        return True, pool.apply(planner_job, ((spec, mode),))
+    except Exception as e:
+        return False, dict(error='%s: %s' % (type(e).__name__, e))
+    finally:
+        pool.close()
+        pool.join()
+
+def load_history(path):
+    history = []
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    history.append(json.loads(line))
+                except ValueError:
+                    pass
+    return history
+
+def benchmark_key(entry):
+    return tuple(entry.get(k) for k in ('suite', 'dataset', 'mode', 'scale', 'host', 'python'))
+
+def compare(previous, current, tolerance):
+    """Yield (metric, previous value, current value, change, regression) for the metrics of both results"""
+    for metric, higher_is_better in METRICS.items():
+        before = previous['metrics'].get(metric)
+        after = current['metrics'].get(metric)
+        if not before or after is None:
+            continue
+        change = (after - before) / float(before)
+        yield metric, before, after, change, change < -tolerance if higher_is_better else change > tolerance
+
+def format_result(entry):
+    m = entry['metrics']
+    if 'error' in m:
+        return m['error']
+    if entry['suite'] == 'rbd':
+        return ("%d images (%sB) in %.1fs: %sB/s, %s %.1fs (%sB changed), %d mismatches" %
+                (m['images'], human_size(m['bytes']), m['elapsed'], human_size(int(m['bytes_per_second'])),
+                 'cutover' if entry['mode'] == 'presync' else 'rerun', m['rerun_elapsed'],
+                 human_size(m['changed_bytes']), m['mismatches']))
+    if entry['suite'] == 'rgw':
+        return ("%d objects (%sB) in %.1fs: %.1f objects/s, %sB/s, rerun %.1fs, peak RSS %sB (%sB/worker), "
+                "%d API calls" % (m['migrated'], human_size(m['bytes']), m['elapsed'], m['objects_per_second'],
+                                  human_size(int(m['bytes_per_second'])), m['rerun_elapsed'],
+                                  human_size(m['peak_rss'] or 0), human_size(m['peak_worker_rss'] or 0),
+                                  m['api_calls']))
+    return ("%d volumes, %d snapshots, %d servers planned in %.2fs, peak RSS %sB, %d API calls" %
+            (m['volumes'], m['snapshots'], m['servers'], m['planning_time'], human_size(m['peak_rss']),
+             m['api_calls']))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--suite', choices=('rgw', 'rbd', 'planner'), action='append',
+                        help='benchmarks to run, repeat for several (default: all)')
+    parser.add_argument('--dataset', action='append', metavar='NAME', help='data set to run, repeat for several '
+                        '(default: all), see --list')
+    parser.add_argument('--mode', action='append', metavar='NAME', help='engine or mode to run, repeat for several '
+                        '(default: the ones of each data set), see --list')
+    parser.add_argument('--scale', type=float, default=1.0, help='scale factor of the data sets (default=1)')
+    parser.add_argument('--jobs', type=int, default=8, help='rgw-migrate.py and rbd-migrate.py --jobs (default=8)')
+    parser.add_argument('--concurrency', type=int, default=64, help='rgw-migrate.py --concurrency (default=64)')
+    parser.add_argument('--latency', type=float, default=0, metavar='MS',
+                        help='delay added to each request of the fake radosgw clusters (default=0)')
+    parser.add_argument('--results', default=os.path.join(BENCH_DIR, 'results.jsonl'), metavar='PATH',
+                        help='history of the results (default=benchmarks/results.jsonl)')
+    parser.add_argument('--no-save', action='store_true', help='do not append the results to the history')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative change of a metric reported as a regression (default=0.1)')
+    parser.add_argument('--check', action='store_true', help='exit with status 1 when a regression is found')
+    parser.add_argument('--list', action='store_true', help='list the data sets and modes')
+    options = parser.parse_args()
+
+    suites = OrderedDict([('rgw', (RGW_DATASETS, RGW_MODES, bench_rgw)),
+                          ('rbd', (RBD_DATASETS, RBD_MODES, bench_rbd)),
+                          ('planner', (PLANNER_DATASETS, PLANNER_MODES, bench_planner))])
+    if options.list:
+        for suite, (datasets, modes, _) in suites.items():
+            print("%s modes: %s" % (suite, ', '.join(modes)))
+            for name, spec in datasets.items():
+                print("  %s: %s (default modes: %s)" % (name, ', '.join(
+                    '%s=%s' % (k, v) for k, v in sorted(spec.items()) if k not in ('modes', 'scaled')),
+                    ', '.join(spec['modes'])))
+        return
+
+    history = load_history(options.results)
+    previous = {}
+    for entry in history:
+        if entry.get('ok', True):
+            previous[benchmark_key(entry)] = entry
+    common = dict(scale=options.scale, host=platform.node(), python='%d.%d' % sys.version_info[:2],
+                  commit=git_commit())
+    regressions = failures = 0
+    for suite, (datasets, modes, bench) in suites.items():
+        if options.suite and suite not in options.suite:
+            continue
+        for dataset, spec in datasets.items():
+            if options.dataset and dataset not in options.dataset:
+                continue
+            for mode in [x for x in (options.mode or spec['modes']) if x in modes]:
+                if mode == 'async' and sys.version_info < (3, 6):
+                    print("%s %s %s: skipped, the async engine requires Python 3.6 or later" % (suite, dataset, mode))
+                    continue
+                ok, metrics = bench(dataset, scaled(spec, options.scale), mode, options)
+                entry = dict(common, suite=suite, dataset=dataset, mode=mode, ok=ok,
+                             timestamp=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), metrics=metrics)
+                print("%s %s %s: %s%s" % (suite, dataset, mode, format_result(entry), '' if ok else ' FAILED'))
+                failures += not ok
+                before = previous.get(benchmark_key(entry))
+                if ok and before is not None:
+                    for metric, old, new, change, regression in compare(before, entry, options.tolerance):
+                        if regression or abs(change) > options.tolerance:
+                            print("    %s: %.6g -> %.6g (%+.1f%%)%s" % (metric, old, new, change * 100,
+                                                                       ' REGRESSION' if regression else ''))
+                            regressions += regression
+                if not options.no_save:
+                    with open(options.results, 'a') as f:
+                        f.write(json.dumps(entry, sort_keys=True) + '\n')
+    if regressions:
+        print("%d regressions since the previous results in %s" % (regressions, options.results))
+    if failures:
+        print("%d benchmarks FAILED" % failures)
+    if failures or (regressions and options.check):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
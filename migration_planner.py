@@ -1,11 +1,36 @@
 #!/usr/bin/env python
 
-import os, sys
-from pprint import pprint
-from keystoneauth1 import loading, session
-from cinderclient import client as c_client
-from novaclient import client as n_client
+import gzip, heapq, json, os, subprocess, sys, time
+from collections import defaultdict, deque, namedtuple
+from multiprocessing.pool import ThreadPool
 
+NO_ROLLING_FLAG = '--no-rolling'
+EXECUTE_FLAG = '--execute'
+# Concurrency limits of the --execute mode and their options
+DEFAULT_LIMITS = dict(source=4, dest=4, host=2)
+LIMIT_FLAGS = {'--source-limit': 'source', '--dest-limit': 'dest', '--host-limit': 'host'}
+THROUGHPUT_FLAG = '--throughput'
+SAVE_FLAG = '--save-inventory'
+LOAD_FLAG = '--load-inventory'
+REFRESH_FLAG = '--refresh'
+INVENTORY_VERSION = 1
+# Expected throughput of a single retype, in MB/s
+DEFAULT_THROUGHPUT = 100
+# Time taken to stop, detach, reattach and start an instance, in seconds
+INSTANCE_OVERHEAD = 120
+PAGE_SIZE = 1000
+SERVER_THREADS = 10
+POLL_INTERVAL = 10
+# Time after which a retype never seen in progress is considered rejected, in seconds
+RETYPE_START_TIMEOUT = 300
+# Time allowed to stop or start an instance, or to detach or attach one of its volumes, in seconds
+INSTANCE_STEP_TIMEOUT = 900
+# Above this many volumes to poll, list all the volumes instead of getting each one
+POLL_LIST_THRESHOLD = 200
+REPORT_INTERVAL = 60
+
+volume = namedtuple('volume', ['id', 'size', 'volume_type', 'servers', 'host'])
+server = namedtuple('server', ['id', 'name', 'status', 'image', 'volumes', 'host'])
 
 def info(msg):
     print("# "+msg)
@@ -26,13 +51,17 @@ def retype_volume(volid, newtype):
     print("cinder retype --migration-policy on-demand %s %s" % (volid, newtype))
     info("Monitor migration process using: openstack volume show %s | grep migration_status" % volid)
 
-def patch_volume_boot_index(vol, enable):
+def boot_index_query(vol, enable):
     if enable:
-        warn("patching boot volume info for volume %s" % vol)
         query = "update block_device_mapping set boot_index=999 where deleted=0 and volume_id='%s' and boot_index=0"
     else:
         query = "update block_device_mapping set boot_index=0 where deleted=0 and volume_id='%s' and boot_index is NULL"
-    print("echo \""+(query % vol)+"\" | sudo mysql nova")
+    return query % vol
+
+def patch_volume_boot_index(vol, enable):
+    if enable:
+        warn("patching boot volume info for volume %s" % vol)
+    print("echo \""+boot_index_query(vol, enable)+"\" | sudo mysql nova")
 
 def instance_power(srv, power):
     pcmd = 'start' if power else 'stop'
@@ -41,127 +70,807 @@ def instance_power(srv, power):
     print("openstack server %s %s" % (pcmd, srv))
 
 
-loader = loading.get_plugin_loader('password')
-auth = loader.load_from_options(
-    auth_url             = os.getenv('OS_AUTH_URL'),
-    username             = os.getenv('OS_USERNAME'),
-    user_domain_name     = os.getenv('OS_USER_DOMAIN_NAME'),
-    user_id              = os.getenv('OS_USER_ID'),
-    project_name         = os.getenv('OS_PROJECT_NAME'),
-    project_domain_name  = os.getenv('OS_PROJECT_DOMAIN_NAME'),
-    project_id           = os.getenv('OS_PROJECT_ID'),
-    password             = os.getenv('OS_PASSWORD'),
-)
-
-sess = session.Session(auth=auth, verify=os.getenv('OS_CACERT', True))
-cinder = c_client.Client(os.getenv('OS_VOLUME_API_VERSION', '2'),
-                         session=sess,
-                         endpoint_type=os.getenv('OS_ENDPOINT_TYPE', 'public'))
-nova = n_client.Client(os.getenv('OS_COMPUTE_API_VERSION', '2'),
-                       session=sess,
-                       endpoint_type=os.getenv('OS_ENDPOINT_TYPE', 'public'))
+def human_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 3600:
+        return '%dm%02ds' % (seconds // 60, seconds % 60)
+    return '%dh%02dm' % (seconds // 3600, seconds % 3600 // 60)
 
-NO_ROLLING_FLAG = '--no-rolling'
+def retype_time(size, throughput):
+    """Estimated duration of the retype of a volume of size GB"""
+    return size * 1024.0 / throughput
+
+def instance_time(srv, inventory, backlog, throughput):
+    """Estimated downtime of an instance, retyping its volumes one after the other"""
+    return INSTANCE_OVERHEAD + sum(retype_time(inventory.volumes[v].size, throughput)
+                                   for v in srv.volumes if v in backlog)
+
+def parallel_retypes(vols, voltype_map, limits):
+    """Number of retypes which can run at once within the per backend limits"""
+    sources = set(volume_backend(v) for v in vols)
+    dests = set(voltype_map[v.volume_type] for v in vols)
+    return max(1, min(limits['source'] * len(sources), limits['dest'] * len(dests)))
+
+def pack(tasks, slots):
+    """
+        Longest processing time first scheduling of (key, duration) tasks on
+        parallel slots, a heap of the time at which each slot is free. Return
+        (key, start, end) tuples in start order, which minimizes the makespan
+        within 4/3 of the optimum.
+    """
+    plan = []
+    for key, duration in sorted(tasks, key=lambda x: -x[1]):
+        start = heapq.heappop(slots)
+        heapq.heappush(slots, start + duration)
+        plan.append((key, start, start + duration))
+    return plan
+
+def make_clients():
+    from keystoneauth1 import loading, session
+    from cinderclient import client as c_client
+    from novaclient import client as n_client
+
+    loader = loading.get_plugin_loader('password')
+    auth = loader.load_from_options(
+        auth_url             = os.getenv('OS_AUTH_URL'),
+        username             = os.getenv('OS_USERNAME'),
+        user_domain_name     = os.getenv('OS_USER_DOMAIN_NAME'),
+        user_id              = os.getenv('OS_USER_ID'),
+        project_name         = os.getenv('OS_PROJECT_NAME'),
+        project_domain_name  = os.getenv('OS_PROJECT_DOMAIN_NAME'),
+        project_id           = os.getenv('OS_PROJECT_ID'),
+        password             = os.getenv('OS_PASSWORD'),
+    )
+
+    sess = session.Session(auth=auth, verify=os.getenv('OS_CACERT', True))
+    cinder = c_client.Client(os.getenv('OS_VOLUME_API_VERSION', '2'),
+                             session=sess,
+                             endpoint_type=os.getenv('OS_ENDPOINT_TYPE', 'public'))
+    nova = n_client.Client(os.getenv('OS_COMPUTE_API_VERSION', '2'),
+                           session=sess,
+                           endpoint_type=os.getenv('OS_ENDPOINT_TYPE', 'public'))
+    return cinder, nova
+
+def iter_resources(manager, page_size=PAGE_SIZE, detailed=True, **filters):
+    """
+        Yield the resources of all tenants listed by a cinder or nova manager,
+        one page of page_size resources at a time, using marker/limit
+        pagination
+    """
+    marker = None
+    kwargs = {} if detailed else dict(detailed=False)
+    while True:
+        page = manager.list(search_opts=dict(filters, all_tenants=1), marker=marker, limit=page_size, **kwargs)
+        if not page:
+            return
+        for x in page:
+            yield x
+        marker = page[-1].id
+
+class Inventory(object):
+    """
+        Volumes and snapshots of the cloud, indexed as they are loaded:
+        snapshots by volume, volumes by type and attached volumes by server.
+        Details of the servers with volumes to migrate are cached in servers.
+    """
+
+    def __init__(self):
+        # When the inventory was taken, and the volume types of the cloud
+        self.taken = None
+        self.volume_types = []
+        self.volumes = {}
+        self.servers = {}
+        self.snapshots_by_volume = defaultdict(set)
+        self.volumes_by_type = defaultdict(list)
+        self.volumes_by_server = defaultdict(list)
+
+    def add_snapshot(self, snapid, volid):
+        self.snapshots_by_volume[volid].add(snapid)
+
+    def add_volume(self, vol):
+        self.volumes[vol.id] = vol
+        self.volumes_by_type[vol.volume_type].append(vol)
+        for srv in vol.servers:
+            self.volumes_by_server[srv].append(vol.id)
+
+    def add_server(self, srv):
+        self.servers[srv.id] = srv
+
+def utc_now():
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+def make_volume(v):
+    return volume(v.id, v.size, v.volume_type, [x['server_id'] for x in v.attachments],
+                  getattr(v, 'os-vol-host-attr:host', None))
 
-if len(sys.argv) < 2:
-    print("Syntax: %s [%s] <fromtype>=<totype>..." % (sys.argv[0], NO_ROLLING_FLAG))
-    sys.exit(0)
+def load_inventory(cinder, page_size=PAGE_SIZE):
+    """Stream snapshots and volumes from cinder into an Inventory in a single pass"""
+    inventory = Inventory()
+    inventory.taken = utc_now()
+    for x in iter_resources(cinder.volume_snapshots, page_size):
+        inventory.add_snapshot(x.id, x.volume_id)
+    for v in iter_resources(cinder.volumes, page_size):
+        inventory.add_volume(make_volume(v))
+    return inventory
 
-no_rolling_migration = False
-restart_instances = []
+def save_inventory(inventory, path):
+    """Write the inventory to a gzipped JSON snapshot, records stored as lists"""
+    data = dict(version=INVENTORY_VERSION, taken=inventory.taken, volume_types=inventory.volume_types,
+                volumes=list(inventory.volumes.values()), servers=list(inventory.servers.values()),
+                snapshots=[(snapid, volid) for volid, snapids in inventory.snapshots_by_volume.items()
+                           for snapid in snapids])
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wb') as f:
+        f.write(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+    os.rename(tmp_path, path)
 
-available_volume_types = set([t.name for t in cinder.volume_types.list()])
+def read_inventory(path):
+    with gzip.open(path, 'rb') as f:
+        data = json.loads(f.read().decode('utf-8'))
+    if data.get('version') != INVENTORY_VERSION:
+        raise ValueError("unsupported inventory version in %s: %s" % (path, data.get('version')))
+    inventory = Inventory()
+    inventory.taken = data['taken']
+    inventory.volume_types = data['volume_types']
+    for snapid, volid in data['snapshots']:
+        inventory.add_snapshot(snapid, volid)
+    for x in data['volumes']:
+        inventory.add_volume(volume(*x))
+    for x in data['servers']:
+        inventory.add_server(server(*x))
+    return inventory
 
-voltype_map = {}
-for arg in sys.argv[1:]:
-    if arg == NO_ROLLING_FLAG:
-        no_rolling_migration = True
-    elif '=' in arg:
-        vtfrom, vtto = (x.strip() for x in arg.split('=', 1))
+def cinder_filters_updated_at(cinder):
+    """Whether cinder can list the volumes updated since a given time (API 3.60)"""
+    version = getattr(cinder, 'api_version', None)
+    return version is not None and (version.ver_major, version.ver_minor) >= (3, 60)
+
+def refresh_inventory(cinder, nova, old, page_size=PAGE_SIZE):
+    """
+        Bring an inventory snapshot up to date. Only the servers, and with
+        cinder API 3.60 or later the volumes, updated since the snapshot was
+        taken are fetched. Volumes are otherwise listed again, as are the
+        snapshots, which cannot be filtered. Deleted volumes are found with a
+        summary listing.
+    """
+    inventory = Inventory()
+    inventory.taken = utc_now()
+    if cinder_filters_updated_at(cinder):
+        alive = set(x.id for x in iter_resources(cinder.volumes, page_size, detailed=False))
+        volumes = {k: v for k, v in old.volumes.items() if k in alive}
+        for v in iter_resources(cinder.volumes, page_size, updated_at='gt:' + old.taken.rstrip('Z')):
+            volumes[v.id] = make_volume(v)
+    else:
+        volumes = {v.id: make_volume(v) for v in iter_resources(cinder.volumes, page_size)}
+    servers = dict(old.servers)
+    for s in iter_resources(nova.servers, page_size, **{'changes-since': old.taken}):
+        if s.status == 'DELETED':
+            servers.pop(s.id, None)
+        else:
+            servers[s.id] = make_server(s)
+    for x in iter_resources(cinder.volume_snapshots, page_size):
+        inventory.add_snapshot(x.id, x.volume_id)
+    for v in volumes.values():
+        inventory.add_volume(v)
+    for srvid, volids in inventory.volumes_by_server.items():
+        srv = servers.get(srvid)
+        # Attaching a volume does not update the server: look it up again
+        if srv is not None and set(srv.volumes) == set(volids):
+            inventory.add_server(srv)
+    return inventory
+
+def make_server(s):
+    return server(s.id, s.name, s.status, s.image['id'] if s.image else None,
+                  [x['id'] for x in s.to_dict().get('os-extended-volumes:volumes_attached', [])],
+                  getattr(s, 'OS-EXT-SRV-ATTR:host', None))
+
+def get_server(args):
+    nova, srvid = args
+    try:
+        return srvid, make_server(nova.servers.get(srvid))
+    except Exception as e:
+        return srvid, e
+
+def load_servers(nova, inventory, srvs, page_size=PAGE_SIZE, threads=SERVER_THREADS):
+    """
+        Cache the details of the servers srvs in inventory. Servers are
+        prefetched from the detailed listing of all tenants, the ones missing
+        from the listing are then looked up individually by a pool of threads.
+    """
+    wanted = set(srvs) - set(inventory.servers)
+    if not wanted:
+        return
+    for s in iter_resources(nova.servers, page_size):
+        if s.id in wanted:
+            inventory.add_server(make_server(s))
+            wanted.discard(s.id)
+            if not wanted:
+                return
+    pool = ThreadPool(min(threads, len(wanted)))
+    try:
+        for srvid, result in pool.imap_unordered(get_server, [(nova, x) for x in wanted]):
+            if isinstance(result, Exception):
+                warn("unable to get instance %s: %s" % (srvid, result))
+            else:
+                inventory.add_server(result)
+    finally:
+        pool.close()
+
+def is_not_found(e):
+    return getattr(e, 'code', None) == 404 or getattr(e, 'http_status', None) == 404
+
+def get_resource(args):
+    manager, resid = args
+    try:
+        return resid, manager.get(resid)
+    except Exception as e:
+        if is_not_found(e):
+            return resid, None
+        warn("unable to get %s: %s" % (resid, e))
+        return resid, e
+
+def fetch_resources(manager, ids, threads=SERVER_THREADS):
+    """
+        Return the current state of the resources ids, mapped to None when
+        they do not exist anymore. Large sets are read from a full listing
+        rather than one request per resource. Resources which could not be
+        read are left out.
+    """
+    if not ids:
+        return {}
+    if len(ids) > POLL_LIST_THRESHOLD:
+        found = {x.id: x for x in iter_resources(manager) if x.id in ids}
+        return {x: found.get(x) for x in ids}
+    pool = ThreadPool(min(threads, len(ids)))
+    try:
+        return {x: r for x, r in pool.imap_unordered(get_resource, [(manager, x) for x in ids])
+                if not isinstance(r, Exception)}
+    finally:
+        pool.close()
+
+def is_deleted(resources, resid):
+    """Whether a resource polled with fetch_resources() does not exist anymore"""
+    return resid in resources and resources[resid] is None
+
+def volume_backend(vol):
+    """Backend of a volume, from its host@backend#pool, defaulting to its type"""
+    return vol.host.split('#')[0] if vol.host else vol.volume_type
+
+def run_mysql(query):
+    proc = subprocess.Popen(['sudo', 'mysql', 'nova'], stdin=subprocess.PIPE)
+    proc.communicate(query.encode('utf-8'))
+    if proc.returncode:
+        raise RuntimeError("mysql exited with status %d" % proc.returncode)
+
+class Executor(object):
+    """
+        Run a migration plan through the cinder and nova APIs.
+
+        Retypes run in concurrent waves: a queued retype is started as soon as
+        its source and destination backends have a free slot, and an instance
+        as soon as its compute host has one. Retypes of attached volumes go
+        first since their instances are down. Each instance moves on to
+        reattaching and powering on as soon as its own volumes are retyped.
+        Everything being waited on is polled together once per POLL_INTERVAL.
+    """
+
+    def __init__(self, cinder, nova, inventory, voltype_map, dst_backends, limits, no_rolling_migration,
+                 throughput=DEFAULT_THROUGHPUT, estimate=None):
+        self.cinder = cinder
+        self.nova = nova
+        self.inventory = inventory
+        self.voltype_map = voltype_map
+        self.dst_backends = dst_backends
+        self.limits = limits
+        self.no_rolling_migration = no_rolling_migration
+        self.slots = defaultdict(int)
+        # Retypes waiting for a slot, and retypes in progress with their owner job
+        self.queue = deque()
+        self.retyping = {}
+        self.owners = {}
+        # Instances waiting for a slot on their host, and instances in progress
+        self.waiting = deque()
+        self.jobs = []
+        self.restart_instances = []
+        self.failed = []
+        self.total_size = self.done_size = 0
+        self.done_count = 0
+        self.throughput = throughput
+        # Estimated completion time, until retypes can be measured
+        self.estimate = estimate
+        self.retype_started = {}
+        # Retypes seen in progress, which are over when the volume is back to rest
+        self.retype_busy = set()
+        self.measured = []
+        self.started = time.time()
+
+    def volume_slots(self, vol):
+        return [('source', volume_backend(vol)),
+                ('dest', self.dst_backends.get(self.voltype_map[vol.volume_type]))]
+
+    def acquire(self, slots):
+        if any(self.slots[s] >= self.limits[s[0]] for s in slots):
+            return False
+        for s in slots:
+            self.slots[s] += 1
+        return True
+
+    def release(self, slots):
+        for s in slots:
+            self.slots[s] -= 1
+
+    def fail(self, what, msg):
+        warn("%s FAILED: %s" % (what, msg))
+        self.failed.append(what)
+
+    def add_volume(self, vol, job=None):
+        self.owners[vol.id] = job
+        if job is None:
+            self.queue.append(vol.id)
+        else:
+            self.queue.appendleft(vol.id)
+
+    def add_server(self, srv):
+        job = dict(server=srv, state='waiting', entered=time.time(), pending=set(), failed=False, index=0)
+        job['running'] = srv.status == 'ACTIVE'
+        job['workaround'] = not srv.image and srv.volumes[0] in self.backlog
+        self.waiting.append(job)
+
+    def remove_snapshots(self, snapids):
+        """Delete snapshots and wait until all of them are gone"""
+        pending = set()
+        for snapid in snapids:
+            info("Removing snapshot %s" % snapid)
+            try:
+                self.cinder.volume_snapshots.delete(snapid)
+                pending.add(snapid)
+            except Exception as e:
+                if not is_not_found(e):
+                    self.fail("Removal of snapshot %s" % snapid, e)
+        while pending:
+            time.sleep(POLL_INTERVAL)
+            for snapid, snap in fetch_resources(self.cinder.volume_snapshots, pending).items():
+                if snap is None:
+                    pending.discard(snapid)
+                elif snap.status.startswith('error'):
+                    self.fail("Removal of snapshot %s" % snapid, snap.status)
+                    pending.discard(snapid)
+
+    def start_retypes(self):
+        for volid in list(self.queue):
+            vol = self.inventory.volumes[volid]
+            slots = self.volume_slots(vol)
+            if not self.acquire(slots):
+                continue
+            self.queue.remove(volid)
+            newtype = self.voltype_map[vol.volume_type]
+            info("Retyping volume %s (%dGB) to %s" % (volid, vol.size, newtype))
+            try:
+                self.cinder.volumes.retype(volid, newtype, 'on-demand')
+            except Exception as e:
+                self.release(slots)
+                self.retype_done(volid, e)
+                continue
+            self.retyping[volid] = slots
+            self.retype_started[volid] = time.time()
+
+    def retype_done(self, volid, error=None):
+        vol = self.inventory.volumes[volid]
+        elapsed = time.time() - self.retype_started.pop(volid, time.time())
+        self.retype_busy.discard(volid)
+        if error is None:
+            self.done_count += 1
+            self.done_size += vol.size
+            if vol.size and elapsed > 0:
+                self.measured.append(vol.size * 1024.0 / elapsed)
+            info("Volume %s retyped in %s" % (volid, human_duration(elapsed)))
+        else:
+            self.fail("Retype of volume %s" % volid, error)
+        job = self.owners.pop(volid)
+        if job is not None:
+            job['pending'].discard(volid)
+            job['failed'] |= error is not None
+
+    def check_retypes(self, volumes):
+        for volid, slots in list(self.retyping.items()):
+            if volid not in volumes:
+                continue
+            v = volumes[volid]
+            newtype = self.voltype_map[self.inventory.volumes[volid].volume_type]
+            migration_status = getattr(v, 'migration_status', None)
+            at_rest = v is not None and v.status in ('available', 'in-use') and \
+                migration_status in (None, 'success')
+            if v is None:
+                error = 'volume not found'
+            elif v.status.startswith('error') or migration_status == 'error':
+                error = 'status %s, migration status %s' % (v.status, migration_status)
+            elif at_rest and v.volume_type == newtype:
+                error = None
+            elif at_rest and (volid in self.retype_busy or
+                              time.time() - self.retype_started.get(volid, 0) > RETYPE_START_TIMEOUT):
+                # cinder gives up on retypes it cannot schedule, e.g. without a
+                # valid host, by restoring the previous status of the volume
+                error = 'retype not performed, volume back to %s with type %s' % (v.status, v.volume_type)
+            else:
+                if not at_rest:
+                    self.retype_busy.add(volid)
+                continue
+            del self.retyping[volid]
+            self.release(slots)
+            self.retype_done(volid, error)
+
+    def start_servers(self):
+        for job in list(self.waiting):
+            srv = job['server']
+            if not self.acquire([('host', srv.host)]):
+                continue
+            self.waiting.remove(job)
+            self.jobs.append(job)
+            info("Migrating volumes attached to instance %s (%s)" % (srv.id, srv.name))
+            self.step(job, None, None)
+
+    def enter(self, job, state):
+        job['state'] = state
+        job['entered'] = time.time()
+
+    def check_timeout(self, job):
+        """Fail an instance stuck in its current state"""
+        if time.time() - job['entered'] > INSTANCE_STEP_TIMEOUT:
+            raise RuntimeError("still %s after %s" % (job['state'], human_duration(INSTANCE_STEP_TIMEOUT)))
+
+    def finish(self, job, failed=False):
+        srv = job['server']
+        job['state'] = 'done'
+        self.jobs.remove(job)
+        self.release([('host', srv.host)])
+        if failed or job['failed']:
+            self.fail("Migration of instance %s" % srv.id, "volumes may need to be checked manually")
+        else:
+            info("Instance %s done" % srv.id)
+
+    def step(self, job, volumes, servers):
+        """Advance the migration of an instance, given the polled volumes and servers"""
+        srv = job['server']
+        state = job['state']
+        try:
+            if state == 'waiting':
+                if job['running']:
+                    warn("instance %s is running: shutting down" % srv.id)
+                    self.nova.servers.stop(srv.id)
+                    self.enter(job, 'stopping')
+                    return
+                state = 'stopped'
+            elif state == 'stopping':
+                if is_deleted(servers, srv.id):
+                    raise RuntimeError("instance deleted while stopping")
+                s = servers.get(srv.id)
+                if s is None or s.status != 'SHUTOFF':
+                    self.check_timeout(job)
+                    return
+                state = 'stopped'
+            if state == 'stopped':
+                if self.no_rolling_migration and job['running']:
+                    self.restart_instances.append(srv.id)
+                if job['workaround']:
+                    # This instance boots from a volume hosted on a legacy
+                    # volume type: apply workaround
+                    warn("patching boot volume info for volume %s" % srv.volumes[0])
+                    run_mysql(boot_index_query(srv.volumes[0], True))
+                for v in srv.volumes:
+                    self.nova.volumes.delete_server_volume(srv.id, v)
+                self.enter(job, 'detaching')
+                return
+            if state == 'detaching':
+                deleted = [v for v in srv.volumes if is_deleted(volumes, v)]
+                if deleted:
+                    raise RuntimeError("volumes deleted while detaching: %s" % ', '.join(deleted))
+                status = [getattr(volumes.get(v), 'status', None) for v in srv.volumes]
+                if any(x is not None and x.startswith('error') for x in status):
+                    raise RuntimeError("detaching volumes: %s" % status)
+                if any(x != 'available' for x in status):
+                    self.check_timeout(job)
+                    return
+                for v in srv.volumes:
+                    if v in self.backlog:
+                        job['pending'].add(v)
+                        self.add_volume(self.inventory.volumes[v], job)
+                state = 'retyping'
+                self.enter(job, state)
+            if state == 'retyping':
+                if job['pending']:
+                    return
+                state = 'attaching'
+                self.enter(job, state)
+                job['index'] = -1
+            if state == 'attaching':
+                # Volumes are attached one at a time to keep the attachment order
+                if job['index'] >= 0:
+                    volid = srv.volumes[job['index']]
+                    if is_deleted(volumes, volid):
+                        raise RuntimeError("volume %s deleted while attaching" % volid)
+                    x = getattr(volumes.get(volid), 'status', None)
+                    if x is not None and x.startswith('error'):
+                        raise RuntimeError("attaching volume %s: %s" % (volid, x))
+                    if x != 'in-use':
+                        self.check_timeout(job)
+                        return
+                job['index'] += 1
+                if job['index'] < len(srv.volumes):
+                    self.nova.volumes.create_server_volume(srv.id, srv.volumes[job['index']])
+                    # Each volume gets the full timeout to be attached
+                    self.enter(job, state)
+                    return
+                if job['workaround']:
+                    # Undo workaround
+                    run_mysql(boot_index_query(srv.volumes[0], False))
+                if job['running'] and not self.no_rolling_migration:
+                    self.nova.servers.start(srv.id)
+                    self.enter(job, 'starting')
+                    return
+                self.finish(job)
+            elif state == 'starting':
+                if is_deleted(servers, srv.id):
+                    raise RuntimeError("instance deleted while starting")
+                s = servers.get(srv.id)
+                if s is not None and s.status == 'ACTIVE':
+                    self.finish(job)
+                else:
+                    self.check_timeout(job)
+        except Exception as e:
+            warn("instance %s: %s" % (srv.id, e))
+            self.finish(job, failed=True)
+
+    def watched(self):
+        volumes = set(self.retyping)
+        servers = set()
+        for job in self.jobs:
+            if job['state'] in ('detaching', 'attaching'):
+                volumes.update(job['server'].volumes)
+            elif job['state'] in ('stopping', 'starting'):
+                servers.add(job['server'].id)
+        return volumes, servers
+
+    def report(self):
+        elapsed = time.time() - self.started
+        rate = self.done_size / elapsed if elapsed else 0
+        if rate:
+            eta = human_duration((self.total_size - self.done_size) / rate)
+        elif self.estimate is not None:
+            eta = human_duration(max(self.estimate - elapsed, 0)) + ' (estimated)'
+        else:
+            eta = 'unknown'
+        throughput = sum(self.measured) / len(self.measured) if self.measured else self.throughput
+        info("Progress: %d volumes (%d/%dGB) retyped, %d retyping, %d queued, %d instances in progress, "
+             "%d waiting, %dMB/s per retype, ETA %s" % (self.done_count, self.done_size, self.total_size,
+                                                      len(self.retyping), len(self.queue), len(self.jobs),
+                                                      len(self.waiting), throughput, eta))
+
+    def run(self, snapids, detached, servers, backlog):
+        """
+            Remove the snapshots, retype the detached volumes and migrate the
+            volumes in backlog attached to servers. Return the instances to
+            power on once nova is configured for the new backend.
+        """
+        self.backlog = backlog
+        self.remove_snapshots(snapids)
+        for vol in detached:
+            self.total_size += vol.size
+            self.add_volume(vol)
+        for srv in servers:
+            if srv.status not in ('ACTIVE', 'SHUTOFF'):
+                warn("Instance %s is in an invalid state (%s): skipping" % (srv.id, srv.status))
+                continue
+            self.total_size += sum(self.inventory.volumes[v].size for v in srv.volumes if v in backlog)
+            self.add_server(srv)
+        last_report = time.time()
+        while self.queue or self.retyping or self.jobs or self.waiting:
+            self.start_servers()
+            self.start_retypes()
+            time.sleep(POLL_INTERVAL)
+            volids, srvids = self.watched()
+            volumes = fetch_resources(self.cinder.volumes, volids)
+            servers = fetch_resources(self.nova.servers, srvids)
+            self.check_retypes(volumes)
+            for job in list(self.jobs):
+                self.step(job, volumes, servers)
+            if time.time() - last_report > REPORT_INTERVAL:
+                self.report()
+                last_report = time.time()
+        return self.restart_instances
+
+def main():
+    if len(sys.argv) < 2:
+        print("Syntax: %s [%s] [%s] [--source-limit=N] [--dest-limit=N] [--host-limit=N] [%s=MBPS] "
+              "[%s=PATH] [%s=PATH [%s]] <fromtype>=<totype>..." %
+              (sys.argv[0], NO_ROLLING_FLAG, EXECUTE_FLAG, THROUGHPUT_FLAG, SAVE_FLAG, LOAD_FLAG, REFRESH_FLAG))
+        sys.exit(0)
+
+    no_rolling_migration = False
+    execute = False
+    limits = dict(DEFAULT_LIMITS)
+    throughput = DEFAULT_THROUGHPUT
+    save_path = load_path = None
+    refresh = False
+    restart_instances = []
+
+    mappings = []
+    for arg in sys.argv[1:]:
+        if arg == NO_ROLLING_FLAG:
+            no_rolling_migration = True
+        elif arg == EXECUTE_FLAG:
+            execute = True
+        elif arg == REFRESH_FLAG:
+            refresh = True
+        elif arg.startswith(SAVE_FLAG + '='):
+            save_path = arg.split('=', 1)[1]
+        elif arg.startswith(LOAD_FLAG + '='):
+            load_path = arg.split('=', 1)[1]
+        elif arg.split('=', 1)[0] in LIMIT_FLAGS:
+            flag, value = arg.split('=', 1)
+            if not value.isdigit() or int(value) < 1:
+                print("Invalid value for %s: %s" % (flag, value))
+                sys.exit(1)
+            limits[LIMIT_FLAGS[flag]] = int(value)
+        elif arg.startswith(THROUGHPUT_FLAG + '='):
+            value = arg.split('=', 1)[1]
+            if not value.isdigit() or int(value) < 1:
+                print("Invalid value for %s: %s" % (THROUGHPUT_FLAG, value))
+                sys.exit(1)
+            throughput = int(value)
+        elif '=' in arg:
+            mappings.append(tuple(x.strip() for x in arg.split('=', 1)))
+
+    if refresh and not load_path:
+        print("%s requires %s" % (REFRESH_FLAG, LOAD_FLAG))
+        sys.exit(1)
+    if execute and load_path and not refresh:
+        print("%s cannot run from an inventory snapshot without %s" % (EXECUTE_FLAG, REFRESH_FLAG))
+        sys.exit(1)
+
+    if load_path and not refresh:
+        # Plan offline, without any API call
+        cinder = nova = None
+        inventory = read_inventory(load_path)
+        info("Using inventory taken at %s from %s" % (inventory.taken, load_path))
+    else:
+        cinder, nova = make_clients()
+        if load_path:
+            inventory = refresh_inventory(cinder, nova, read_inventory(load_path))
+        else:
+            inventory = load_inventory(cinder)
+        inventory.volume_types = [t.name for t in cinder.volume_types.list()]
+    if save_path:
+        if nova is not None:
+            # Keep every server with volumes, whatever the volume types to migrate
+            load_servers(nova, inventory, list(inventory.volumes_by_server))
+        save_inventory(inventory, save_path)
+        info("Inventory saved to %s" % save_path)
+
+    available_volume_types = set(inventory.volume_types)
+
+    voltype_map = {}
+    for vtfrom, vtto in mappings:
         for t in (vtfrom, vtto):
             if t not in available_volume_types:
                 warn("unknown volume type: %s" % t)
                 continue
         voltype_map[vtfrom] = vtto
 
-backlog = {}
-srvs_with_volumes = set()
-
-info("Migration plan for the following volume types:")
-for f, t in sorted(voltype_map.items()):
-    info("%s -> %s" % (f.rjust(15), t))
-
-snapshots = {x.id: x.volume_id
-    for x in cinder.volume_snapshots.list(search_opts=dict(all_tenants=1))}
-vols_with_snapshots = {
-    x: set([k for k, v in snapshots.items() if v == x])
-        for x in snapshots.values()
-}
-
-vol_count = vol_total_size = 0
-
-# First migrate all detached volumes
-info("Migrating detached volumes")
-for v in cinder.volumes.list(search_opts=dict(all_tenants=1)):
-    if v.volume_type in voltype_map:
-        if v.id in vols_with_snapshots:
-            warn("volume %s has snapshot(s): removing" % v.id)
-            for snapid in vols_with_snapshots[v.id]:
-                remove_snapshot(snapid)
-        srvs = [x['server_id'] for x in v.attachments]
-        if len(srvs) > 1:
-            # This should not happen since multi-attach is not supported yet
-            warn("Volume %s is attached to multiple instances: ignoring" % v.id)
-        else:
-            vol_count += 1
-            vol_total_size += v.size
-            if srvs:
-                srvs_with_volumes.add(srvs[0])
-                backlog[v.id] = v.volume_type
+    backlog = {}
+    srvs_with_volumes = set()
+
+    info("Migration plan for the following volume types:")
+    for f, t in sorted(voltype_map.items()):
+        info("%s -> %s" % (f.rjust(15), t))
+
+    vol_count = vol_total_size = 0
+    snapshots = []
+    detached = []
+
+    # First migrate all detached volumes
+    info("Migrating detached volumes")
+    for vtfrom in sorted(voltype_map):
+        for v in inventory.volumes_by_type.get(vtfrom, ()):
+            if v.id in inventory.snapshots_by_volume:
+                warn("volume %s has snapshot(s): removing" % v.id)
+                for snapid in inventory.snapshots_by_volume[v.id]:
+                    if execute:
+                        snapshots.append(snapid)
+                    else:
+                        remove_snapshot(snapid)
+            srvs = v.servers
+            if len(srvs) > 1:
+                # This should not happen since multi-attach is not supported yet
+                warn("Volume %s is attached to multiple instances: ignoring" % v.id)
             else:
-                retype_volume(v.id, voltype_map[v.volume_type])
-
-# Then, for each idle server, detach all volumes, migrate if needed and re-attach
-info("Migrating attached volumes")
-for srv in srvs_with_volumes:
-    s = nova.servers.get(srv)
-    info("Migrating volumes attached to instance %s (%s)" % (srv, s.name))
-    if s.status not in ('ACTIVE', 'SHUTOFF'):
-        warn("Instance %s is in an invalid state (%s): skipping" % (srv, s.status))
-        continue
-    srv_running = s.status == 'ACTIVE'
-    if srv_running:
-        instance_power(srv, False)
-        if no_rolling_migration:
-            restart_instances.append(srv)
-    vols = [x['id'] for x in s.to_dict().get('os-extended-volumes:volumes_attached')]
-    workaround_required = not s.image and vols[0] in backlog
-    if workaround_required:
-        # This instance boots from a volume hosted on a legacy volume type:
-        # apply workaround
-        patch_volume_boot_index(vols[0], True)
-    for v in vols:
-        detach_volume(srv, v)
-    for v in vols:
-        if v in backlog:
-            # We only want to retype if the volume has one of the legacy
-            # volume types but we still want to detach and reattach the
-            # volume to keep the right attachment order
-            retype_volume(v, voltype_map[backlog[v]])
-    for v in vols:
-        attach_volume(srv, v)
-    if workaround_required:
-        # Undo workaround
-        patch_volume_boot_index(vols[0], False)
-    if srv_running and not no_rolling_migration:
-        instance_power(srv, True)
-
-# In case we are not doing a rolling migration, power back on the instances
-# at the end of the migration
-if restart_instances:
-    info("Before proceding, make sure nova is correctly configured to connect to the new backend")
-    for srv in restart_instances:
-            instance_power(srv, True)
-    
-info("Migration completed: %d volumes, %dGB data, %d instances" %
-     (vol_count, vol_total_size, len(srvs_with_volumes)))
+                vol_count += 1
+                vol_total_size += v.size
+                if srvs:
+                    srvs_with_volumes.add(srvs[0])
+                    backlog[v.id] = v.volume_type
+                else:
+                    detached.append(v)
+                    if not execute:
+                        retype_volume(v.id, voltype_map[v.volume_type])
+
+    # Then, for each idle server, detach all volumes, migrate if needed and re-attach
+    info("Migrating attached volumes")
+    if nova is not None:
+        load_servers(nova, inventory, srvs_with_volumes)
+    # Instances go longest first across the parallel retypes, then the
+    # detached volumes fill the slots left
+    slots = [0.0] * parallel_retypes(detached + [inventory.volumes[v] for v in backlog], voltype_map, limits)
+    schedule = pack([(x, instance_time(inventory.servers[x], inventory, backlog, throughput))
+                     for x in srvs_with_volumes if x in inventory.servers and
+                     inventory.servers[x].status in ('ACTIVE', 'SHUTOFF')], slots)
+    pack([(v.id, retype_time(v.size, throughput)) for v in detached], slots)
+    completion = max(slots)
+    scheduled = [x for x, _, _ in schedule]
+    srvs_with_volumes = scheduled + list(srvs_with_volumes - set(scheduled))
+    for srv, start, end in schedule:
+        s = inventory.servers[srv]
+        info("Instance %s (%s): estimated %s %s, from +%s to +%s" %
+             (srv, s.name, 'downtime' if s.status == 'ACTIVE' else 'duration',
+              human_duration(end - start), human_duration(start), human_duration(end)))
+    info("Estimated completion time: %s, %d retypes in parallel at %dMB/s each" %
+         (human_duration(completion), len(slots), throughput))
+    if execute:
+        dst_backends = {t.name: t.get_keys().get('volume_backend_name', t.name)
+                        for t in cinder.volume_types.list() if t.name in voltype_map.values()}
+        executor = Executor(cinder, nova, inventory, voltype_map, dst_backends, limits, no_rolling_migration,
+                            throughput, completion)
+        restart_instances = executor.run(snapshots, sorted(detached, key=lambda v: -v.size),
+                                         [inventory.servers[x] for x in srvs_with_volumes if x in inventory.servers],
+                                         backlog)
+    else:
+        for srv in srvs_with_volumes:
+            s = inventory.servers.get(srv)
+            if s is None:
+                warn("Instance %s not found: skipping" % srv)
+                continue
+            info("Migrating volumes attached to instance %s (%s)" % (srv, s.name))
+            if s.status not in ('ACTIVE', 'SHUTOFF'):
+                warn("Instance %s is in an invalid state (%s): skipping" % (srv, s.status))
+                continue
+            srv_running = s.status == 'ACTIVE'
+            if srv_running:
+                instance_power(srv, False)
+                if no_rolling_migration:
+                    restart_instances.append(srv)
+            vols = s.volumes
+            workaround_required = not s.image and vols[0] in backlog
+            if workaround_required:
+                # This instance boots from a volume hosted on a legacy volume type:
+                # apply workaround
+                patch_volume_boot_index(vols[0], True)
+            for v in vols:
+                detach_volume(srv, v)
+            for v in vols:
+                if v in backlog:
+                    # We only want to retype if the volume has one of the legacy
+                    # volume types but we still want to detach and reattach the
+                    # volume to keep the right attachment order
+                    retype_volume(v, voltype_map[backlog[v]])
+            for v in vols:
+                attach_volume(srv, v)
+            if workaround_required:
+                # Undo workaround
+                patch_volume_boot_index(vols[0], False)
+            if srv_running and not no_rolling_migration:
+                instance_power(srv, True)
+
+    # In case we are not doing a rolling migration, power back on the instances
+    # at the end of the migration
+    if restart_instances:
+        info("Before proceding, make sure nova is correctly configured to connect to the new backend")
+        for srv in restart_instances:
+                instance_power(srv, True)
+
+    info("Migration completed: %d volumes, %dGB data, %d instances" %
+         (vol_count, vol_total_size, len(srvs_with_volumes)))
+    if execute and executor.failed:
+        warn("%d operations FAILED: %s" % (len(executor.failed), ', '.join(executor.failed)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
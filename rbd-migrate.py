@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""
+    Migrate the rbd images of the glance images or cinder backups pool
+    between two Ceph clusters.
+
+    Images are copied in parallel with `rbd export-diff | rbd import-diff`,
+    which only sends the allocated extents of each image. The snapshots of
+    each image are copied one by one so that incremental backup chains are
+    kept, and only the snapshots missing in the destination cluster are sent.
+    Images marked as complete in the destination cluster are skipped, so an
+    interrupted migration can be run again.
+
+    With --presync, images without snapshots get a source snapshot and are
+    copied while the services are still running. The migration run during
+    the outage then only sends the changes made since.
+"""
+
+import argparse, json, logging, shlex, subprocess, sys, time
+from multiprocessing.pool import ThreadPool
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)-15s %(name)-14s %(levelname)-9s %(message)s')
+logger = logging.getLogger('rbd-migrate')
+
+# cephx user of each pool, suffixed with the cluster name for clusters other than 'ceph'
+POOL_USERS = {'images': 'cinder', 'backups': 'cinder-backup'}
+CREATE_OPTIONS = ['--image-format', '2', '--stripe-unit', '8388608', '--stripe-count', '1',
+                  '--order', '23', '--image-features', '3']
+# Image metadata set on destination images once they are completely copied
+COMPLETE_KEY = 'migration.complete'
+# Image metadata set on destination images copied by a pre-sync
+PRESYNC_KEY = 'migration.presync'
+# Source snapshot taken by a pre-sync on images without snapshots
+PRESYNC_SNAP = 'migration.presync'
+
+def human_size(size):
+    prefixes = ' KMGTPEZY'
+    if size < 1024.0:
+        return str(size)
+    for p in prefixes:
+        if size > 1024.0:
+            size /= 1024.0
+        else:
+            return '%.1f%s' % (size, p)
+
+class Rbd(object):
+    """rbd command line for a pool of a cluster"""
+
+    def __init__(self, cmd, cluster, pool):
+        user = POOL_USERS[pool] if cluster == 'ceph' else '%s-%s' % (POOL_USERS[pool], cluster)
+        self.cluster = cluster
+        self.base = shlex.split(cmd) + ['-c', '/etc/ceph/%s.conf' % cluster, '--id', user, '-p', pool]
+
+    def args(self, *args):
+        return self.base + list(args)
+
+    def run(self, *args):
+        return subprocess.check_output(self.args(*args)).decode('utf-8')
+
+    def json(self, *args):
+        return json.loads(self.run(*(args + ('--format', 'json'))) or 'null')
+
+    def ls(self):
+        return self.json('ls') or []
+
+    def size(self, image):
+        return self.json('info', image)['size']
+
+    def snaps(self, image):
+        """Snapshot names of an image, oldest first"""
+        return [x['name'] for x in sorted(self.json('snap', 'ls', image) or [], key=lambda x: x['id'])]
+
+    def allocated(self, spec, from_snap=None):
+        """Number of bytes allocated in an image or snapshot, or changed since from_snap"""
+        args = ('diff', spec) + (('--from-snap', from_snap) if from_snap else ())
+        return sum(x['length'] for x in self.json(*args) or [])
+
+    def has_meta(self, image, key):
+        with open('/dev/null', 'w') as devnull:
+            try:
+                subprocess.check_call(self.args('image-meta', 'get', image, key), stdout=devnull, stderr=devnull)
+                return True
+            except subprocess.CalledProcessError:
+                return False
+
+    def is_complete(self, image):
+        return self.has_meta(image, COMPLETE_KEY)
+
+    def remove(self, image):
+        self.run('snap', 'purge', image)
+        self.run('rm', image)
+
+def copy_diff(src, dst, export_args, image):
+    """Pipe `rbd export-diff` from the source cluster into `rbd import-diff`"""
+    export = subprocess.Popen(src.args('export-diff', *(export_args + ['-'])), stdout=subprocess.PIPE)
+    try:
+        imp = subprocess.Popen(dst.args('import-diff', '-', image), stdin=export.stdout)
+    finally:
+        export.stdout.close()
+    # Reap both processes whichever fails
+    imp.wait()
+    export.wait()
+    if imp.returncode or export.returncode:
+        raise RuntimeError("export-diff exited with status %s, import-diff with status %s" %
+                           (export.returncode, imp.returncode))
+
+def copy_delta(src, dst, image, spec, from_snap):
+    """Copy the changes of a source image or snapshot since from_snap, return the number of bytes sent"""
+    allocated = src.allocated(spec, from_snap)
+    copy_diff(src, dst, (['--from-snap', from_snap] if from_snap else []) + [spec], image)
+    return allocated
+
+def migrate_image(args):
+    """
+        Copy an image and return an (image, size, allocated, elapsed, error)
+        tuple, elapsed being None for images which were already complete
+    """
+    src, dst, image, snap, presync, dst_images = args
+    t = time.time()
+    try:
+        exists = presynced = image in dst_images
+        if exists:
+            if dst.is_complete(image):
+                logger.info("Image %s already migrated: skipping", image)
+                return image, 0, 0, None, None
+            presynced = dst.has_meta(image, PRESYNC_KEY)
+            if not presynced:
+                logger.info("Removing incomplete image %s", image)
+                dst.remove(image)
+                exists = False
+        dst_snaps = dst.snaps(image) if presynced else []
+        src_snaps = src.snaps(image)
+        if presync and not src_snaps:
+            src.run('snap', 'create', '%s@%s' % (image, PRESYNC_SNAP))
+            src_snaps = [PRESYNC_SNAP]
+        size = src.size(image)
+        # Resume from the most recent snapshot already copied
+        common = [s for s in src_snaps if s in dst_snaps]
+        if presynced and not common:
+            # The source image was recreated since it was pre-synced: a full diff
+            # would keep the old data in the extents it does not allocate
+            logger.info("Removing pre-synced image %s without snapshot in common with cluster %s",
+                        image, src.cluster)
+            dst.remove(image)
+            exists = presynced = False
+            dst_snaps = []
+        base = common[-1] if common else None
+        missing = src_snaps[src_snaps.index(base) + 1:] if base else src_snaps
+        logger.info("%s image %s (%sB, %d snapshots to copy%s)", 'Pre-syncing' if presync else 'Migrating',
+                    image, human_size(size), len(missing), ', from snapshot %s' % base if base else '')
+        if not exists:
+            # import-diff resizes the image to the size recorded in the diff
+            dst.run('create', '--size', '1', *(CREATE_OPTIONS + [image]))
+        allocated = 0
+        for s in missing:
+            allocated += copy_delta(src, dst, image, '%s@%s' % (image, s), base)
+            base = s
+        for s in dst_snaps:
+            if s not in src_snaps:
+                dst.run('snap', 'rm', '%s@%s' % (image, s))
+        if presync:
+            dst.run('image-meta', 'set', image, PRESYNC_KEY, base)
+        else:
+            allocated += copy_delta(src, dst, image, image, base)
+            if PRESYNC_SNAP in src_snaps:
+                dst.run('snap', 'rm', '%s@%s' % (image, PRESYNC_SNAP))
+                src.run('snap', 'rm', '%s@%s' % (image, PRESYNC_SNAP))
+            if snap and snap not in src_snaps:
+                dst.run('snap', 'create', '%s@%s' % (image, snap))
+            dst.run('image-meta', 'set', image, COMPLETE_KEY, str(size))
+            if presynced:
+                dst.run('image-meta', 'remove', image, PRESYNC_KEY)
+        elapsed = time.time() - t
+        logger.info("Image %s %s in %ds: %sB sent, %sB/s", image, 'pre-synced' if presync else 'migrated', elapsed,
+                    human_size(allocated), human_size(int(allocated / max(elapsed, 0.001))))
+        return image, size, allocated, elapsed, None
+    except Exception as e:
+        logger.exception("Migration of image %s FAILED!", image)
+        return image, 0, 0, time.time() - t, '%s: %s' % (type(e).__name__, e)
+
+def migrate_pool(src, dst, snap, presync, jobs):
+    """Migrate all the images of a pool, return the list of images which failed"""
+    t = time.time()
+    images = src.ls()
+    dst_images = set(dst.ls())
+    if not presync:
+        # Images deleted from the source cluster since they were pre-synced
+        for image in sorted(dst_images.difference(images)):
+            if dst.has_meta(image, PRESYNC_KEY) and not dst.is_complete(image):
+                logger.info("Removing pre-synced image %s deleted from cluster %s", image, src.cluster)
+                dst.remove(image)
+    pool = ThreadPool(jobs)
+    failed = []
+    migrated = skipped = 0
+    transferred = 0
+    try:
+        for image, size, allocated, elapsed, error in pool.imap_unordered(
+                migrate_image, [(src, dst, image, snap, presync, dst_images) for image in images]):
+            if error is not None:
+                failed.append(image)
+            elif elapsed is None:
+                skipped += 1
+            else:
+                migrated += 1
+                transferred += allocated
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - t
+    logger.info("%s %d images (%sB) in %ds: %sB/s, %d already migrated, %d failures",
+                'Pre-synced' if presync else 'Migrated', migrated,
+                human_size(transferred), elapsed, human_size(int(transferred / max(elapsed, 0.001))),
+                skipped, len(failed))
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('pool', choices=sorted(POOL_USERS), help='pool to migrate')
+    parser.add_argument('from_cluster', help='source cluster name, e.g. ceph')
+    parser.add_argument('to_cluster', help='destination cluster name, e.g. ses')
+    parser.add_argument('--jobs', '-j', type=int, default=4, help='number of images copied in parallel (default=4)')
+    parser.add_argument('--snap', default=None, metavar='NAME',
+                        help='snapshot created on each image once copied (default: none)')
+    parser.add_argument('--presync', action='store_true',
+                        help='copy the images while the services are running, the final migration '
+                             'then only sends the changes made since')
+    parser.add_argument('--rbd-cmd', default='rbd', metavar='CMD', help='rbd command (default=rbd)')
+    args = parser.parse_args()
+    if args.from_cluster == args.to_cluster:
+        return
+    src = Rbd(args.rbd_cmd, args.from_cluster, args.pool)
+    dst = Rbd(args.rbd_cmd, args.to_cluster, args.pool)
+    failed = migrate_pool(src, dst, args.snap, args.presync, max(args.jobs, 1))
+    if failed:
+        logger.error("Images which could not be migrated: %s", ' '.join(sorted(failed)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
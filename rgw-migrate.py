@@ -1,12 +1,29 @@
 #!/usr/bin/env python
 
-import json, logging, os, re, sys, time, traceback
-from collections import namedtuple
-from multiprocessing import Pool
+import hashlib, hmac, json, logging, os, random, re, signal, sqlite3, sys, threading, time, types
+from collections import OrderedDict, deque, namedtuple
+from multiprocessing import Array, Pool
+from multiprocessing.pool import ThreadPool
 import click
 import radosgw
 import swiftclient
-from swiftclient.service import SwiftService, SwiftError
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+try:
+    from urllib.parse import quote, unquote, urlparse, urlunparse
+except ImportError:
+    from urllib import quote, unquote
+    from urlparse import urlparse, urlunparse
+try:
+    from http.client import HTTPConnection, HTTPException
+except ImportError:
+    from httplib import HTTPConnection, HTTPException
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 
 ### BEGIN Workaround radosgw client API bug
 class Stats(object):
@@ -160,201 +177,1029 @@ for mute in ('swiftclient', 'boto', 'requests'):
     logging.getLogger(mute).setLevel(logging.CRITICAL)
 
 OS_UID_RE = re.compile('^[0-9a-fA-F]{32}$')
+SIZE_RE = re.compile('^([0-9]+)([kKmMgGtT]?)$')
+# ETags which are the MD5 digest of the content, unlike the ones of S3 multipart uploads
+MD5_RE = re.compile('^[0-9a-fA-F]{32}$')
 
-s3_account = namedtuple('s3_account', ['host', 'port', 'access_key', 'secret_key'])
-swift_account = namedtuple('swift_account', ['host', 'port', 'user', 'key'])
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+DEFAULT_SEGMENT_SIZE = 1024 * 1024 * 1024
+HEAD_THREADS = 10
+REPORT_INTERVAL = 30
+THROTTLE_CHECK_INTERVAL = 5
+METRICS_INTERVAL = 10
+RETRY_BACKOFF = 1
+RETRY_BACKOFF_MAX = 60
+ENDPOINT_WAIT = 0.05
+ENDPOINT_DOWN_TIME = 30
+HEALTH_CHECK_INTERVAL = 10
+HEALTH_CHECK_TIMEOUT = 5
+SEGMENT_MODES = ('dlo', 'concat')
+# Largest object radosgw creates with a server side copy (rgw_max_put_size)
+MAX_COPY_SIZE = 5 * 1024 * 1024 * 1024
+DIFF_MODES = ('listing', 'head')
+ENGINES = ('pool', 'async')
+SHARD_KEYS = ('user', 'container')
+VERIFY_MODES = ('listing', 'sample', 'full')
+VERIFY_BATCH = 100
 
-def decode_s3_account(account):
-    host, port, access, secret = account.split(':')
-    return s3_account(host, int(port), access, secret)
+s3_account = namedtuple('s3_account', ['endpoints', 'access_key', 'secret_key', 'cluster'])
+swift_account = namedtuple('swift_account', ['user', 'key', 'cluster'])
+segment = namedtuple('segment', ['container', 'name', 'offset', 'length'])
+
+def decode_endpoints(value):
+    endpoints = []
+    for endpoint in value.split(','):
+        host, port = endpoint.strip().rsplit(':', 1)
+        endpoints.append((host, int(port)))
+    return tuple(endpoints)
+
+def decode_s3_account(account, cluster):
+    endpoints, access, secret = account.rsplit(':', 2)
+    return s3_account(decode_endpoints(endpoints), access, secret, cluster)
+
+def decode_size(value):
+    m = SIZE_RE.match(value.strip())
+    if m is None:
+        raise ValueError("invalid size: %s" % value)
+    return int(m.group(1)) * 1024 ** ' KMGT'.index((m.group(2) or ' ').upper())
+
+class ShardType(click.ParamType):
+    name = 'shard'
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, tuple):
+            return value
+        m = re.match('^([0-9]+)/([0-9]+)$', value.strip())
+        if m is None or not 1 <= int(m.group(1)) <= int(m.group(2)):
+            self.fail("invalid shard: %s (expected I/N with 1 <= I <= N)" % value, param, ctx)
+        return int(m.group(1)), int(m.group(2))
+
+def in_shard(shard, *keys):
+    """Deterministically assign keys to one of the shards, the same on every host"""
+    if shard is None:
+        return True
+    digest = hashlib.md5('/'.join(keys).encode('utf-8')).hexdigest()
+    return int(digest, 16) % shard[1] == shard[0] - 1
+
+class SizeType(click.ParamType):
+    name = 'size'
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, int):
+            return value
+        try:
+            return decode_size(value)
+        except ValueError as e:
+            self.fail(str(e), param, ctx)
+
+class AdminConnection(object):
+    """
+        radosgw admin API connection to one endpoint of a cluster, failing
+        over to another endpoint when its endpoint is down or does not respond
+    """
+
+    def __init__(self, account):
+        self.account = account
+        self.gateways = _gateways[account.cluster]
+        self.connect()
+
+    def connect(self):
+        self.endpoint = self.gateways.pick()
+        host, port = self.endpoint
+        self.conn = radosgw.connection.RadosGWAdminConnection(
+            access_key=self.account.access_key,
+            secret_key=self.account.secret_key,
+            host=host, port=port,
+            aws_signature='AWS2',
+            is_secure=False
+        )
+
+    def __getattr__(self, name):
+        if not callable(getattr(self.conn, name)):
+            return getattr(self.conn, name)
+        def request(*args, **kwargs):
+            for attempt in range(len(self.gateways.endpoints)):
+                if not self.gateways.is_up(self.endpoint):
+                    self.connect()
+                try:
+                    result = getattr(self.conn, name)(*args, **kwargs)
+                    # Iterators, like get_users(), send their requests while consumed
+                    return list(result) if isinstance(result, types.GeneratorType) else result
+                except Exception as e:
+                    # Errors with a response come from radosgw, not from the endpoint
+                    if getattr(e, 'status', None):
+                        raise
+                    self.gateways.mark_down(self.endpoint)
+                    if attempt == len(self.gateways.endpoints) - 1:
+                        raise
+                    logger.warn("radosgw admin request to %s:%d failed (%s): failing over", self.endpoint[0],
+                                self.endpoint[1], e)
+                    self.connect()
+        return request
 
 def make_admin_connection(account):
-    return radosgw.connection.RadosGWAdminConnection(
-        access_key=account.access_key,
-        secret_key=account.secret_key,
-        host=account.host, port=account.port,
-        aws_signature='AWS2',
-        is_secure=False
-    )
-
-def make_swift_connection(account):
-    return swiftclient.Connection(authurl='http://{}:{}/auth'.format(account.host, account.port),
+    return AdminConnection(account)
+
+class Gateways(object):
+    """
+        radosgw endpoints of a cluster, shared by all the processes of the
+        migration. Requests go to the healthy endpoint with the fewest
+        transfers in flight, with at most limit transfers per endpoint (0
+        means no limit). Endpoints which fail are skipped until they pass a
+        health check, or for ENDPOINT_DOWN_TIME seconds.
+    """
+
+    def __init__(self, endpoints, limit=0):
+        self.endpoints = list(endpoints)
+        self.limit = limit
+        self.in_flight = Array('i', len(self.endpoints))
+        # time until which each endpoint is considered down
+        self.down_until = Array('d', len(self.endpoints))
+
+    def _choose(self):
+        now = time.time()
+        indexes = range(len(self.endpoints))
+        # When every endpoint is down, keep trying them rather than stalling
+        up = [i for i in indexes if self.down_until[i] <= now] or indexes
+        return min(up, key=lambda i: (self.in_flight[i], random.random()))
+
+    def pick(self):
+        """Endpoint for requests which are not accounted, e.g. listings"""
+        return self.endpoints[self._choose()]
+
+    def try_acquire(self):
+        """Reserve a transfer slot and return the index of its endpoint, or None"""
+        with self.in_flight.get_lock():
+            i = self._choose()
+            if self.limit and self.in_flight[i] >= self.limit:
+                return None
+            self.in_flight[i] += 1
+            return i
+
+    def acquire(self):
+        while True:
+            i = self.try_acquire()
+            if i is not None:
+                return i
+            time.sleep(ENDPOINT_WAIT)
+
+    def release(self, i):
+        with self.in_flight.get_lock():
+            self.in_flight[i] -= 1
+
+    def is_up(self, endpoint):
+        return self.down_until[self.endpoints.index(endpoint)] <= time.time()
+
+    def mark_down(self, endpoint):
+        i = self.endpoints.index(endpoint)
+        if self.down_until[i] <= time.time():
+            logger.warn("radosgw endpoint %s:%d is down", *endpoint)
+        self.down_until[i] = time.time() + ENDPOINT_DOWN_TIME
+
+    def mark_up(self, endpoint):
+        i = self.endpoints.index(endpoint)
+        if self.down_until[i] > time.time():
+            logger.info("radosgw endpoint %s:%d is up", *endpoint)
+        self.down_until[i] = 0
+
+# Endpoints of each cluster ('src' and 'dst'), inherited by the workers
+_gateways = {}
+
+def check_endpoint(endpoint):
+    """Any response but a server error means the radosgw daemon is serving requests"""
+    conn = HTTPConnection(endpoint[0], endpoint[1], timeout=HEALTH_CHECK_TIMEOUT)
+    try:
+        conn.request('GET', '/')
+        return conn.getresponse().status < 500
+    except (IOError, OSError, HTTPException):
+        return False
+    finally:
+        conn.close()
+
+def watch_endpoints():
+    """Periodically check the health of the endpoints of both clusters"""
+    while True:
+        for gateways in _gateways.values():
+            for endpoint in gateways.endpoints:
+                if check_endpoint(endpoint):
+                    gateways.mark_up(endpoint)
+                else:
+                    gateways.mark_down(endpoint)
+        time.sleep(HEALTH_CHECK_INTERVAL)
+
+class Throttle(object):
+    """
+        Token bucket shared by all the processes of the migration. A rate of
+        0 disables the throttle.
+    """
+
+    def __init__(self, rate=0):
+        # rate, available tokens, time of the last update
+        self.state = Array('d', [float(rate), 0.0, time.time()])
+
+    @property
+    def rate(self):
+        return self.state[0]
+
+    def set_rate(self, rate):
+        with self.state.get_lock():
+            self.state[:] = [float(rate), 0.0, time.time()]
+
+    def reserve(self, amount):
+        """Take amount tokens and return how long to wait before using them"""
+        with self.state.get_lock():
+            rate, tokens, last = self.state[:]
+            if rate <= 0:
+                return 0
+            now = time.time()
+            # Bursts are limited to one second worth of tokens: consumers
+            # going past the limit get in debt and wait until it is paid
+            tokens = min(tokens + (now - last) * rate, rate) - amount
+            self.state[1] = tokens
+            self.state[2] = now
+        return max(-tokens / rate, 0)
+
+    def consume(self, amount):
+        delay = self.reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+
+cluster_throttles = namedtuple('cluster_throttles', ['bandwidth', 'rate'])
+
+# Throttles for each cluster ('src' and 'dst'), inherited by the workers
+_throttles = {}
+
+def throttle_iter(iterable, *throttles):
+    """Consume the size of each chunk of iterable from throttles"""
+    for chunk in iterable:
+        for throttle in throttles:
+            throttle.consume(len(chunk))
+        yield chunk
+
+def cluster_bandwidth(*clusters):
+    return [_throttles[c].bandwidth for c in clusters if c in _throttles]
+
+def load_throttle_file(path):
+    """
+        Apply the limits found in a JSON file, e.g.:
+
+            {"src_bandwidth": "50M", "src_rate": 200, "dst_bandwidth": "100M", "dst_rate": 0}
+    """
+    with open(path) as f:
+        limits = json.load(f)
+    for cluster, throttles in _throttles.items():
+        bandwidth = limits.get(cluster + '_bandwidth')
+        if bandwidth is not None:
+            throttles.bandwidth.set_rate(decode_size(str(bandwidth)))
+        rate = limits.get(cluster + '_rate')
+        if rate is not None:
+            throttles.rate.set_rate(float(rate))
+    logger.info("Throttles: %s", ', '.join(
+        '%s %sB/s %d req/s' % (c, human_size(int(t.bandwidth.rate)), t.rate.rate)
+        for c, t in sorted(_throttles.items())))
+
+def watch_throttle_file(path, reload_event):
+    """Reload the throttle file when it changes or when SIGHUP is received"""
+    mtime = None
+    while True:
+        try:
+            current = os.stat(path).st_mtime
+            if reload_event.is_set() or current != mtime:
+                mtime = current
+                load_throttle_file(path)
+        except (OSError, IOError, ValueError) as e:
+            logger.error("Unable to load throttle file %s: %s", path, e)
+        reload_event.clear()
+        reload_event.wait(THROTTLE_CHECK_INTERVAL)
+
+class Connection(swiftclient.Connection):
+    """
+        Swift connection to one endpoint of a cluster, subject to the request
+        rate limit of the cluster
+    """
+
+    def __init__(self, cluster, endpoint, *args, **kwargs):
+        swiftclient.Connection.__init__(self, *args, **kwargs)
+        self.cluster = cluster
+        self.endpoint = endpoint
+        self.retries = 0
+        # Connections which are not bound to an endpoint by their caller fail over
+        self.failover = False
+
+    def move(self, endpoint):
+        """Send the next requests to another endpoint"""
+        self.close()
+        self.endpoint = endpoint
+        self.authurl = 'http://{}:{}/auth'.format(*endpoint)
+        self.url = self.token = None
+
+    def get_auth(self):
+        url, token = swiftclient.Connection.get_auth(self)
+        # Keep sending requests to our endpoint whatever the storage URL
+        # advertised by radosgw
+        self.url = urlunparse(urlparse(url)._replace(netloc='%s:%d' % self.endpoint))
+        return self.url, token
+
+    def _retry(self, *args, **kwargs):
+        gateways = _gateways.get(self.cluster)
+        attempts = len(gateways.endpoints) if gateways is not None and self.failover else 1
+        for attempt in range(attempts):
+            if self.cluster in _throttles:
+                _throttles[self.cluster].rate.consume(1)
+            try:
+                return swiftclient.Connection._retry(self, *args, **kwargs)
+            except Exception as e:
+                # No response at all: fail over to the other endpoints
+                if gateways is None or (isinstance(e, swiftclient.ClientException) and e.http_status):
+                    raise
+                gateways.mark_down(self.endpoint)
+                if attempt == attempts - 1:
+                    raise
+                self.move(gateways.pick())
+            finally:
+                self.retries += max(getattr(self, 'attempts', 1) - 1, 0)
+
+def make_swift_connection(account, endpoint):
+    return Connection(account.cluster, endpoint, authurl='http://{}:{}/auth'.format(*endpoint),
         user=account.user, key=account.key)
 
-def migrate_object(src_swift, dst_swift, bucket, key):
+# radosgw admin connections are not thread safe: each thread gets its own
+_admin_local = threading.local()
+
+def get_admin_connection(account):
+    if not hasattr(_admin_local, 'connections'):
+        _admin_local.connections = {}
+    conn = _admin_local.connections.get(account)
+    if conn is None:
+        conn = _admin_local.connections[account] = make_admin_connection(account)
+    return conn
+
+# Swift connections owned by the current thread, keyed by swift_account and
+# endpoint. swiftclient re-authenticates transparently when a cached token
+# expires and keeps the underlying HTTP connection alive between requests.
+# Only the most recently used connections are kept, so that migrating many
+# users does not leave an open socket per user in every thread.
+_swift_local = threading.local()
+SWIFT_CONNECTIONS_PER_THREAD = 8
+
+def _swift_connections():
+    if not hasattr(_swift_local, 'connections'):
+        _swift_local.connections = OrderedDict()
+    return _swift_local.connections
+
+def get_swift_connection(account, endpoint=None):
+    """
+        Connection to the given endpoint or, when None, to any healthy
+        endpoint of the cluster of account
+    """
+    connections = _swift_connections()
+    conn = connections.get((account, endpoint))
+    gateways = _gateways[account.cluster]
+    if conn is not None and endpoint is None and not gateways.is_up(conn.endpoint):
+        drop_swift_connection(account)
+        conn = None
+    if conn is None:
+        conn = make_swift_connection(account, endpoint or gateways.pick())
+        conn.failover = endpoint is None
+        while len(connections) >= SWIFT_CONNECTIONS_PER_THREAD:
+            _, evicted = connections.popitem(last=False)
+            # A connection still in use by the caller reconnects on its next request
+            try:
+                evicted.close()
+            except: pass
+    else:
+        del connections[(account, endpoint)]
+    connections[(account, endpoint)] = conn
+    return conn
+
+def drop_swift_connection(account, endpoint=None):
+    conn = _swift_connections().pop((account, endpoint), None)
+    if conn is not None:
+        try:
+            conn.close()
+        except: pass
+
+# Number of times a failed transfer is retried
+_max_retries = [0]
+
+def init_worker(max_retries=0):
+    # Never share sockets inherited from the parent process
+    _swift_connections().clear()
+    _max_retries[0] = max_retries
+    # Only the main process reloads the throttle file: HUP must not kill the workers
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+def iter_container_listing(conn, container, marker='', prefix=None):
+    """Yield the pages of a container listing, starting after marker"""
+    while True:
+        _, page = conn.get_container(container, marker=marker, prefix=prefix)
+        if not page:
+            return
+        yield page
+        marker = page[-1]['name']
+
+class ListingCursor(object):
+    """Walk a container listing in name order, fetching pages on demand"""
+
+    def __init__(self, conn, container, marker=''):
+        self.pages = iter_container_listing(conn, container, marker)
+        self.entries = deque()
+        self.exhausted = False
+
+    def seek(self, name):
+        """Return the listing entry for name, if any, skipping all the entries before it"""
+        while True:
+            while self.entries and self.entries[0]['name'] < name:
+                self.entries.popleft()
+            if self.entries:
+                return self.entries[0] if self.entries[0]['name'] == name else None
+            if self.exhausted:
+                return None
+            page = next(self.pages, None)
+            if page is None:
+                self.exhausted = True
+            else:
+                self.entries.extend(page)
+
+def filter_object_headers(hdrs):
+    return {
+        k: v for k, v in hdrs.items() if k in (
+            'x-object-manifest', 'content-type', 'last-modified', 'x-timestamp'
+            ) or k.startswith('x-object-meta-')}
+
+def filter_container_headers(hdrs):
+    return {
+        k: v for k, v in hdrs.items() if k in (
+            'x-storage-policy', 'default-placement', 'x-timestamp',
+            'x-container-read', 'x-container-write'
+            ) or k.startswith('x-container-meta-')}
+
+def timed(stats, op, func, *args, **kwargs):
+    t = time.time()
+    result = func(*args, **kwargs)
+    stats[op] = time.time() - t
+    return result
+
+def migrate_segment(swift_from, swift_to, bucket, key, seg, chunk_size, stats):
+    # Ranged GET of the source object, uploaded as a DLO segment
+    byte_range = 'bytes=%d-%d' % (seg.offset, seg.offset + seg.length - 1)
+    hdr_from, body_from = timed(stats, 'get', swift_from.get_object, bucket, key,
+                                resp_chunk_size=chunk_size, headers={'Range': byte_range})
+    body_from = throttle_iter(body_from, *cluster_bandwidth('src', 'dst'))
+    size = int(hdr_from.get('content-length'))
+    logger.info("Uploading %s/%s range %d-%d as segment %s/%s", bucket, key,
+                seg.offset, seg.offset + size - 1, seg.container, seg.name)
+    timed(stats, 'put', swift_to.put_object, seg.container, seg.name, body_from, content_length=size)
+    return size
+
+def is_retryable(e):
+    """Tell transient errors, worth retrying, from permanent ones"""
+    if isinstance(e, swiftclient.ClientException):
+        # No status means the request did not get a response
+        return not e.http_status or e.http_status in (408, 429) or e.http_status >= 500
+    return isinstance(e, (IOError, OSError))
+
+def retry_delay(attempt):
+    """Capped exponential backoff with full jitter"""
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** attempt))
+
+def content_etag(etag):
+    """ETag to check the content uploaded against, when it is an MD5 digest"""
+    return etag if etag is not None and MD5_RE.match(etag) else None
+
+def transfer_object(swift_from, swift_to, bucket, key, chunk_size, stats):
+    hdr_from = timed(stats, 'head', swift_from.head_object, bucket, key)
+    headers = filter_object_headers(hdr_from)
+    lo = headers.get('x-object-manifest')
+    size = int(hdr_from.get('content-length'))
+    if size > 0 and lo is None:
+        # Stream the object body: only one chunk per worker is held in
+        # memory regardless of the object size
+        hdr_from, body_from = timed(stats, 'get', swift_from.get_object, bucket, key,
+                                    resp_chunk_size=chunk_size)
+        body_from = throttle_iter(body_from, *cluster_bandwidth('src', 'dst'))
+        size = int(hdr_from.get('content-length'))
+        logger.info("Uploading %s/%s as regular object (%sB)", bucket, key, human_size(size))
+        timed(stats, 'put', swift_to.put_object, bucket, key, body_from, content_length=size,
+              etag=content_etag(hdr_from.get('etag')), headers=headers)
+    else:
+        logger.info("Uploading %s/%s as large object (%sB)", bucket, key, human_size(size))
+        timed(stats, 'put', swift_to.put_object, bucket, key, '', headers=headers)
+    return size
+
+def migrate_object(src_swift, dst_swift, bucket, key, chunk_size=DEFAULT_CHUNK_SIZE, seg=None):
+    """
+        Migrate an object, or a segment of it, and return a
+        (bucket, key, size, elapsed, stats) tuple where stats holds the
+        duration of each request and the number of retries. When the
+        migration failed, size is -1 and elapsed is replaced by the error.
+    """
     logger.info("Uploading %s/%s", bucket, key)
+    stats = dict(head=None, get=None, put=None, retries=0)
+    t1 = time.time()
+    if seg is not None:
+        bucket_key = (seg.container, seg.name)
+    else:
+        bucket_key = (bucket, key)
+    attempt = 0
+    while True:
+        src_gateways = _gateways[src_swift.cluster]
+        dst_gateways = _gateways[dst_swift.cluster]
+        src_slot = src_gateways.acquire()
+        dst_slot = dst_gateways.acquire()
+        src_endpoint = src_gateways.endpoints[src_slot]
+        dst_endpoint = dst_gateways.endpoints[dst_slot]
+        try:
+            swift_from = get_swift_connection(src_swift, src_endpoint)
+            swift_to = get_swift_connection(dst_swift, dst_endpoint)
+            retries = swift_from.retries + swift_to.retries
+            try:
+                if seg is not None:
+                    size = migrate_segment(swift_from, swift_to, bucket, key, seg, chunk_size, stats)
+                else:
+                    size = transfer_object(swift_from, swift_to, bucket, key, chunk_size, stats)
+            finally:
+                stats['retries'] += swift_from.retries + swift_to.retries - retries
+            stats['elapsed'] = time.time() - t1
+            return bucket_key + (size, stats['elapsed'], stats)
+        except Exception as e:
+            # A failed request may leave a partially read response behind:
+            # start over with fresh connections
+            drop_swift_connection(src_swift, src_endpoint)
+            drop_swift_connection(dst_swift, dst_endpoint)
+            error, error_info = e, sys.exc_info()
+        finally:
+            src_gateways.release(src_slot)
+            dst_gateways.release(dst_slot)
+        if is_retryable(error) and attempt < _max_retries[0]:
+            delay = retry_delay(attempt)
+            attempt += 1
+            stats['retries'] += 1
+            logger.warn("Uploading %s/%s failed (%s): retrying in %.1fs", bucket, key, error, delay)
+            time.sleep(delay)
+            continue
+        logger.error('Uploading %s/%s FAILED!', bucket, key, exc_info=error_info)
+        stats['elapsed'] = time.time() - t1
+        return bucket_key + (-1, '%s: %s' % (type(error).__name__, error), stats)
+
+def migrate_object_job(migration):
+    return migration, migrate_object(*migration)
+
+def head_object_job(args):
+    account, container, name = args
     try:
-        t1 = time.time()
-        swift_from = make_swift_connection(src_swift)
-        swift_to = make_swift_connection(dst_swift)
-        hdr_from = swift_from.head_object(bucket, key)
-        headers = {
-            k: v for k, v in hdr_from.items() if k in (
-                'x-object-manifest', 'content-type', 'last-modified', 'x-timestamp'
-                ) or k.startswith('x-object-meta-')}
-        lo = headers.get('x-object-manifest')
-        size = int(hdr_from.get('content-length'))
-        if size > 0 and lo is None:
-            hdr_from, key_from = swift_from.get_object(bucket, key)
-            logger.info("Uploading %s/%s as regular object (%sB)", bucket, key, human_size(size))
-            swift_to.put_object(bucket, key, key_from, headers=headers)
+        return name, get_swift_connection(account).head_object(container, name)
+    except swiftclient.ClientException as e:
+        if e.http_status == 404:
+            return name, None
+        raise
+
+def diff_listing(head_pool, cursor, account, container, batch):
+    """
+        Merge a page of the source listing with the destination listing.
+        Yield (name, headers) for each object of the page, headers being None
+        for objects missing in the destination: HEAD requests are only sent
+        for objects whose size or hash do not match and for possible DLOs.
+    """
+    to_check = []
+    for name in sorted(batch):
+        src_obj = batch[name]
+        dst_obj = cursor.seek(name)
+        if dst_obj is None:
+            yield name, None
+        elif src_obj['bytes'] > 0 and dst_obj['bytes'] == src_obj['bytes'] and dst_obj['hash'] == src_obj['hash']:
+            yield name, {'content-length': str(dst_obj['bytes']), 'etag': dst_obj['hash']}
         else:
-            logger.info("Uploading %s/%s as large object (%sB)", bucket, key, human_size(size))
-            swift_to.put_object(bucket, key, '', headers=headers)
-        t2 = time.time()
-        elapsed = t2 - t1
-        return (bucket, key, size, elapsed)
-    except:
-        logger.exception('Uploading %s/%s FAILED!', bucket, key)
-        return (bucket, key, -1, traceback.extract_stack())
+            to_check.append((account, container, name))
+    for result in head_pool.imap_unordered(head_object_job, to_check):
+        yield result
 
-def migrate_object_job(migration):
-    return migrate_object(*migration)
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
 
-def ensure_swift_subuser(admin, uid):
-    user = admin.get_user(uid)
-    if len(user.swift_keys) < 1:
-        admin.create_subuser(user.uid, user.uid+':migration', key_type='swift', generate_secret=True, access='full')
-        user = admin.get_user(uid)
-    return user
+def account_uid(account):
+    return account.user.split(':')[0]
 
-@click.command()
-@click.option('--jobs', '-j', type=click.IntRange(min=1, max=None), default=20, metavar="JOBS",
-    help='Number of parallel trasfers (default=20)')
-@click.argument('src', type=str, nargs=1)
-@click.argument('dst', type=str, nargs=1)
-def migrate(src, dst, jobs):
+class Metrics(object):
+    """
+        Progress of the migration, aggregated from the enumeration and from
+        the results returned by the transfer jobs
     """
-        Migrate radosgw data between two Ceph clusters
 
-        SRC and DST represent radosgw admin credentials for source
-        and destination clusters in the following format:
+    OPERATIONS = ('head', 'get', 'put')
+    LATENCY_SAMPLES = 10000
+
+    def __init__(self, jobs):
+        self.lock = threading.Lock()
+        self.jobs = jobs
+        self.started = time.time()
+        self.containers = {}
+        self.latencies = {op: deque(maxlen=self.LATENCY_SAMPLES) for op in self.OPERATIONS}
+        self.transferred = 0
+        self.retries = 0
+        self.busy = 0.0
+        self.failed_users = 0
+        self.failed_containers = 0
+
+    def _container(self, uid, container):
+        key = (uid, container)
+        if key not in self.containers:
+            self.containers[key] = dict(objects=0, bytes=0, up_to_date=0, up_to_date_bytes=0,
+                                        migrated=0, migrated_bytes=0, failed=0)
+        return self.containers[key]
+
+    def container_found(self, uid, container, objects, size):
+        with self.lock:
+            c = self._container(uid, container)
+            c['objects'] = objects
+            c['bytes'] = size
+
+    def object_up_to_date(self, uid, container, size):
+        with self.lock:
+            c = self._container(uid, container)
+            c['up_to_date'] += 1
+            c['up_to_date_bytes'] += size
+
+    def scan_failed(self, container=None):
+        """Account for a user, or a container when given, which could not be enumerated"""
+        with self.lock:
+            if container is None:
+                self.failed_users += 1
+            else:
+                self.failed_containers += 1
+
+    def transfer_done(self, size, stats):
+        """Account for a transfer job, either a whole object or a segment"""
+        with self.lock:
+            self.transferred += max(size, 0)
+            self.retries += stats.get('retries', 0)
+            self.busy += stats.get('elapsed', 0)
+            for op in self.OPERATIONS:
+                if stats.get(op) is not None:
+                    self.latencies[op].append(stats[op])
+
+    def object_done(self, uid, container, size, failed=False):
+        with self.lock:
+            c = self._container(uid, container)
+            if failed:
+                c['failed'] += 1
+            else:
+                c['migrated'] += 1
+                c['migrated_bytes'] += size
+
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            duration = max(now - self.started, 0.001)
+            containers = []
+            users = {}
+            totals = dict(objects=0, bytes=0, done=0, done_bytes=0, remaining=0, remaining_bytes=0,
+                          migrated=0, migrated_bytes=0, failed=0)
+            for (uid, name), c in sorted(self.containers.items()):
+                entry = dict(c, user=uid, container=name,
+                             done=c['up_to_date'] + c['migrated'],
+                             done_bytes=c['up_to_date_bytes'] + c['migrated_bytes'])
+                entry['remaining'] = max(c['objects'] - entry['done'], 0)
+                entry['remaining_bytes'] = max(c['bytes'] - entry['done_bytes'], 0)
+                containers.append(entry)
+                user = users.setdefault(uid, dict((k, 0) for k in totals))
+                for k in totals:
+                    user[k] += entry[k]
+                    totals[k] += entry[k]
+            latencies = {}
+            for op, samples in self.latencies.items():
+                samples = sorted(samples)
+                latencies[op] = dict((p, percentile(samples, int(p[1:]))) for p in ('p50', 'p95', 'p99'))
+            rate = self.transferred / duration
+            return dict(
+                elapsed=duration,
+                transferred_bytes=self.transferred,
+                bytes_per_second=rate,
+                eta=totals['remaining_bytes'] / rate if rate else None,
+                retries=self.retries,
+                failed_users=self.failed_users,
+                failed_containers=self.failed_containers,
+                worker_utilization=min(self.busy / (duration * self.jobs), 1.0),
+                latency=latencies,
+                totals=totals,
+                users=users,
+                containers=containers,
+            )
+
+    def prometheus(self):
+        snap = self.snapshot()
+        lines = [
+            'rgw_migrate_elapsed_seconds %f' % snap['elapsed'],
+            'rgw_migrate_transferred_bytes_total %d' % snap['transferred_bytes'],
+            'rgw_migrate_bytes_per_second %f' % snap['bytes_per_second'],
+            'rgw_migrate_retries_total %d' % snap['retries'],
+            'rgw_migrate_failed_users_total %d' % snap['failed_users'],
+            'rgw_migrate_failed_containers_total %d' % snap['failed_containers'],
+            'rgw_migrate_worker_utilization %f' % snap['worker_utilization'],
+        ]
+        for op, values in sorted(snap['latency'].items()):
+            for p, value in sorted(values.items()):
+                if value is not None:
+                    lines.append('rgw_migrate_latency_seconds{operation="%s",quantile="0.%s"} %f' % (op, p[1:], value))
+        for c in snap['containers']:
+            labels = 'user="%s",container="%s"' % (c['user'], c['container'].replace('\\', '\\\\').replace('"', '\\"'))
+            for k in ('objects', 'bytes', 'done', 'done_bytes', 'remaining', 'remaining_bytes', 'failed'):
+                lines.append('rgw_migrate_container_%s{%s} %d' % (k, labels, c[k]))
+        return '\n'.join(lines) + '\n'
 
-            host:port:access_key:secret_key
+def serve_metrics(metrics, port):
+    """Serve metrics on localhost: /metrics in Prometheus format, /metrics.json as JSON"""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, ctype = metrics.prometheus(), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body, ctype = json.dumps(metrics.snapshot()), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            body = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server')
+    thread.daemon = True
+    thread.start()
+    return server
+
+def write_metrics_file(metrics, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(metrics.snapshot(), f, indent=2)
+    os.rename(tmp_path, path)
+
+def watch_metrics_file(metrics, path):
+    while True:
+        time.sleep(METRICS_INTERVAL)
+        try:
+            write_metrics_file(metrics, path)
+        except (OSError, IOError) as e:
+            logger.error("Unable to write metrics file %s: %s", path, e)
+
+class DeadLetters(object):
+    """
+        Objects which could not be migrated, appended to a file as JSON lines
+        so that they can be retried without enumerating all the objects again
     """
 
-    def iter_objects(src_s3, dst_s3):
-        logger.info("Connecting to radosgw admin API")
-        admin_from = make_admin_connection(src_s3)
-        admin_to = make_admin_connection(dst_s3)
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # Entries recorded by this run
+        self.count = 0
 
-        SWIFT_COMMON_OPTS = dict(auth_version='1.0')
+    def add(self, uid, container, obj, error):
+        self.add_entry(dict(user=uid, container=container, name=obj['name'],
+                            bytes=obj['bytes'], hash=obj['hash'], error=error))
 
-        for user in admin_from.get_users():
-            if OS_UID_RE.match(user.uid) is None:
-                # Ignore non-openstack users
-                continue
-            user_from = ensure_swift_subuser(admin_from, user.uid)
-            try:
-                logger.info("Checking user: %s (%s)" % (user_from.display_name, user_from.uid))
-                user_to = admin_to.get_user(user.uid)
-            except radosgw.exception.NoSuchUser:
-                # Account does not exist in destination cluster: create it
-                logger.info("Migrating user: %s (%s)" % (user_from.display_name, user_from.uid), exc_info=0)
-                user_to = admin_to.create_user(user_from.uid, user_from.display_name, generate_key=False)
-                user_quota = admin_from.get_quota(user.uid, 'user')
-                admin_to.set_quota(user.uid, 'user', **user_quota)
-                bucket_quota = admin_from.get_quota(user.uid, 'bucket')
-                admin_to.set_quota(user.uid, 'bucket', **bucket_quota)
-                logger.info("Updated quota for user %s: user=%s bucket=%s", user.uid, user_quota, bucket_quota)
-            user_to = ensure_swift_subuser(admin_to, user.uid)
-
-            swift_account_from = swift_account(src_s3.host, src_s3.port, user_from.swift_keys[0].user, user_from.swift_keys[0].access_key)
-            swift_account_to = swift_account(dst_s3.host, dst_s3.port, user_to.swift_keys[0].user, user_to.swift_keys[0].access_key)
-
-            swift_opts_from = dict(
-                auth='http://{}:{}/auth'.format(swift_account_from.host, swift_account_from.port),
-                user=swift_account_from.user,
-                key=swift_account_from.key)
-            swift_opts_from.update(SWIFT_COMMON_OPTS)
-
-            swift_opts_to = dict(
-                auth='http://{}:{}/auth'.format(swift_account_to.host, swift_account_to.port),
-                user=swift_account_to.user,
-                key=swift_account_to.key)
-            swift_opts_to.update(SWIFT_COMMON_OPTS)
-
-            with SwiftService(options=swift_opts_from) as swift_from:
-                with SwiftService(options=swift_opts_to) as swift_to:
-                    try:
-                        # List containers owned by the account
-                        account_contents = swift_from.list()
-                        for containers_page in account_contents:
-                            if containers_page['success']:
-                                for container in containers_page['listing']:
-                                    container_name = container['name']
-                                    logger.info("Checking container %s (%d objects, %sB)",
-                                                container_name, container['count']/2, human_size(container['bytes']/2))
-                                    container_from_stats = swift_from.stat(container=container_name)
-                                    container_from_hdrs = container_from_stats['headers']
-                                    try:
-                                        swift_to.stat(container=container_name)
-                                    except SwiftError:
-                                        # Container is not present in destination cluster: create it
-                                        filtered_hdrs = {
-                                            k: v for k, v in container_from_hdrs.items() if k in (
-                                                'x-storage-policy', 'default-placement', 'x-timestamp',
-                                                'x-container-read', 'x-container-write'
-                                                ) or k.startswith('x-container-meta-')}
-                                        logger.info('Migrating container %s', container_name)
-                                        swift_conn_to = make_swift_connection(swift_account_to)
-                                        swift_conn_to.put_container(container_name, filtered_hdrs)
-                                    # List objects in the container
-                                    container_contents = swift_from.list(container=container_name)
-                                    for objects_page in container_contents:
-                                        if objects_page['success']:
-                                            batch = {x['name']: x for x in objects_page['listing']}
-                                            # Check which object already exist in the destination cluster
-                                            objs_stats = swift_to.stat(container=container_name, objects=batch.keys())
-                                            for obj in objs_stats:
-                                                obj_name = obj['object']
-                                                src_obj = batch[obj_name]
-                                                if obj['success']:
-                                                    # Object is present in destination: check size and hash
-                                                    src_size = src_obj['bytes']
-                                                    src_hash = src_obj['hash']
-                                                    dst_size = int(obj['headers']['content-length'])
-                                                    dst_hash = obj['headers']['etag']
-                                                    if dst_size == src_size and dst_hash == src_hash:
-                                                        continue
-                                                    # The object exists in the destination cluster but size and/or
-                                                    # hash do not match. If it's a swift large object, we need to
-                                                    # perform further checks
-                                                    if src_size == 0 and dst_size > 0:
-                                                        # Check if both are large objects
-                                                        src_stats = swift_from.stat(container=container_name, objects=[obj_name])
-                                                        src_obj_stats = list(src_stats)[0]
-                                                        real_src_size = int(src_obj_stats['headers']['content-length'])
-                                                        # We only need to check for DLOs since SLOs are not supported
-                                                        # in Ceph Hammer
-                                                        src_manifest = src_obj_stats['headers'].get('x-object-manifest')
-                                                        dst_manifest = obj['headers'].get('x-object-manifest')
-                                                        if real_src_size == dst_size and src_manifest is not None and src_manifest == dst_manifest:
-                                                            # Both are large objects, have the same size and manifests match
-                                                            continue
-                                                    logger.warn("Destination %s/%s does not match source: deleting", container_name, obj_name)
-                                                    swift_to.delete(container=container_name, objects=[obj_name])
-                                                logger.info("Submitting %s/%s for migration", container_name, obj_name)
-                                                yield (swift_account_from, swift_account_to, container_name, obj_name)
-                                        else:
-                                            raise objects_page['error']
-                            else:
-                                raise containers_page['error']
-                    except SwiftError as e:
-                        logger.error(e.value)
-
-    src_account = decode_s3_account(src)
-    dst_account = decode_s3_account(dst)
-
-    pool = Pool(processes=jobs)
-    for bucket, key, size, elapsed in pool.imap_unordered(migrate_object_job, iter_objects(src_account, dst_account)):
-        if size < 0:
-            logger.info("Upload of %s/%s FAILED!" % (bucket, key))
+    def add_scan(self, uid, container, error):
+        """Record a user, or a container when given, which could not be enumerated"""
+        self.add_entry(dict(user=uid, container=container, name=None, error=error))
+
+    def add_entry(self, entry):
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+            self.count += 1
+
+    def entries(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def take(self):
+        """
+            Return the recorded entries, moving the file out of the way for new
+            failures. Objects which failed several times are only returned once,
+            with their most recent entry.
+        """
+        entries = OrderedDict()
+        for entry in self.entries():
+            key = (entry['user'], entry['container'], entry['name'])
+            entries.pop(key, None)
+            entries[key] = entry
+        os.rename(self.path, self.path + '.prev')
+        return list(entries.values())
+
+class PendingJobs(object):
+    """
+        Bookkeeping of the jobs submitted for transfer. Identical jobs can be
+        in flight at the same time: the values of each job are returned in
+        submission order.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {}
+
+    def add(self, job, value):
+        with self.lock:
+            self.jobs.setdefault(job, deque()).append(value)
+
+    def pop(self, job, default=None):
+        with self.lock:
+            values = self.jobs.get(job)
+            if not values:
+                return default
+            value = values.popleft()
+            if not values:
+                del self.jobs[job]
+            return value
+
+class Journal(object):
+    """
+        On-disk record of the objects known to be migrated and of the progress
+        of each container listing, used to resume an interrupted migration.
+
+        Listing pages are tracked until every object they contain has been
+        handled: the saved marker of a container never moves past an object
+        which is still in flight or failed.
+    """
+
+    COMMIT_INTERVAL = 5
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS objects (account TEXT, container TEXT, name TEXT, '
+                        'etag TEXT, size INTEGER, PRIMARY KEY (account, container, name))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS markers (account TEXT, container TEXT, marker TEXT, '
+                        'PRIMARY KEY (account, container))')
+        self.db.commit()
+        self.last_commit = time.time()
+        self.pages = {}
+
+    def _changed(self):
+        if time.time() - self.last_commit > self.COMMIT_INTERVAL:
+            self.db.commit()
+            self.last_commit = time.time()
+
+    def is_migrated(self, account, container, name, etag, size):
+        with self.lock:
+            row = self.db.execute('SELECT etag, size FROM objects WHERE account=? AND container=? AND name=?',
+                                  (account, container, name)).fetchone()
+        return row is not None and row[0] == etag and row[1] == size
+
+    def record(self, account, container, name, etag, size):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)',
+                            (account, container, name, etag, size))
+            self._changed()
+
+    def get_marker(self, account, container):
+        with self.lock:
+            row = self.db.execute('SELECT marker FROM markers WHERE account=? AND container=?',
+                                  (account, container)).fetchone()
+        return row[0] if row else ''
+
+    def open_page(self, account, container, listing):
+        """Start tracking a listing page: the page is held open until close_page()"""
+        page = dict(account=account, container=container, marker=listing[-1]['name'],
+                    pending=1, failed=False)
+        with self.lock:
+            self.pages.setdefault((account, container), deque()).append(page)
+        return page
+
+    def add_job(self, page):
+        with self.lock:
+            page['pending'] += 1
+
+    def close_page(self, page):
+        self.job_done(page)
+
+    def job_done(self, page, failed=False):
+        with self.lock:
+            page['pending'] -= 1
+            page['failed'] |= failed
+            pages = self.pages[(page['account'], page['container'])]
+            marker = None
+            while pages and pages[0]['pending'] == 0 and not pages[0]['failed']:
+                marker = pages.popleft()['marker']
+            if marker is not None:
+                self.db.execute('INSERT OR REPLACE INTO markers VALUES (?, ?, ?)',
+                                (page['account'], page['container'], marker))
+                self._changed()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+def split_object(bucket, key, size, etag, segment_size):
+    """Split a regular object into the segments of a DLO"""
+    seg_container = bucket + '_segments'
+    prefix = '%s/%s/%d/%d/' % (key, etag, size, segment_size)
+    return [segment(seg_container, '%s%08d' % (prefix, i), offset, min(segment_size, size - offset))
+            for i, offset in enumerate(range(0, size, segment_size))]
+
+def split_manifest(segments):
+    """DLO manifest of the segments returned by split_object()"""
+    return quote(('%s/%s' % (segments[0].container, segments[0].name[:-8])).encode('utf-8'))
+
+def split_manifest_etag(manifest, bucket, key):
+    """Source etag embedded in a DLO manifest written for split_object() segments, or None"""
+    seg_container, _, prefix = unquote(manifest).partition('/')
+    if seg_container != bucket + '_segments' or not prefix.startswith(key + '/'):
+        return None
+    parts = prefix[len(key) + 1:].split('/')
+    if len(parts) != 4 or parts[3] or not parts[1].isdigit() or not parts[2].isdigit():
+        return None
+    return parts[0]
+
+def put_split_container(swift_from, swift_to, seg_container):
+    """
+        Create the container of split_object() segments in the destination
+        cluster. A source container of the same name is migrated into it as
+        well: it is then created with the headers of the source container.
+    """
+    try:
+        headers = filter_container_headers(swift_from.head_container(seg_container))
+    except swiftclient.ClientException as e:
+        if e.http_status != 404:
+            raise
+        headers = {}
+    swift_to.put_container(seg_container, headers)
+
+def delete_split_segments(conn, manifest):
+    """Remove the segments left behind by an object previously migrated in segments"""
+    seg_container, prefix = unquote(manifest).split('/', 1)
+    for page in iter_container_listing(conn, seg_container, prefix=prefix):
+        for obj in page:
+            conn.delete_object(seg_container, obj['name'])
+
+def stored_as_dlo(mode, size):
+    """Whether an object of size bytes migrated in segments is stored as a DLO"""
+    return mode == 'dlo' or size > MAX_COPY_SIZE
+
+def finish_large_object(lobj, mode):
+    """
+        Write the DLO manifest of an object migrated in segments or, in
+        'concat' mode, assemble the segments in a single object using a
+        server side copy and remove them. Objects too large for a server
+        side copy are kept as DLOs.
+    """
+    swift_from = get_swift_connection(lobj['src'])
+    swift_to = get_swift_connection(lobj['dst'])
+    bucket, key, segments = lobj['bucket'], lobj['key'], lobj['segments']
+    headers = filter_object_headers(swift_from.head_object(bucket, key))
+    seg_container = segments[0].container
+    prefix = segments[0].name[:-8]
+    manifest = split_manifest(segments)
+    if stored_as_dlo(mode, sum(seg.length for seg in segments)):
+        if mode != 'dlo':
+            logger.info("Keeping %s/%s as a DLO: too large for a server side copy", bucket, key)
+        headers['x-object-manifest'] = manifest
+        swift_to.put_object(bucket, key, '', headers=headers)
+        return
+    tmp_manifest = prefix[:-1] + '.manifest'
+    swift_to.put_object(seg_container, tmp_manifest, '', headers={'x-object-manifest': manifest})
+    headers['x-copy-from'] = quote(('%s/%s' % (seg_container, tmp_manifest)).encode('utf-8'))
+    swift_to.put_object(bucket, key, '', headers=headers)
+    swift_to.delete_object(seg_container, tmp_manifest)
+    for seg in segments:
+        swift_to.delete_object(seg.container, seg.name)
+
+def ensure_swift_subuser(admin, uid, secret=None):
+    user = admin.get_user(uid)
+    if len(user.swift_keys) < 1:
+        if secret is None:
+            admin.create_subuser(user.uid, user.uid+':migration', key_type='swift', generate_secret=True, access='full')
         else:
-            logger.info("Upload of %s/%s completed in %ds" % (bucket, key, elapsed))
-    pool.close()
-    pool.join()
+            try:
+                admin.create_subuser(user.uid, user.uid+':migration', key_type='swift', secret=secret,
+                                     access='full')
+            except (radosgw.exception.SubuserExists, radosgw.exception.KeyExists):
+                # Another shard created the subuser in the meantime, with the same secret
+                pass
+        user = admin.get_user(uid)
+        if len(user.swift_keys) < 1:
+            raise RuntimeError('user %s has no swift key' % uid)
+    return user
+
+def subuser_secret(account, uid):
+    """
+        Swift key of the migration subuser of uid when sharding by container:
+        shards provisioning the same user concurrently must agree on the key
+    """
+    return hmac.new(account.secret_key.encode('utf-8'), uid.encode('utf-8'), hashlib.sha256).hexdigest()
 
+def remove_migration_subusers(src_account, dst_account):
     logger.info("Removing temporary swift subusers")
     admin_from = make_admin_connection(src_account)
     admin_to = make_admin_connection(dst_account)
@@ -375,6 +1220,821 @@ def migrate(src, dst, jobs):
             admin_to.delete_subuser(user.uid, subuser)
         except: pass
 
+def finalize_shards(src_account, dst_account, paths, dead_letter):
+    """
+        Merge the reports written by the shards of a migration and, once all
+        of them have completed, remove the temporary swift subusers. Return
+        the number of failures recorded by the shards.
+    """
+    reports = []
+    for path in paths:
+        with open(path) as f:
+            reports.append(json.load(f))
+    counts = set(r['shards'] for r in reports)
+    if len(counts) != 1:
+        raise click.BadParameter('reports belong to different shardings: %s' % sorted(counts), param_hint='--finalize')
+    missing = set(range(1, counts.pop() + 1)) - set(r['shard'] for r in reports)
+    if missing:
+        raise click.BadParameter('missing reports for shards %s' % sorted(missing), param_hint='--finalize')
+    totals = {}
+    failed_objects = []
+    for r in sorted(reports, key=lambda r: r['shard']):
+        logger.info("Shard %d/%d: %d objects migrated, %d up to date, %d failed, %d users and %d containers "
+                    "not enumerated", r['shard'], r['shards'], r['totals']['migrated'],
+                    r['totals']['done'] - r['totals']['migrated'], r['totals']['failed'],
+                    r.get('failed_users', 0), r.get('failed_containers', 0))
+        for k, v in r['totals'].items():
+            totals[k] = totals.get(k, 0) + v
+        failed_objects.extend(r['failed_objects'])
+    logger.info("All shards: %d objects (%sB) done, %d objects migrated, %d failed", totals['done'],
+                human_size(totals['done_bytes']), totals['migrated'], totals['failed'])
+    if failed_objects:
+        with open(dead_letter, 'a') as f:
+            for entry in failed_objects:
+                f.write(json.dumps(entry) + '\n')
+        logger.warn("%d objects, users or containers could not be migrated: recorded in %s",
+                    len(failed_objects), dead_letter)
+    remove_migration_subusers(src_account, dst_account)
+    return len(failed_objects)
+
+def merge_listings(src_pages, dst_pages):
+    """
+        Walk the source and destination listings of a container in name
+        order and yield (name, src_obj, dst_obj) tuples, with None for the
+        objects missing on one side
+    """
+    src_iter = (obj for page in src_pages for obj in page)
+    dst_iter = (obj for page in dst_pages for obj in page)
+    src_obj, dst_obj = next(src_iter, None), next(dst_iter, None)
+    while src_obj is not None or dst_obj is not None:
+        if dst_obj is None or (src_obj is not None and src_obj['name'] < dst_obj['name']):
+            yield src_obj['name'], src_obj, None
+            src_obj = next(src_iter, None)
+        elif src_obj is None or dst_obj['name'] < src_obj['name']:
+            yield dst_obj['name'], None, dst_obj
+            dst_obj = next(dst_iter, None)
+        else:
+            yield src_obj['name'], src_obj, dst_obj
+            src_obj, dst_obj = next(src_iter, None), next(dst_iter, None)
+
+def listing_matches(src_obj, dst_obj):
+    """Whether listing entries prove an object up to date without a HEAD request"""
+    return src_obj['bytes'] > 0 and src_obj['bytes'] == dst_obj['bytes'] and src_obj['hash'] == dst_obj['hash']
+
+def object_metadata(hdrs):
+    return {k: v for k, v in hdrs.items() if k == 'content-type' or k.startswith('x-object-meta-')}
+
+def dlo_segments(conn, manifest):
+    """Listing entries of the segments of a DLO, keyed by name relative to the manifest prefix"""
+    container, prefix = unquote(manifest).split('/', 1)
+    return {obj['name'][len(prefix):]: obj
+            for page in iter_container_listing(conn, container, prefix=prefix) for obj in page}
+
+def hash_object(conn, container, name, chunk_size, cluster):
+    """Read an object, streaming it, and return the MD5 digest and size of its content"""
+    _, body = conn.get_object(container, name, resp_chunk_size=chunk_size)
+    md5 = hashlib.md5()
+    size = 0
+    for chunk in throttle_iter(body, *cluster_bandwidth(cluster)):
+        md5.update(chunk)
+        size += len(chunk)
+    return md5.hexdigest(), size
+
+def verify_object(src_swift, dst_swift, container, name, deep, chunk_size):
+    """
+        Compare an object present in both clusters and return a list of
+        (problem, details) tuples. DLOs are compared using the sum of the
+        sizes of their segments, and segment by segment when both sides are
+        DLOs. Regular objects migrated in segments are compared with the
+        source etag embedded in their manifest. In deep mode the content of
+        both objects is read and hashed.
+    """
+    swift_from = get_swift_connection(src_swift)
+    swift_to = get_swift_connection(dst_swift)
+    src_hdrs = swift_from.head_object(container, name)
+    try:
+        dst_hdrs = swift_to.head_object(container, name)
+    except swiftclient.ClientException as e:
+        if e.http_status == 404:
+            return [('missing', {})]
+        raise
+    problems = []
+    src_manifest = src_hdrs.get('x-object-manifest')
+    dst_manifest = dst_hdrs.get('x-object-manifest')
+    src_segments = dlo_segments(swift_from, src_manifest) if src_manifest is not None else None
+    dst_segments = dlo_segments(swift_to, dst_manifest) if dst_manifest is not None else None
+    if src_segments is not None:
+        src_size = sum(obj['bytes'] for obj in src_segments.values())
+    else:
+        src_size = int(src_hdrs['content-length'])
+    if dst_segments is not None:
+        dst_size = sum(obj['bytes'] for obj in dst_segments.values())
+    else:
+        dst_size = int(dst_hdrs['content-length'])
+    if src_size != dst_size:
+        problems.append(('size', dict(src=src_size, dst=dst_size)))
+    if src_segments is not None and dst_segments is not None:
+        bad = sorted(k for k in set(src_segments) | set(dst_segments)
+                     if k not in src_segments or k not in dst_segments or
+                     (src_segments[k]['bytes'], src_segments[k]['hash']) !=
+                     (dst_segments[k]['bytes'], dst_segments[k]['hash']))
+        if bad:
+            problems.append(('segments', dict(src=src_manifest, dst=dst_manifest, segments=bad)))
+    elif src_segments is not None:
+        problems.append(('manifest', dict(src=src_manifest, dst=None)))
+    elif dst_segments is not None:
+        # Regular object migrated in segments: the manifest prefix embeds the source etag
+        dst_etag = split_manifest_etag(dst_manifest, container, name)
+        if dst_etag is None:
+            problems.append(('manifest', dict(src=None, dst=dst_manifest)))
+        elif src_hdrs.get('etag') != dst_etag:
+            problems.append(('etag', dict(src=src_hdrs.get('etag'), dst=dst_etag)))
+    elif src_hdrs.get('etag') != dst_hdrs.get('etag'):
+        problems.append(('etag', dict(src=src_hdrs.get('etag'), dst=dst_hdrs.get('etag'))))
+    src_meta = object_metadata(src_hdrs)
+    dst_meta = object_metadata(dst_hdrs)
+    if src_meta != dst_meta:
+        problems.append(('metadata', dict(src=src_meta, dst=dst_meta)))
+    if deep and not problems:
+        src_digest, src_read = hash_object(swift_from, container, name, chunk_size, 'src')
+        dst_digest, dst_read = hash_object(swift_to, container, name, chunk_size, 'dst')
+        if (src_digest, src_read) != (dst_digest, dst_read):
+            problems.append(('checksum', dict(src=src_digest, dst=dst_digest, src_bytes=src_read, dst_bytes=dst_read)))
+    return problems
+
+def verify_object_job(args):
+    try:
+        return args, verify_object(*args)
+    except Exception as e:
+        logger.exception("Verifying %s/%s FAILED!", args[2], args[3])
+        return args, [('error', dict(error='%s: %s' % (type(e).__name__, e)))]
+
+class VerifyReport(object):
+    """Totals and mismatches found by the verification of a migration"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = dict(users=0, containers=0, objects=0, bytes=0, deep_checked=0, mismatches=0)
+        self.mismatches = []
+
+    def count(self, **counts):
+        with self.lock:
+            for k, v in counts.items():
+                self.totals[k] += v
+
+    def add(self, problem, uid, container=None, name=None, **details):
+        logger.warn("Verification of %s FAILED: %s %s", '/'.join(x for x in (uid, container, name) if x is not None),
+                    problem, json.dumps(details, sort_keys=True))
+        with self.lock:
+            self.mismatches.append(dict(details, problem=problem, user=uid, container=container, name=name))
+            self.totals['mismatches'] += 1
+
+    def write(self, path, **info):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(info, totals=self.totals, mismatches=self.mismatches), f, indent=2)
+        os.rename(tmp_path, path)
+
+def verify_migration(src_account, dst_account, mode, sample, scan_threads, jobs, chunk_size, path):
+    """
+        Compare every user, container and object of the source cluster with
+        the destination. Containers are compared in parallel by walking both
+        listings; objects which the listings cannot prove identical, and the
+        objects picked for a deep check, are checked by a pool of jobs.
+        Return the number of mismatches, which are written to a JSON report.
+    """
+    report = VerifyReport()
+    started = time.time()
+
+    def prepare_user(uid):
+        try:
+            user_from = ensure_swift_subuser(get_admin_connection(src_account), uid)
+            admin_to = get_admin_connection(dst_account)
+            try:
+                admin_to.get_user(uid)
+            except radosgw.exception.NoSuchUser:
+                report.add('missing', uid)
+                return None
+            user_to = ensure_swift_subuser(admin_to, uid)
+            report.count(users=1)
+            return (swift_account(user_from.swift_keys[0].user, user_from.swift_keys[0].access_key, 'src'),
+                    swift_account(user_to.swift_keys[0].user, user_to.swift_keys[0].access_key, 'dst'))
+        except Exception as e:
+            logger.exception("Verifying user %s FAILED!", uid)
+            report.add('error', uid, error='%s: %s' % (type(e).__name__, e))
+            return None
+
+    def check_batch(uid, batch):
+        for args, problems in object_pool.imap_unordered(verify_object_job, batch):
+            if args[4]:
+                report.count(deep_checked=1)
+            for problem, details in problems:
+                report.add(problem, uid, args[2], args[3], **details)
+
+    def verify_container(src_swift, dst_swift, container):
+        uid = account_uid(src_swift)
+        try:
+            swift_from = get_swift_connection(src_swift)
+            swift_to = get_swift_connection(dst_swift)
+            try:
+                swift_to.head_container(container)
+            except swiftclient.ClientException as e:
+                if e.http_status != 404:
+                    raise
+                report.add('missing', uid, container)
+                return
+            logger.info("Verifying container %s/%s", uid, container)
+            report.count(containers=1)
+            src_count = dst_count = 0
+            batch = []
+            for name, src_obj, dst_obj in merge_listings(iter_container_listing(swift_from, container),
+                                                         iter_container_listing(swift_to, container)):
+                if dst_obj is not None:
+                    dst_count += 1
+                if src_obj is None:
+                    report.add('extra', uid, container, name)
+                    continue
+                src_count += 1
+                report.count(objects=1, bytes=src_obj['bytes'])
+                if dst_obj is None:
+                    report.add('missing', uid, container, name)
+                    continue
+                deep = mode == 'full' or (mode == 'sample' and random.random() < sample)
+                if not deep and listing_matches(src_obj, dst_obj):
+                    if src_obj.get('content_type') != dst_obj.get('content_type'):
+                        report.add('metadata', uid, container, name,
+                                   src={'content-type': src_obj.get('content_type')},
+                                   dst={'content-type': dst_obj.get('content_type')})
+                    continue
+                batch.append((src_swift, dst_swift, container, name, deep, chunk_size))
+                if len(batch) >= VERIFY_BATCH:
+                    check_batch(uid, batch)
+                    batch = []
+            check_batch(uid, batch)
+            if src_count != dst_count:
+                report.add('count', uid, container, src=src_count, dst=dst_count)
+        except Exception as e:
+            logger.exception("Verifying container %s FAILED!", container)
+            report.add('error', uid, container, error='%s: %s' % (type(e).__name__, e))
+
+    logger.info("Verifying migration (%s mode)", mode)
+    user_pool = ThreadPool(scan_threads)
+    container_pool = ThreadPool(scan_threads)
+    object_pool = ThreadPool(jobs)
+    try:
+        uids = [user.uid for user in get_admin_connection(src_account).get_users()
+                # Ignore non-openstack users
+                if OS_UID_RE.match(user.uid) is not None]
+        for accounts in user_pool.imap_unordered(prepare_user, uids):
+            if accounts is None:
+                continue
+            try:
+                _, containers = get_swift_connection(accounts[0]).get_account(full_listing=True)
+            except swiftclient.ClientException as e:
+                report.add('error', account_uid(accounts[0]), error='%s: %s' % (type(e).__name__, e))
+                continue
+            for container in containers:
+                container_pool.apply_async(verify_container, accounts + (container['name'],))
+        container_pool.close()
+        container_pool.join()
+    finally:
+        user_pool.terminate()
+        container_pool.terminate()
+        object_pool.terminate()
+    remove_migration_subusers(src_account, dst_account)
+    report.write(path, mode=mode, sample=sample if mode == 'sample' else None,
+                 finished=time.time(), elapsed=time.time() - started)
+    totals = report.totals
+    logger.info("Verified %d users, %d containers, %d objects (%sB), %d read back: %d mismatches, "
+                "report written to %s", totals['users'], totals['containers'], totals['objects'],
+                human_size(totals['bytes']), totals['deep_checked'], totals['mismatches'], path)
+    return totals['mismatches']
+
+@click.command()
+@click.option('--jobs', '-j', type=click.IntRange(min=1, max=None), default=20, metavar="JOBS",
+    help='Number of parallel trasfers (default=20)')
+@click.option('--chunk-size', type=SizeType(), default=DEFAULT_CHUNK_SIZE, metavar="SIZE",
+    help='Size of the buffer used to stream object data, e.g. 512K or 16M (default=4M)')
+@click.option('--segment-threshold', type=SizeType(), default=None, metavar="SIZE",
+    help='Migrate regular objects larger than SIZE in parallel segments (default=disabled)')
+@click.option('--segment-size', type=SizeType(), default=DEFAULT_SEGMENT_SIZE, metavar="SIZE",
+    help='Size of the segments of large objects (default=1G)')
+@click.option('--segment-mode', type=click.Choice(SEGMENT_MODES), default='dlo',
+    help='Store segmented objects as DLOs or assemble them in a single object (default=dlo)')
+@click.option('--journal', type=click.Path(dir_okay=False), default=None, metavar="PATH",
+    help='Record the progress of the migration in a journal file')
+@click.option('--resume', is_flag=True, default=False,
+    help='Resume the migration recorded in the journal, skipping migrated objects')
+@click.option('--scan-threads', type=click.IntRange(min=1, max=None), default=4, metavar="THREADS",
+    help='Number of users and containers enumerated in parallel (default=4)')
+@click.option('--queue-size', type=click.IntRange(min=1, max=None), default=1000, metavar="SIZE",
+    help='Maximum number of enumerated objects waiting for a transfer job (default=1000)')
+@click.option('--diff', 'diff_mode', type=click.Choice(DIFF_MODES), default='listing',
+    help='Compare objects with the destination using container listings or one HEAD per object (default=listing)')
+@click.option('--src-bandwidth', type=SizeType(), default=0, metavar="SIZE",
+    help='Maximum bytes per second read from the source cluster (default=unlimited)')
+@click.option('--src-rate', type=click.FloatRange(min=0), default=0, metavar="RATE",
+    help='Maximum requests per second sent to the source cluster (default=unlimited)')
+@click.option('--dst-bandwidth', type=SizeType(), default=0, metavar="SIZE",
+    help='Maximum bytes per second written to the destination cluster (default=unlimited)')
+@click.option('--dst-rate', type=click.FloatRange(min=0), default=0, metavar="RATE",
+    help='Maximum requests per second sent to the destination cluster (default=unlimited)')
+@click.option('--throttle-file', type=click.Path(dir_okay=False), default=None, metavar="PATH",
+    help='JSON file with throttle limits, reloaded when modified or on SIGHUP')
+@click.option('--metrics-port', type=click.IntRange(min=1, max=65535), default=None, metavar="PORT",
+    help='Serve progress metrics on http://localhost:PORT/metrics (Prometheus) and /metrics.json')
+@click.option('--metrics-file', type=click.Path(dir_okay=False), default=None, metavar="PATH",
+    help='Periodically write progress metrics to a JSON file')
+@click.option('--retries', type=click.IntRange(min=0, max=None), default=3, metavar="RETRIES",
+    help='Number of times a transfer failing with a transient error is retried (default=3)')
+@click.option('--dead-letter', type=click.Path(dir_okay=False), default='rgw-migrate-failed.jsonl', metavar="PATH",
+    help='File recording the objects which could not be migrated (default=rgw-migrate-failed.jsonl)')
+@click.option('--retry-failed', is_flag=True, default=False,
+    help='Only migrate the objects recorded in the dead letter file')
+@click.option('--engine', type=click.Choice(ENGINES), default='pool',
+    help='Run transfers in a pool of JOBS processes or on an asyncio event loop (default=pool)')
+@click.option('--concurrency', type=click.IntRange(min=1, max=None), default=200, metavar="TRANSFERS",
+    help='Number of concurrent transfers of the async engine (default=200)')
+@click.option('--timeout', type=click.FloatRange(min=0.1, max=None), default=60, metavar="SECONDS",
+    help='Seconds the async engine waits to connect to radosgw or for each read and write (default=60)')
+@click.option('--shard', type=ShardType(), default=None, metavar="I/N",
+    help='Only migrate the I-th of N shards of the data, e.g. 1/4 (default=all data)')
+@click.option('--shard-by', type=click.Choice(SHARD_KEYS), default='user',
+    help='Split the data between shards by user or by container (default=user)')
+@click.option('--shard-report', type=click.Path(dir_okay=False), default=None, metavar="PATH",
+    help='Report written by a shard when done (default=rgw-migrate-shard-I-of-N.json)')
+@click.option('--finalize', type=click.Path(dir_okay=False, exists=True), multiple=True, metavar="REPORT",
+    help='Merge the reports of all the shards and remove the temporary subusers (repeat for each report)')
+@click.option('--src-endpoint-concurrency', type=click.IntRange(min=0, max=None), default=0, metavar="TRANSFERS",
+    help='Maximum number of transfers in flight on each source endpoint (default=unlimited)')
+@click.option('--dst-endpoint-concurrency', type=click.IntRange(min=0, max=None), default=0, metavar="TRANSFERS",
+    help='Maximum number of transfers in flight on each destination endpoint (default=unlimited)')
+@click.option('--verify', type=click.Choice(VERIFY_MODES), default=None,
+    help='Compare the source and destination clusters instead of migrating: listings only, '
+         'or also reading back a sample or all of the objects')
+@click.option('--verify-sample', type=click.FloatRange(min=0, max=1), default=0.01, metavar="FRACTION",
+    help='Fraction of the objects read back and hashed by --verify sample (default=0.01)')
+@click.option('--verify-report', type=click.Path(dir_okay=False), default='rgw-migrate-verify.json', metavar="PATH",
+    help='Report of the mismatches found by --verify (default=rgw-migrate-verify.json)')
+@click.argument('src', type=str, nargs=1)
+@click.argument('dst', type=str, nargs=1)
+def migrate(src, dst, jobs, chunk_size, segment_threshold, segment_size, segment_mode, journal, resume,
+            scan_threads, queue_size, diff_mode, src_bandwidth, src_rate, dst_bandwidth, dst_rate,
+            throttle_file, metrics_port, metrics_file, retries, dead_letter, retry_failed,
+            engine, concurrency, timeout, shard, shard_by, shard_report, finalize,
+            src_endpoint_concurrency, dst_endpoint_concurrency, verify, verify_sample, verify_report):
+    """
+        Migrate radosgw data between two Ceph clusters
+
+        SRC and DST represent radosgw admin credentials for source
+        and destination clusters in the following format:
+
+            host:port[,host:port...]:access_key:secret_key
+
+        Requests are spread across all the radosgw endpoints listed.
+    """
+
+    def prepare_user(uid):
+        """Make sure the user exists in both clusters and return its swift accounts"""
+        admin_from = get_admin_connection(src_account)
+        admin_to = get_admin_connection(dst_account)
+        shared = shard is not None and shard_by == 'container'
+        user_from = ensure_swift_subuser(admin_from, uid,
+                                         subuser_secret(src_account, uid) if shared else None)
+        try:
+            logger.info("Checking user: %s (%s)" % (user_from.display_name, user_from.uid))
+            user_to = admin_to.get_user(uid)
+        except radosgw.exception.NoSuchUser:
+            # Account does not exist in destination cluster: create it
+            logger.info("Migrating user: %s (%s)" % (user_from.display_name, user_from.uid), exc_info=0)
+            try:
+                user_to = admin_to.create_user(user_from.uid, user_from.display_name, generate_key=False)
+            except Exception:
+                if not shared:
+                    raise
+                # Another shard created the user in the meantime
+                user_to = admin_to.get_user(uid)
+            user_quota = admin_from.get_quota(uid, 'user')
+            admin_to.set_quota(uid, 'user', **user_quota)
+            bucket_quota = admin_from.get_quota(uid, 'bucket')
+            admin_to.set_quota(uid, 'bucket', **bucket_quota)
+            logger.info("Updated quota for user %s: user=%s bucket=%s", uid, user_quota, bucket_quota)
+        user_to = ensure_swift_subuser(admin_to, uid,
+                                       subuser_secret(dst_account, uid) if shared else None)
+
+        swift_account_from = swift_account(user_from.swift_keys[0].user, user_from.swift_keys[0].access_key, 'src')
+        swift_account_to = swift_account(user_to.swift_keys[0].user, user_to.swift_keys[0].access_key, 'dst')
+        return swift_account_from, swift_account_to
+
+    def prepare_user_job(uid):
+        try:
+            return uid, prepare_user(uid), None
+        except Exception as e:
+            logger.exception("Checking user %s FAILED!", uid)
+            return uid, None, '%s: %s' % (type(e).__name__, e)
+
+    def scan_failed(uid, container, error):
+        """Record a user or container whose objects could not be enumerated"""
+        metrics.scan_failed(container)
+        dead_letters.add_scan(uid, container, error)
+
+    def iter_container_jobs(swift_account_from, swift_account_to, container):
+        swift_from = get_swift_connection(swift_account_from)
+        swift_to = get_swift_connection(swift_account_to)
+        container_name = container['name']
+        logger.info("Checking container %s (%d objects, %sB)",
+                    container_name, container['count']/2, human_size(container['bytes']/2))
+        uid = account_uid(swift_account_from)
+        metrics.container_found(uid, container_name, container['count']//2, container['bytes']//2)
+        container_from_hdrs = swift_from.head_container(container_name)
+        try:
+            swift_to.head_container(container_name)
+        except swiftclient.ClientException as e:
+            if e.http_status != 404:
+                raise
+            # Container is not present in destination cluster: create it
+            logger.info('Migrating container %s', container_name)
+            swift_to.put_container(container_name, filter_container_headers(container_from_hdrs))
+        # List objects in the container
+        account = swift_account_from.user
+        marker = journal.get_marker(account, container_name) if resume else ''
+        if marker:
+            logger.info("Resuming container %s after %s", container_name, marker)
+        dst_cursor = ListingCursor(swift_to, container_name, marker) if diff_mode == 'listing' else None
+        for objects_page in iter_container_listing(swift_from, container_name, marker):
+            page = journal.open_page(account, container_name, objects_page) if journal else None
+            batch = {x['name']: x for x in objects_page}
+            if resume:
+                # Skip objects already known to be migrated
+                for k, v in list(batch.items()):
+                    if journal.is_migrated(account, container_name, k, v['hash'], v['bytes']):
+                        metrics.object_up_to_date(uid, container_name, v['bytes'])
+                        del batch[k]
+            # Check which object already exist in the destination cluster
+            if dst_cursor is not None:
+                objs_stats = diff_listing(head_pool, dst_cursor, swift_account_to, container_name, batch)
+            else:
+                objs_stats = head_pool.imap_unordered(head_object_job,
+                                                      [(swift_account_to, container_name, k) for k in batch])
+            for obj_name, dst_hdrs in objs_stats:
+                src_obj = batch[obj_name]
+                if dst_hdrs is not None:
+                    # Object is present in destination: check size and hash
+                    src_size = src_obj['bytes']
+                    src_hash = src_obj['hash']
+                    dst_size = int(dst_hdrs['content-length'])
+                    dst_hash = dst_hdrs['etag']
+                    if dst_size == src_size and dst_hash == src_hash:
+                        metrics.object_up_to_date(uid, container_name, src_size)
+                        if journal:
+                            journal.record(account, container_name, obj_name, src_hash, src_size)
+                        continue
+                    dst_manifest = dst_hdrs.get('x-object-manifest')
+                    if segment_threshold and stored_as_dlo(segment_mode, src_size) and src_size == dst_size \
+                            and src_size >= segment_threshold and dst_manifest is not None \
+                            and unquote(dst_manifest) == unquote(split_manifest(
+                                split_object(container_name, obj_name, src_size, src_hash, segment_size))):
+                        # Regular object previously migrated in segments: the
+                        # segment prefix embeds the source etag
+                        metrics.object_up_to_date(uid, container_name, src_size)
+                        if journal:
+                            journal.record(account, container_name, obj_name, src_hash, src_size)
+                        continue
+                    # The object exists in the destination cluster but size and/or
+                    # hash do not match. If it's a swift large object, we need to
+                    # perform further checks
+                    if src_size == 0 and dst_size > 0:
+                        # Check if both are large objects
+                        src_hdrs = swift_from.head_object(container_name, obj_name)
+                        real_src_size = int(src_hdrs['content-length'])
+                        # We only need to check for DLOs since SLOs are not supported
+                        # in Ceph Hammer
+                        src_manifest = src_hdrs.get('x-object-manifest')
+                        if real_src_size == dst_size and src_manifest is not None and src_manifest == dst_manifest:
+                            # Both are large objects, have the same size and manifests match
+                            metrics.object_up_to_date(uid, container_name, src_size)
+                            if journal:
+                                journal.record(account, container_name, obj_name, src_hash, src_size)
+                            continue
+                    logger.warn("Destination %s/%s does not match source: deleting", container_name, obj_name)
+                    swift_to.delete_object(container_name, obj_name)
+                    if dst_manifest is not None and \
+                            split_manifest_etag(dst_manifest, container_name, obj_name) is not None:
+                        delete_split_segments(swift_to, dst_manifest)
+                for job in submit_object(swift_account_from, swift_account_to, container_name, src_obj, page):
+                    yield job
+            if page:
+                journal.close_page(page)
+
+    def submit_object(swift_account_from, swift_account_to, container_name, src_obj, page):
+        """Yield the transfer jobs of an object: one per segment for large objects"""
+        obj_name = src_obj['name']
+        if page:
+            journal.add_job(page)
+        if segment_threshold and src_obj['bytes'] >= segment_threshold:
+            segments = split_object(container_name, obj_name, src_obj['bytes'],
+                                    src_obj['hash'], segment_size)
+            if (swift_account_to, segments[0].container) not in seg_containers:
+                put_split_container(get_swift_connection(swift_account_from),
+                                    get_swift_connection(swift_account_to), segments[0].container)
+                seg_containers.add((swift_account_to, segments[0].container))
+            lobj = dict(src=swift_account_from, dst=swift_account_to, bucket=container_name,
+                        key=obj_name, obj=src_obj, segments=segments,
+                        remaining=len(segments), failed=False, error=None, page=page)
+            logger.info("Submitting %s/%s for migration in %d segments",
+                        container_name, obj_name, len(segments))
+            for seg in segments:
+                job = (swift_account_from, swift_account_to, container_name, obj_name, chunk_size, seg)
+                large_objects.add(job, lobj)
+                yield job
+            return
+        logger.info("Submitting %s/%s for migration", container_name, obj_name)
+        job = (swift_account_from, swift_account_to, container_name, obj_name, chunk_size)
+        job_objects.add(job, (page, src_obj))
+        yield job
+
+    def scan_container(swift_account_from, swift_account_to, container):
+        try:
+            for job in iter_container_jobs(swift_account_from, swift_account_to, container):
+                jobs_queue.put(job)
+        except Exception as e:
+            if isinstance(e, swiftclient.ClientException):
+                logger.error(e)
+            else:
+                logger.exception("Checking container %s FAILED!", container['name'])
+            scan_failed(account_uid(swift_account_from), container['name'], '%s: %s' % (type(e).__name__, e))
+
+    def list_containers(accounts):
+        """Containers of a user in the shard, or None if they cannot be listed"""
+        uid = account_uid(accounts[0])
+        try:
+            _, containers = get_swift_connection(accounts[0]).get_account(full_listing=True)
+        except Exception as e:
+            logger.error("Listing containers of user %s FAILED: %s", uid, e)
+            scan_failed(uid, None, '%s: %s' % (type(e).__name__, e))
+            return None
+        return [container for container in containers
+                if shard_by != 'container' or in_shard(shard, uid, container['name'])]
+
+    def scan_all():
+        """
+            Enumeration pipeline: users are provisioned by one thread pool
+            while the containers of the users which are ready are listed and
+            compared with the destination by another one
+        """
+        user_pool = ThreadPool(scan_threads)
+        container_pool = ThreadPool(scan_threads)
+        try:
+            logger.info("Connecting to radosgw admin API")
+            uids = [user.uid for user in get_admin_connection(src_account).get_users()
+                    # Ignore non-openstack users
+                    if OS_UID_RE.match(user.uid) is not None]
+            if shard_by == 'user':
+                uids = [uid for uid in uids if in_shard(shard, uid)]
+            for uid, accounts, error in user_pool.imap_unordered(prepare_user_job, uids):
+                if accounts is None:
+                    scan_failed(uid, None, error)
+                    continue
+                # List containers owned by the account
+                for container in list_containers(accounts) or []:
+                    container_pool.apply_async(scan_container, accounts + (container,))
+            container_pool.close()
+            container_pool.join()
+        except Exception as e:
+            logger.exception("Enumeration of objects FAILED!")
+            scan_failed(None, None, '%s: %s' % (type(e).__name__, e))
+        finally:
+            user_pool.terminate()
+            container_pool.terminate()
+            jobs_queue.put(None)
+
+    def scan_dead_letters(entries):
+        """
+            Submit the objects which failed in a previous run, and enumerate
+            again the users and containers which could not be
+        """
+        try:
+            by_user = {}
+            for entry in entries:
+                if entry['user'] is None:
+                    logger.error("The enumeration of users failed in a previous run: "
+                                 "run the migration again without --retry-failed")
+                    scan_failed(None, None, entry['error'])
+                    continue
+                by_user.setdefault(entry['user'], []).append(entry)
+            for uid, user_entries in sorted(by_user.items()):
+                _, accounts, error = prepare_user_job(uid)
+                if accounts is None:
+                    for entry in user_entries:
+                        if entry['name'] is None:
+                            scan_failed(uid, entry['container'], error)
+                        else:
+                            metrics.object_done(uid, entry['container'], 0, failed=True)
+                            dead_letters.add_entry(dict(entry, error=error))
+                    continue
+                for entry in user_entries:
+                    if entry['name'] is None:
+                        containers = list_containers(accounts)
+                        for container in containers or []:
+                            if entry['container'] is None or container['name'] == entry['container']:
+                                scan_container(accounts[0], accounts[1], container)
+                        continue
+                    src_obj = dict(name=entry['name'], bytes=entry['bytes'], hash=entry['hash'])
+                    try:
+                        for job in submit_object(accounts[0], accounts[1], entry['container'], src_obj, None):
+                            jobs_queue.put(job)
+                    except Exception as e:
+                        logger.error("Submitting %s/%s FAILED: %s", entry['container'], entry['name'], e)
+                        metrics.object_done(uid, entry['container'], 0, failed=True)
+                        dead_letters.add(uid, entry['container'], src_obj, '%s: %s' % (type(e).__name__, e))
+        except Exception as e:
+            logger.exception("Enumeration of failed objects FAILED!")
+            scan_failed(None, None, '%s: %s' % (type(e).__name__, e))
+        finally:
+            jobs_queue.put(None)
+
+    def iter_objects(scan, *args):
+        scanner = threading.Thread(target=scan, args=args, name='scanner')
+        scanner.daemon = True
+        scanner.start()
+        while True:
+            job = jobs_queue.get()
+            if job is None:
+                return
+            yield job
+
+    src_account = decode_s3_account(src, 'src')
+    dst_account = decode_s3_account(dst, 'dst')
+    _gateways['src'] = Gateways(src_account.endpoints, src_endpoint_concurrency)
+    _gateways['dst'] = Gateways(dst_account.endpoints, dst_endpoint_concurrency)
+    _throttles['src'] = cluster_throttles(Throttle(src_bandwidth), Throttle(src_rate))
+    _throttles['dst'] = cluster_throttles(Throttle(dst_bandwidth), Throttle(dst_rate))
+
+    if finalize:
+        if finalize_shards(src_account, dst_account, finalize, dead_letter):
+            logger.error("Migration completed with failures: recorded in %s", dead_letter)
+            sys.exit(1)
+        logger.info("Migration completed")
+        return
+
+    if verify:
+        if verify_migration(src_account, dst_account, verify, verify_sample, scan_threads, jobs,
+                            chunk_size, verify_report):
+            sys.exit(1)
+        return
+
+    if shard is not None:
+        suffix = '-%d-of-%d' % shard
+        if shard_report is None:
+            shard_report = 'rgw-migrate-shard%s.json' % suffix
+        if dead_letter == 'rgw-migrate-failed.jsonl':
+            dead_letter = 'rgw-migrate-failed%s.jsonl' % suffix
+        logger.info("Migrating shard %d/%d by %s", shard[0], shard[1], shard_by)
+
+    if resume and not journal:
+        raise click.BadParameter('--resume requires a journal', param_hint='--journal')
+    journal = Journal(journal) if journal else None
+    dead_letters = DeadLetters(dead_letter)
+    if retry_failed:
+        if not os.path.exists(dead_letter):
+            raise click.BadParameter('%s does not exist' % dead_letter, param_hint='--dead-letter')
+        scan, scan_args = scan_dead_letters, (dead_letters.take(),)
+        logger.info("Retrying %d failed objects", len(scan_args[0]))
+    else:
+        scan, scan_args = scan_all, ()
+
+    if engine == 'async':
+        try:
+            from rgw_migrate_async import run_jobs
+        except (ImportError, SyntaxError):
+            raise click.BadParameter('the async engine requires Python 3.6 or later', param_hint='--engine')
+
+    jobs_queue = Queue(maxsize=queue_size)
+    metrics = Metrics(jobs if engine == 'pool' else concurrency)
+    seg_containers = set()
+    # Objects being migrated in segments, indexed by segment job
+    large_objects = PendingJobs()
+    # Listing page and source listing entry of the regular object jobs
+    job_objects = PendingJobs()
+
+    if engine == 'pool':
+        pool = Pool(processes=jobs, initializer=init_worker, initargs=(retries,))
+    # Threads are only started once the worker processes have been forked
+    head_pool = ThreadPool(HEAD_THREADS)
+    checker = threading.Thread(target=watch_endpoints, name='health-checker')
+    checker.daemon = True
+    checker.start()
+    if throttle_file:
+        reload_event = threading.Event()
+        signal.signal(signal.SIGHUP, lambda signum, frame: reload_event.set())
+        watcher = threading.Thread(target=watch_throttle_file, args=(throttle_file, reload_event),
+                                   name='throttle-watcher')
+        watcher.daemon = True
+        watcher.start()
+    if metrics_port:
+        serve_metrics(metrics, metrics_port)
+    if metrics_file:
+        writer = threading.Thread(target=watch_metrics_file, args=(metrics, metrics_file),
+                                  name='metrics-writer')
+        writer.daemon = True
+        writer.start()
+    last_report = time.time()
+    if engine == 'pool':
+        results = pool.imap_unordered(migrate_object_job, iter_objects(scan, *scan_args))
+    else:
+        results = run_jobs(iter_objects(scan, *scan_args), concurrency, timeout, retries, retry_delay,
+                           filter_object_headers, _throttles, _gateways)
+    for job, (bucket, key, size, elapsed, stats) in results:
+        if time.time() - last_report > REPORT_INTERVAL:
+            snap = metrics.snapshot()
+            # An empty queue means transfer jobs are waiting for the enumeration
+            logger.info("Progress: %d/%d objects, %sB/%sB, %sB/s, ETA %s, %d/%d objects queued",
+                        snap['totals']['done'], snap['totals']['objects'], human_size(snap['totals']['done_bytes']),
+                        human_size(snap['totals']['bytes']), human_size(int(snap['bytes_per_second'])),
+                        '%ds' % snap['eta'] if snap['eta'] is not None else 'unknown',
+                        jobs_queue.qsize(), queue_size)
+            last_report = time.time()
+        metrics.transfer_done(size, stats)
+        uid = account_uid(job[0])
+        if size < 0:
+            logger.info("Upload of %s/%s FAILED!" % (bucket, key))
+        else:
+            logger.info("Upload of %s/%s completed in %ds" % (bucket, key, elapsed))
+        lobj = large_objects.pop(job, None)
+        if lobj is None:
+            page, src_obj = job_objects.pop(job)
+            metrics.object_done(uid, bucket, size, failed=size < 0)
+            if size < 0:
+                dead_letters.add(uid, bucket, src_obj, elapsed)
+            if page:
+                if size >= 0:
+                    journal.record(page['account'], bucket, key, src_obj['hash'], src_obj['bytes'])
+                journal.job_done(page, failed=size < 0)
+        else:
+            if size < 0:
+                lobj['failed'] = True
+                lobj['error'] = lobj['error'] or elapsed
+            lobj['remaining'] -= 1
+            if lobj['remaining'] > 0:
+                continue
+            if lobj['failed']:
+                logger.error("Upload of %s/%s FAILED: one or more segments could not be migrated",
+                             lobj['bucket'], lobj['key'])
+            else:
+                try:
+                    finish_large_object(lobj, segment_mode)
+                    logger.info("Upload of %s/%s completed (%d segments)", lobj['bucket'], lobj['key'],
+                                len(lobj['segments']))
+                    if lobj['page']:
+                        journal.record(lobj['page']['account'], lobj['bucket'], lobj['key'],
+                                       lobj['obj']['hash'], lobj['obj']['bytes'])
+                except Exception as e:
+                    logger.exception("Upload of %s/%s FAILED!", lobj['bucket'], lobj['key'])
+                    lobj['failed'] = True
+                    lobj['error'] = '%s: %s' % (type(e).__name__, e)
+            if lobj['failed']:
+                dead_letters.add(uid, lobj['bucket'], lobj['obj'], lobj['error'])
+            metrics.object_done(uid, lobj['bucket'], sum(seg.length for seg in lobj['segments']),
+                                failed=lobj['failed'])
+            if lobj['page']:
+                journal.job_done(lobj['page'], failed=lobj['failed'])
+    if engine == 'pool':
+        pool.close()
+        pool.join()
+    head_pool.close()
+    if throttle_file:
+        # Python restores the default action of SIGHUP, i.e. exiting, when shutting down
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    if journal:
+        journal.close()
+    snap = metrics.snapshot()
+    obj_count = snap['totals']['migrated']
+    if obj_count:
+        logger.info("Transferred %d objects (%sB) in %ds: %.1f objects/s, %sB/s, %d retries, %d failures",
+                    obj_count, human_size(snap['transferred_bytes']), snap['elapsed'],
+                    obj_count / snap['elapsed'], human_size(int(snap['bytes_per_second'])),
+                    snap['retries'], snap['totals']['failed'])
+    if metrics_file:
+        write_metrics_file(metrics, metrics_file)
+
+    if shard is not None:
+        # Other shards may still be using the temporary subusers: they are
+        # removed by --finalize once all the shards are done
+        report = dict(shard=shard[0], shards=shard[1], shard_by=shard_by, finished=time.time(),
+                      elapsed=snap['elapsed'], transferred_bytes=snap['transferred_bytes'],
+                      totals=snap['totals'], failed_users=snap['failed_users'],
+                      failed_containers=snap['failed_containers'], failed_objects=dead_letters.entries())
+        with open(shard_report, 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info("Shard %d/%d completed: report written to %s", shard[0], shard[1], shard_report)
+    else:
+        remove_migration_subusers(src_account, dst_account)
+
+    if dead_letters.count:
+        logger.error("Migration completed with %d failures (%d users and %d containers not enumerated): "
+                     "recorded in %s", dead_letters.count, snap['failed_users'], snap['failed_containers'],
+                     dead_letter)
+        sys.exit(1)
     logger.info("Migration completed")
 
 if __name__ == '__main__':
@@ -0,0 +1,437 @@
+"""
+    asyncio transfer engine for rgw-migrate.py
+
+    Runs the transfer jobs produced by rgw-migrate.py on an event loop rather
+    than in a multiprocessing.Pool: a single process keeps hundreds of
+    requests in flight, sharing keep-alive connections and auth tokens
+    between all the transfers. Requires Python 3.6 or later.
+"""
+
+import asyncio, logging, re, threading, time
+from collections import deque
+from queue import Queue
+from urllib.parse import quote, urlparse
+
+logger = logging.getLogger('rgw-migrate')
+
+# Delay between attempts to reserve a transfer slot on a busy endpoint
+ENDPOINT_WAIT = 0.05
+# ETags which are the MD5 digest of the content, unlike the ones of S3 multipart uploads
+MD5_RE = re.compile('^[0-9a-fA-F]{32}$')
+
+class HTTPError(Exception):
+    """Unexpected response status, mirrors swiftclient.ClientException"""
+
+    def __init__(self, method, path, status, reason):
+        Exception.__init__(self, '%s %s: %d %s' % (method, path, status, reason))
+        self.http_status = status
+
+def is_retryable(e):
+    if isinstance(e, HTTPError):
+        return e.http_status in (401, 408, 429) or e.http_status >= 500
+    return isinstance(e, (IOError, OSError, asyncio.TimeoutError, asyncio.IncompleteReadError))
+
+class Response(object):
+
+    def __init__(self, method, status, reason, headers, conn, pool):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.conn = conn
+        self.pool = pool
+        self.keep_alive = headers.get('connection', '').lower() != 'close'
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            self.remaining = 0
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            self.remaining = None
+        elif 'content-length' in headers:
+            self.remaining = int(headers['content-length'])
+        else:
+            # Body delimited by the end of the connection
+            self.remaining = -1
+            self.keep_alive = False
+
+    async def iter_body(self, chunk_size):
+        reader = self.conn[0]
+        timeout = self.pool.timeout
+        if self.remaining is None:
+            while True:
+                size = int((await asyncio.wait_for(reader.readline(), timeout)).split(b';')[0], 16)
+                if size == 0:
+                    # Trailers
+                    while (await asyncio.wait_for(reader.readline(), timeout)) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                while size > 0:
+                    chunk = await asyncio.wait_for(reader.readexactly(min(size, chunk_size)), timeout)
+                    size -= len(chunk)
+                    yield chunk
+                await asyncio.wait_for(reader.readline(), timeout)
+            self.remaining = 0
+        elif self.remaining < 0:
+            while True:
+                chunk = await asyncio.wait_for(reader.read(chunk_size), timeout)
+                if not chunk:
+                    break
+                yield chunk
+        else:
+            while self.remaining > 0:
+                chunk = await asyncio.wait_for(reader.read(min(self.remaining, chunk_size)), timeout)
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b'', self.remaining)
+                self.remaining -= len(chunk)
+                yield chunk
+
+    async def read(self):
+        return b''.join([chunk async for chunk in self.iter_body(65536)])
+
+    async def release(self):
+        """Discard the rest of the body and give the connection back to its pool"""
+        if self.conn is None:
+            return
+        try:
+            if self.keep_alive and self.remaining:
+                await self.read()
+        except Exception:
+            self.keep_alive = False
+        if self.keep_alive:
+            self.pool.put(self.conn)
+        else:
+            self.conn[1].close()
+        self.conn = None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn[1].close()
+            self.conn = None
+
+class ConnectionPool(object):
+    """
+        Idle keep-alive connections to a radosgw endpoint, and the seconds to
+        wait for a new connection or for each read and write on them
+    """
+
+    def __init__(self, host, port, limit, timeout):
+        self.host = host
+        self.port = port
+        self.limit = limit
+        self.timeout = timeout
+        self.idle = deque()
+
+    async def get(self):
+        """Return a (reader, writer, reused) tuple"""
+        while self.idle:
+            reader, writer = self.idle.pop()
+            if not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        return reader, writer, False
+
+    def put(self, conn):
+        if len(self.idle) < self.limit:
+            self.idle.append(conn)
+        else:
+            conn[1].close()
+
+    def close(self):
+        while self.idle:
+            self.idle.pop()[1].close()
+
+class AsyncSwift(object):
+    """
+        Minimal Swift v1 client for a single account, sending its requests to
+        any endpoint of the cluster of the account
+    """
+
+    def __init__(self, engine, account):
+        self.engine = engine
+        self.account = account
+        self.gateways = engine.gateways[account.cluster]
+        self.token = None
+        self.path = None
+        self.auth_lock = asyncio.Lock()
+
+    async def authenticate(self):
+        async with self.auth_lock:
+            if self.token is not None:
+                # Another transfer already renewed the token
+                return
+            endpoint = self.gateways.pick()
+            resp = await self.send(endpoint, 'GET', '/auth', {
+                'X-Auth-User': self.account.user, 'X-Auth-Key': self.account.key})
+            await resp.release()
+            if resp.status // 100 != 2:
+                raise HTTPError('GET', '/auth', resp.status, resp.reason)
+            # Tokens are valid on every endpoint of the cluster: only keep
+            # the path of the storage URL advertised by radosgw
+            self.path = urlparse(resp.headers['x-storage-url']).path.rstrip('/')
+            self.token = resp.headers['x-auth-token']
+
+    async def send(self, endpoint, method, path, headers, body=None):
+        try:
+            return await self.engine.send(self.engine.get_pool(*endpoint), method, path, headers, body)
+        except (IOError, OSError, asyncio.TimeoutError):
+            # No response at all: fail over to the other endpoints
+            self.gateways.mark_down(endpoint)
+            raise
+
+    async def request(self, endpoint, method, container, obj=None, headers=None, body=None, content_length=None):
+        """Send a request to endpoint and return the response, its body still unread"""
+        for attempt in range(2):
+            if self.token is None:
+                await self.authenticate()
+            token = self.token
+            path = '/'.join([self.path] + [quote(x.encode('utf-8')) for x in (container, obj) if x is not None])
+            hdrs = dict(headers or {})
+            hdrs['X-Auth-Token'] = token
+            if body is not None or method == 'PUT':
+                hdrs['Content-Length'] = str(content_length if content_length is not None else len(body or b''))
+            await self.engine.throttle(1, self.engine.rate_throttle(self.account.cluster))
+            resp = await self.send(endpoint, method, path, hdrs, body)
+            if resp.status == 401:
+                # Token expired: authenticate again and retry once, streamed
+                # bodies are retried by the caller
+                await resp.release()
+                if self.token == token:
+                    self.token = None
+                if attempt == 0 and not hasattr(body, '__aiter__'):
+                    continue
+            if resp.status // 100 != 2:
+                await resp.release()
+                raise HTTPError(method, path, resp.status, resp.reason)
+            return resp
+
+class AsyncEngine(object):
+    """Run transfer jobs with at most `concurrency` of them in flight"""
+
+    def __init__(self, concurrency, timeout, max_retries, retry_delay, filter_headers, throttles, gateways):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.filter_headers = filter_headers
+        self.throttles = throttles
+        self.gateways = gateways
+        self.pools = {}
+        self.clients = {}
+        self.results = Queue()
+
+    def get_pool(self, host, port):
+        key = (host, port)
+        if key not in self.pools:
+            self.pools[key] = ConnectionPool(host, port, self.concurrency, self.timeout)
+        return self.pools[key]
+
+    def get_client(self, account):
+        if account not in self.clients:
+            self.clients[account] = AsyncSwift(self, account)
+        return self.clients[account]
+
+    def rate_throttle(self, cluster):
+        return [self.throttles[cluster].rate] if cluster in self.throttles else []
+
+    def bandwidth_throttles(self):
+        return [t.bandwidth for t in self.throttles.values()]
+
+    async def acquire(self, gateways):
+        """Reserve a transfer slot on an endpoint and return its index"""
+        while True:
+            i = gateways.try_acquire()
+            if i is not None:
+                return i
+            await asyncio.sleep(ENDPOINT_WAIT)
+
+    async def throttle(self, amount, throttles):
+        delay = max([t.reserve(amount) for t in throttles] or [0])
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def send(self, pool, method, path, headers, body=None):
+        """Send a request on a pooled connection and read the response headers"""
+        for attempt in range(2):
+            reader, writer, reused = await pool.get()
+            try:
+                lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s:%d' % (pool.host, pool.port)]
+                lines.extend('%s: %s' % (k, v) for k, v in headers.items())
+                writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+                if hasattr(body, '__aiter__'):
+                    async for chunk in body:
+                        writer.write(chunk)
+                        await asyncio.wait_for(writer.drain(), pool.timeout)
+                elif body:
+                    writer.write(body)
+                await asyncio.wait_for(writer.drain(), pool.timeout)
+                status_line = await asyncio.wait_for(reader.readline(), pool.timeout)
+                if not status_line:
+                    raise ConnectionResetError('connection closed by %s:%d' % (pool.host, pool.port))
+                _, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+                resp_headers = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), pool.timeout)
+                    line = line.decode('latin-1').rstrip('\r\n')
+                    if not line:
+                        break
+                    k, v = line.split(':', 1)
+                    resp_headers[k.strip().lower()] = v.strip()
+                return Response(method, int(status), reason, resp_headers, (reader, writer), pool)
+            except BaseException as e:
+                # The connection is in an unknown state, e.g. when a read
+                # timed out or the transfer was cancelled
+                writer.close()
+                # Idle keep-alive connections may have been closed by the
+                # server: retry once on a new one unless the body is a stream.
+                # Timeouts are OSErrors as of Python 3.11 but are not retried.
+                if isinstance(e, (IOError, OSError)) and not isinstance(e, asyncio.TimeoutError) \
+                        and reused and attempt == 0 and not hasattr(body, '__aiter__'):
+                    continue
+                raise
+
+    async def transfer(self, job, stats):
+        src, dst, bucket, key, chunk_size = job[:5]
+        seg = job[5] if len(job) > 5 else None
+        swift_from = self.get_client(src)
+        swift_to = self.get_client(dst)
+        src_slot = await self.acquire(swift_from.gateways)
+        try:
+            dst_slot = await self.acquire(swift_to.gateways)
+        except BaseException:
+            swift_from.gateways.release(src_slot)
+            raise
+        src_endpoint = swift_from.gateways.endpoints[src_slot]
+        dst_endpoint = swift_to.gateways.endpoints[dst_slot]
+        responses = []
+        try:
+            if seg is not None:
+                byte_range = 'bytes=%d-%d' % (seg.offset, seg.offset + seg.length - 1)
+                t = time.time()
+                resp = await swift_from.request(src_endpoint, 'GET', bucket, key, headers={'Range': byte_range})
+                stats['get'] = time.time() - t
+                responses.append(resp)
+                put_container, put_key, headers = seg.container, seg.name, {}
+            else:
+                t = time.time()
+                resp = await swift_from.request(src_endpoint, 'HEAD', bucket, key)
+                stats['head'] = time.time() - t
+                await resp.release()
+                headers = self.filter_headers(resp.headers)
+                size = int(resp.headers.get('content-length'))
+                put_container, put_key = bucket, key
+                if size > 0 and headers.get('x-object-manifest') is None:
+                    t = time.time()
+                    resp = await swift_from.request(src_endpoint, 'GET', bucket, key)
+                    stats['get'] = time.time() - t
+                    responses.append(resp)
+                    if MD5_RE.match(resp.headers.get('etag') or ''):
+                        headers['ETag'] = resp.headers['etag']
+                else:
+                    resp = None
+            if resp is None:
+                t = time.time()
+                responses.append(await swift_to.request(dst_endpoint, 'PUT', put_container, put_key, headers=headers, body=b''))
+                stats['put'] = time.time() - t
+                await responses[-1].release()
+                return size
+            size = int(resp.headers.get('content-length'))
+
+            async def body():
+                async for chunk in resp.iter_body(chunk_size):
+                    await self.throttle(len(chunk), self.bandwidth_throttles())
+                    yield chunk
+
+            t = time.time()
+            responses.append(await swift_to.request(dst_endpoint, 'PUT', put_container, put_key, headers=headers,
+                                                    body=body(), content_length=size))
+            stats['put'] = time.time() - t
+            for r in responses:
+                await r.release()
+            return size
+        except BaseException:
+            for r in responses:
+                r.close()
+            raise
+        finally:
+            swift_from.gateways.release(src_slot)
+            swift_to.gateways.release(dst_slot)
+
+    async def migrate(self, job):
+        """Same contract as migrate_object() in rgw-migrate.py"""
+        bucket, key = job[2], job[3]
+        seg = job[5] if len(job) > 5 else None
+        bucket_key = (seg.container, seg.name) if seg is not None else (bucket, key)
+        stats = dict(head=None, get=None, put=None, retries=0)
+        t1 = time.time()
+        attempt = 0
+        while True:
+            try:
+                size = await self.transfer(job, stats)
+                stats['elapsed'] = time.time() - t1
+                return bucket_key + (size, stats['elapsed'], stats)
+            except Exception as e:
+                if is_retryable(e) and attempt < self.max_retries:
+                    delay = self.retry_delay(attempt)
+                    attempt += 1
+                    stats['retries'] += 1
+                    logger.warning("Uploading %s/%s failed (%s): retrying in %.1fs", bucket, key, e, delay)
+                    await asyncio.sleep(delay)
+                    continue
+                logger.exception('Uploading %s/%s FAILED!', bucket, key)
+                stats['elapsed'] = time.time() - t1
+                return bucket_key + (-1, '%s: %s' % (type(e).__name__, e), stats)
+
+    async def run_job(self, job, slots):
+        try:
+            result = await self.migrate(job)
+        finally:
+            slots.release()
+        self.results.put((job, result))
+
+    async def run(self, jobs):
+        loop = asyncio.get_event_loop()
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        jobs = iter(jobs)
+        try:
+            while True:
+                await slots.acquire()
+                # The job iterator blocks while the enumeration is running
+                job = await loop.run_in_executor(None, next, jobs, None)
+                if job is None:
+                    break
+                task = loop.create_task(self.run_job(job, slots))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(list(tasks))
+        finally:
+            for pool in self.pools.values():
+                pool.close()
+
+def run_jobs(jobs, concurrency, timeout, max_retries, retry_delay, filter_headers, throttles, gateways):
+    """
+        Run the transfer jobs on an event loop in a background thread and
+        yield (job, result) tuples as they complete, like
+        Pool.imap_unordered(migrate_object_job, jobs)
+    """
+    engine = AsyncEngine(concurrency, timeout, max_retries, retry_delay, filter_headers, throttles, gateways)
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(engine.run(jobs))
+        except Exception:
+            logger.exception("Transfer engine FAILED!")
+        finally:
+            loop.close()
+            engine.results.put(None)
+
+    thread = threading.Thread(target=run, name='async-engine')
+    thread.daemon = True
+    thread.start()
+    while True:
+        result = engine.results.get()
+        if result is None:
+            break
+        yield result
+    thread.join()